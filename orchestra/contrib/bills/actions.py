@@ -50,9 +50,10 @@ def close_bills(modeladmin, request, queryset, action='close_bills'):
         formset = SelectSourceFormSet(request.POST, request.FILES, queryset=queryset)
         if formset.is_valid():
             transactions = []
+            numbers = Bill.reserve_numbers([form.instance for form in formset.forms])
             for form in formset.forms:
                 source = form.cleaned_data['source']
-                transaction = form.instance.close(payment=source)
+                transaction = form.instance.close(payment=source, number=numbers[form.instance])
                 if transaction:
                     transactions.append(transaction)
             for bill in queryset:
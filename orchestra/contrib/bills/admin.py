@@ -22,7 +22,7 @@ from . import settings, actions
 from .filters import (BillTypeListFilter, HasBillContactListFilter, TotalListFilter,
     PaymentStateListFilter, AmendedListFilter)
 from .models import (Bill, Invoice, AmendmentInvoice, AbonoInvoice, Fee, AmendmentFee, ProForma, BillLine,
-    BillSubline, BillContact)
+    BillSubline, BillContact, deferred_totals)
 
 
 PAYMENT_STATE_COLORS = {
@@ -202,6 +202,11 @@ class BillLineAdmin(admin.ModelAdmin):
             return False
         return super().has_delete_permission(request, obj)
 
+    def save_related(self, request, form, formsets, change):
+        # Bill totals updated once for all the sublines
+        with deferred_totals():
+            super().save_related(request, form, formsets, change)
+
 
 class BillLineManagerAdmin(BillLineAdmin):
     def get_queryset(self, request):
@@ -253,7 +258,7 @@ class BillAdminMixin(AccountAdminMixin):
             subtotals = '\n'.join(subtotals)
             return '<span title="%s">%s &%s;</span>' % (subtotals, bill.compute_total(), currency)
     display_total_with_subtotals.short_description = _("total")
-    display_total_with_subtotals.admin_order_field = 'approx_total'
+    display_total_with_subtotals.admin_order_field = 'total'
 
     @mark_safe
     def display_payment_state(self, bill):
@@ -278,16 +283,11 @@ class BillAdminMixin(AccountAdminMixin):
             return '<a href="{url}" style="color:{color}" title="{title}">{name}</a>'.format(
                 url=url, color=color, name=state, title=title)
     display_payment_state.short_description = _("Payment")
+    display_payment_state.admin_order_field = 'payment_state'
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        qs = qs.annotate(
-            models.Count('lines'),
-            # FIXME https://code.djangoproject.com/ticket/10060
-            approx_total=Coalesce(Sum(
-                (F('lines__subtotal') + Coalesce('lines__sublines__total', 0)) * (1+F('lines__tax')/100),
-            ), 0),
-        )
+        qs = qs.annotate(models.Count('lines'))
         qs = qs.prefetch_related(
             Prefetch('amends', queryset=Bill.objects.filter(is_open=False), to_attr='closed_amends')
         )
@@ -378,7 +378,7 @@ class BillAdmin(BillAdminMixin, ExtendedModelAdmin):
         currency = settings.BILLS_CURRENCY.lower()
         return format_html('{} &{};', bill.compute_total(), currency)
     display_total.short_description = _("total")
-    display_total.admin_order_field = 'approx_total'
+    display_total.admin_order_field = 'total'
 
     def type_link(self, bill):
         bill_type = bill.type.lower()
@@ -449,6 +449,11 @@ class BillAdmin(BillAdminMixin, ExtendedModelAdmin):
             formfield.queryset = formfield.queryset.filter(is_open=False)
         return formfield
 
+    def save_related(self, request, form, formsets, change):
+        # Bill totals updated once for all the lines
+        with deferred_totals():
+            super().save_related(request, form, formsets, change)
+
     def change_view(self, request, object_id, **kwargs):
         # TODO raise404, here and everywhere
         bill = self.get_object(request, unquote(object_id))
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 from orchestra.core import accounts
 
@@ -10,3 +11,13 @@ class BillsConfig(AppConfig):
     def ready(self):
         from .models import Bill
         accounts.register(Bill, icon='invoice.png')
+        from . import signals
+        post_migrate.connect(self.backfill_totals, sender=self,
+            dispatch_uid="orchestra.contrib.bills.apps.backfill_totals")
+    
+    def backfill_totals(self, **kwargs):
+        """ stores the totals of the bills created before they were stored """
+        from .models import Bill
+        for bill in Bill.objects.filter(total__isnull=True).only('id').iterator():
+            # Also updates the payment state
+            bill.update_totals()
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from orchestra.contrib.bills.models import Bill
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the stored payment state of the bills from their transactions, needed '
+            'for backfilling it on existing bills or verifying that it is in sync.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('bills', nargs='*', type=int,
+            help='Ids of the bills to recompute, all by default.')
+        parser.add_argument('--check', action='store_true', dest='check', default=False,
+            help='Only reports the bills with an out of sync payment state, without updating them.')
+
+    def handle(self, *args, **options):
+        bills = Bill.objects.all()
+        if options.get('bills'):
+            bills = bills.filter(id__in=options.get('bills'))
+        verbosity = int(options.get('verbosity'))
+        if options.get('check'):
+            mismatches = 0
+            for bill in bills.prefetch_related('transactions').defer('html'):
+                state = bill.compute_payment_state()
+                if state != bill.payment_state:
+                    mismatches += 1
+                    if verbosity > 1:
+                        self.stdout.write('%s: stored payment state %s, computed %s' % (
+                            bill.number, bill.payment_state or 'OPEN', state or 'OPEN'))
+            if mismatches:
+                raise CommandError('%i bills have an out of sync payment state.' % mismatches)
+            if verbosity:
+                self.stdout.write('All bill payment states are in sync.')
+        else:
+            count = bills.update_payment_state()
+            if verbosity:
+                self.stdout.write('%i bills have been updated.' % count)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from orchestra.contrib.bills.models import Bill
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the stored totals of the bills from their lines, for verifying that they '
+            'are in sync. Bills without stored totals are also backfilled by migrate.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('bills', nargs='*', type=int,
+            help='Ids of the bills to recompute, all by default.')
+        parser.add_argument('--check', action='store_true', dest='check', default=False,
+            help='Only reports the bills with out of sync totals, without updating them.')
+
+    def handle(self, *args, **options):
+        bills = Bill.objects.defer('html').order_by('id')
+        if options.get('bills'):
+            bills = bills.filter(id__in=options.get('bills'))
+        check = options.get('check')
+        verbosity = int(options.get('verbosity'))
+        mismatches = []
+        for bill in bills.iterator():
+            stored = (bill.total, bill.base, bill.tax)
+            if bill.total is not None:
+                stored += (bill.compute_subtotals(),)
+            bill.update_totals(commit=False)
+            if stored == (bill.total, bill.base, bill.tax, bill.compute_subtotals()):
+                continue
+            mismatches.append(bill.pk)
+            if verbosity > 1:
+                self.stdout.write('%s: stored total %s, computed %s' % (bill.number, stored[0], bill.total))
+            if not check:
+                Bill.objects.filter(pk=bill.pk).update(
+                    total=bill.total, base=bill.base, tax=bill.tax, subtotals=bill.subtotals)
+        if check:
+            if mismatches:
+                raise CommandError('%i bills have out of sync totals.' % len(mismatches))
+            if verbosity:
+                self.stdout.write('All bill totals are in sync.')
+        else:
+            # The payment state depends on the total
+            Bill.objects.filter(pk__in=mismatches).update_payment_state()
+            if verbosity:
+                self.stdout.write('%i bills have been updated.' % len(mismatches))
@@ -1,14 +1,16 @@
 import datetime
+import decimal
+import json
+import threading
 from dateutil.relativedelta import relativedelta
 
 from django.urls import reverse
 from django.core.validators import ValidationError, RegexValidator
-from django.db import models
-from django.db.models import F, Sum
+from django.db import IntegrityError, models, transaction
+from django.db.models import Sum
 from django.db.models.functions import Coalesce
 from django.template import loader
 from django.utils import timezone, translation
-from django.utils.encoding import force_str
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
@@ -18,6 +20,7 @@ from orchestra.contrib.contacts.models import Contact
 from orchestra.core import validators
 from orchestra.utils.functional import cached
 from orchestra.utils.html import html_to_pdf
+from orchestra.utils.python import random_ascii
 
 from . import settings
 
@@ -52,7 +55,20 @@ class BillContact(models.Model):
         })
 
 
-class BillManager(models.Manager):
+class BillQuerySet(models.QuerySet):
+    def update_payment_state(self):
+        """ recomputes the stored payment state, with an update per changed state """
+        states = {}
+        for bill in self.prefetch_related('transactions').defer('html'):
+            state = bill.compute_payment_state()
+            if state != bill.payment_state:
+                states.setdefault(state, []).append(bill.pk)
+        for state, pks in states.items():
+            Bill.objects.filter(pk__in=pks).update(payment_state=state)
+        return sum(len(pks) for pks in states.values())
+
+
+class BillManager(models.Manager.from_queryset(BillQuerySet)):
     def get_queryset(self):
         queryset = super(BillManager, self).get_queryset()
         if self.model != Bill:
@@ -106,13 +122,23 @@ class Bill(models.Model):
     amend_of = models.ForeignKey('self', null=True, blank=True, verbose_name=_("amend of"),
         related_name='amends', on_delete=models.SET_NULL)
     type = models.CharField(_("type"), max_length=16, choices=TYPES)
+    payment_state = models.CharField(_("payment state"), max_length=16, choices=PAYMENT_STATES,
+        default=OPEN, blank=True, editable=False, db_index=True)
     created_on = models.DateField(_("created on"), auto_now_add=True)
     closed_on = models.DateField(_("closed on"), blank=True, null=True, db_index=True)
     is_open = models.BooleanField(_("open"), default=True)
     is_sent = models.BooleanField(_("sent"), default=False)
     due_on = models.DateField(_("due on"), null=True, blank=True)
     updated_on = models.DateField(_("updated on"), auto_now=True)
-#    total = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    # Totals of the lines, kept in sync by update_totals(), null until backfilled
+    total = models.DecimalField(_("total"), max_digits=12, decimal_places=2, null=True,
+        editable=False)
+    base = models.DecimalField(_("base"), max_digits=12, decimal_places=2, null=True,
+        editable=False)
+    tax = models.DecimalField(_("tax"), max_digits=12, decimal_places=2, null=True,
+        editable=False)
+    subtotals = models.TextField(_("subtotals"), null=True, editable=False,
+        help_text=_("JSON of [subtotal, tax] by tax rate."))
     comments = models.TextField(_("comments"), blank=True)
     html = models.TextField(_("HTML"), blank=True)
 
@@ -130,10 +156,6 @@ class Bill(models.Model):
             cls = cls.__base__
         return cls.__name__.upper()
 
-    @cached_property
-    def total(self):
-        return self.compute_total()
-
     @cached_property
     def seller(self):
         return Account.objects.get_main().billcontact
@@ -146,8 +168,7 @@ class Bill(models.Model):
     def has_multiple_pages(self):
         return self.type != self.FEE
 
-    @cached_property
-    def payment_state(self):
+    def compute_payment_state(self, transactions=None):
         if self.is_open or self.get_type() == self.PROFORMA:
             return self.OPEN
         secured = 0
@@ -156,7 +177,9 @@ class Bill(models.Model):
         processed = False
         executed = False
         rejected = False
-        for transaction in self.transactions.all():
+        if transactions is None:
+            transactions = self.transactions.all()
+        for transaction in transactions:
             if transaction.state == transaction.SECURED:
                 secured += transaction.amount
                 pending += transaction.amount
@@ -193,6 +216,23 @@ class Bill(models.Model):
             return self.EXECUTED
         return self.BAD_DEBT
 
+    @transaction.atomic
+    def update_payment_state(self, commit=True):
+        """ stores the payment state of the current transactions and total """
+        transactions = self.transactions.model.objects.filter(bill_id=self.pk)
+        if not commit:
+            self.payment_state = self.compute_payment_state(transactions=transactions)
+            return
+        # Serializes concurrent transitions of the bill transactions, the stored bill is used
+        # because self may be stale or only have its pk, e.g. when updated from signals
+        bill = Bill.objects.select_for_update().defer('html').filter(pk=self.pk).first()
+        if bill is None:
+            # Deleted along with its transactions
+            return
+        self.payment_state = bill.compute_payment_state(transactions=transactions)
+        if self.payment_state != bill.payment_state:
+            Bill.objects.filter(pk=self.pk).update(payment_state=self.payment_state)
+
     def clean(self):
         if self.amend_of_id:
             errors = {}
@@ -207,10 +247,6 @@ class Bill(models.Model):
             if errors:
                 raise ValidationError(errors)
 
-    def get_payment_state_display(self):
-        value = self.payment_state
-        return force_str(dict(self.PAYMENT_STATES).get(value, value))
-
     def get_current_transaction(self):
         return self.transactions.exclude_rejected().first()
 
@@ -227,30 +263,51 @@ class Bill(models.Model):
             raise TypeError("%s has no associated amend type." % self.type)
         return amend_type
 
-    def get_number(self):
-        cls = type(self)
-        if cls is models.DEFERRED:
-            cls = cls.__base__
+    def get_number_prefix(self, is_open=None):
         bill_type = self.get_type()
         if bill_type == self.BILL:
             raise TypeError('This method can not be used on BILL instances')
         bill_type = bill_type.replace('AMENDMENT', 'AMENDMENT_')
         prefix = getattr(settings, 'BILLS_%s_NUMBER_PREFIX' % bill_type)
-        if self.is_open:
+        if self.is_open if is_open is None else is_open:
             prefix = 'O{}'.format(prefix)
-        year = timezone.now().strftime("%Y")
-        bills = cls.objects.filter(number__regex=r'^%s%s[0-9]+' % (prefix, year))
-        last_number = bills.order_by('-number').values_list('number', flat=True).first()
-        if last_number is None:
-            last_number = 0
-        else:
-            last_number = int(last_number[len(prefix)+4:])
-        number = last_number + 1
+        return prefix
+
+    @staticmethod
+    def format_number(prefix, year, number):
         number_length = settings.BILLS_NUMBER_LENGTH
         zeros = (number_length - len(str(number))) * '0'
         number = zeros + str(number)
         return '{prefix}{year}{number}'.format(prefix=prefix, year=year, number=number)
 
+    def get_number(self):
+        """ next number of its sequence, locked until the current transaction ends """
+        prefix = self.get_number_prefix()
+        year = timezone.now().strftime("%Y")
+        number = BillSequence.objects.reserve(prefix, year)
+        return self.format_number(prefix, year, number)
+
+    def get_provisional_number(self):
+        """ number of open bills, unique by pk so no sequence is locked until they are closed """
+        return '{prefix}-{pk}'.format(prefix=self.get_number_prefix(), pk=self.pk)
+
+    @classmethod
+    def reserve_numbers(cls, bills):
+        """
+        {bill: number} once closed, reserving a block of numbers per sequence instead of one
+        number at a time
+        """
+        year = timezone.now().strftime("%Y")
+        sequences = {}
+        for bill in bills:
+            sequences.setdefault(bill.get_number_prefix(is_open=False), []).append(bill)
+        numbers = {}
+        for prefix, sequence_bills in sorted(sequences.items()):
+            first = BillSequence.objects.reserve(prefix, year, count=len(sequence_bills))
+            for ix, bill in enumerate(sequence_bills):
+                numbers[bill] = cls.format_number(prefix, year, first+ix)
+        return numbers
+
     def get_due_date(self, payment=None):
         now = timezone.now()
         if payment:
@@ -260,7 +317,9 @@ class Bill(models.Model):
     def get_absolute_url(self):
         return reverse('admin:bills_bill_view', args=(self.pk,))
 
-    def close(self, payment=False):
+    @transaction.atomic
+    def close(self, payment=False, number=None):
+        """ number: reserved with reserve_numbers() when closing many bills """
         if not self.is_open:
             raise TypeError("Bill not in Open state.")
         if payment is False:
@@ -274,7 +333,8 @@ class Bill(models.Model):
         self.closed_on = timezone.now()
         self.is_open = False
         self.is_sent = False
-        self.number = self.get_number()
+        self.number = number or self.get_number()
+        self.update_payment_state(commit=False)
         self.html = self.render(payment=payment)
         self.save()
         return transaction
@@ -337,51 +397,166 @@ class Bill(models.Model):
     def save(self, *args, **kwargs):
         if not self.type:
             self.type = self.get_type()
+        if self._state.adding and self.total is None:
+            # New bills have no lines yet
+            self.total = self.base = self.tax = 0
+            self.subtotals = '{}'
+        if not self.number and self.is_open:
+            with transaction.atomic():
+                # Placeholder until the pk of the provisional number is known
+                self.number = random_ascii(16)
+                super(Bill, self).save(*args, **kwargs)
+                self.number = self.get_provisional_number()
+                Bill.objects.filter(pk=self.pk).update(number=self.number)
+            return
         if not self.number:
             self.number = self.get_number()
         super(Bill, self).save(*args, **kwargs)
 
-    @cached
-    def compute_subtotals(self):
-        subtotals = {}
-        lines = self.lines.annotate(totals=F('subtotal') + Sum(Coalesce('sublines__total', 0)))
-        for tax, total in lines.values_list('tax', 'totals'):
+    def aggregate_totals(self):
+        """ (total, base, tax, subtotals) of the lines, as computed by compute_*() """
+        bases = {}
+        lines = self.lines.annotate(sublines_total=Sum(Coalesce('sublines__total', 0)))
+        for tax, subtotal, sublines_total in lines.values_list('tax', 'subtotal', 'sublines_total'):
+            base = subtotal + decimal.Decimal(sublines_total or 0)
             try:
-                subtotals[tax] += total
+                bases[tax] += base
             except KeyError:
-                subtotals[tax] = total
-        result = {}
-        for tax, subtotal in subtotals.items():
-            result[tax] = [subtotal, round(tax/100*subtotal, 2)]
-        return result
+                bases[tax] = base
+        subtotals = {}
+        total = base = taxes = 0
+        for tax, subtotal in bases.items():
+            subtotals[tax] = [subtotal, round(tax/100*subtotal, 2)]
+            total += subtotal * (1+tax/100)
+            base += subtotal
+            taxes += subtotal * (tax/100)
+        return round(total, 2), round(base, 2), round(taxes, 2), subtotals
+
+    def update_totals(self, commit=True):
+        """ stores the totals of the lines """
+        self.total, self.base, self.tax, subtotals = self.aggregate_totals()
+        self.subtotals = json.dumps({
+            str(tax): [str(subtotal), str(taxes)] for tax, (subtotal, taxes) in subtotals.items()
+        })
+        if commit:
+            Bill.objects.filter(pk=self.pk).update(
+                total=self.total, base=self.base, tax=self.tax, subtotals=self.subtotals)
+            # The payment state depends on the total
+            deferred_payment_states.update(self)
+
+    def get_totals(self):
+        """ stored totals, aggregated from the lines on bills not backfilled yet """
+        if self.total is None:
+            self.update_totals(commit=False)
+        return self.total, self.base, self.tax, self.subtotals
+
+    def compute_subtotals(self):
+        subtotals = self.get_totals()[3]
+        return {
+            decimal.Decimal(tax): [decimal.Decimal(subtotal), decimal.Decimal(taxes)]
+            for tax, (subtotal, taxes) in json.loads(subtotals).items()
+        }
 
-    @cached
     def compute_base(self):
-        bases = self.lines.annotate(
-            bases=F('subtotal') + Sum(Coalesce('sublines__total', 0))
-        )
-        return round(bases.aggregate(Sum('bases'))['bases__sum'] or 0, 2)
+        return self.get_totals()[1]
 
-    @cached
     def compute_tax(self):
-        taxes = self.lines.annotate(
-            taxes=(F('subtotal') + Coalesce(Sum('sublines__total'), 0)) * (F('tax')/100)
-        )
-        return round(taxes.aggregate(Sum('taxes'))['taxes__sum'] or 0, 2)
+        return self.get_totals()[2]
 
-    @cached
     def compute_total(self):
-        if 'lines' in getattr(self, '_prefetched_objects_cache', ()):
-            total = 0
-            for line in self.lines.all():
-                line_total = line.compute_total()
-                total += line_total * (1+line.tax/100)
-            return round(total, 2)
-        else:
-            totals = self.lines.annotate(
-                totals=(F('subtotal') + Sum(Coalesce('sublines__total', 0))) * (1+F('tax')/100)
-            )
-            return round(totals.aggregate(Sum('totals'))['totals__sum'] or 0, 2)
+        return self.get_totals()[0]
+
+
+class deferred_updates(object):
+    """
+    bills changed within are updated once, on exit, instead of on every change
+    subclasses provide their own thread_locals and the name of the updating bill method
+    """
+    method = None
+
+    def __enter__(self):
+        cls = type(self)
+        self.old_bills = getattr(cls.thread_locals, 'bills', None)
+        if self.old_bills is None:
+            cls.thread_locals.bills = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        cls = type(self)
+        if self.old_bills is None:
+            bills = cls.thread_locals.bills
+            cls.thread_locals.bills = None
+            if exc_type is None:
+                for bill in bills.values():
+                    getattr(bill, cls.method)()
+
+    @classmethod
+    def update(cls, bill, cached=True):
+        """ cached: bill instance used by the caller, preferred for being updated """
+        bills = getattr(cls.thread_locals, 'bills', None)
+        if bills is None:
+            getattr(bill, cls.method)()
+        elif cached or bill.pk not in bills:
+            bills[bill.pk] = bill
+
+
+class deferred_totals(deferred_updates):
+    """ totals of the bills whose lines or sublines are saved within """
+    thread_locals = threading.local()
+    method = 'update_totals'
+
+
+class deferred_payment_states(deferred_updates):
+    """ payment states of the bills whose transactions or totals change within """
+    thread_locals = threading.local()
+    method = 'update_payment_state'
+
+
+class BillSequenceQuerySet(models.QuerySet):
+    def reserve(self, prefix, year, count=1):
+        """
+        first of count consecutive numbers of the (prefix, year) sequence
+        the sequence row is locked until the current transaction ends, so rolled back
+        transactions don't leave gaps
+        """
+        with transaction.atomic():
+            try:
+                sequence = self.select_for_update().get(prefix=prefix, year=year)
+            except self.model.DoesNotExist:
+                try:
+                    with transaction.atomic():
+                        self.create(prefix=prefix, year=year,
+                            last_number=self.model.get_last_number(prefix, year))
+                except IntegrityError:
+                    # Created concurrently
+                    pass
+                sequence = self.select_for_update().get(prefix=prefix, year=year)
+            first = sequence.last_number + 1
+            sequence.last_number += count
+            sequence.save(update_fields=('last_number',))
+        return first
+
+
+class BillSequence(models.Model):
+    """ last number given to the bills of each number prefix and year """
+    prefix = models.CharField(_("prefix"), max_length=16)
+    year = models.PositiveIntegerField(_("year"))
+    last_number = models.PositiveIntegerField(_("last number"), default=0)
+
+    objects = BillSequenceQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('prefix', 'year')
+
+    def __str__(self):
+        return '%s%s' % (self.prefix, self.year)
+
+    @staticmethod
+    def get_last_number(prefix, year):
+        """ last number of the existing bills, sequences start after them """
+        bills = Bill.objects.filter(number__regex=r'^%s%s[0-9]+$' % (prefix, year))
+        numbers = bills.values_list('number', flat=True)
+        return max([int(number[len(prefix)+4:]) for number in numbers] or [0])
 
 
 class Invoice(Bill):
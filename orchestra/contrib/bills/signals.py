@@ -0,0 +1,49 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Bill, BillLine, BillSubline, deferred_payment_states, deferred_totals
+
+
+def update_bill_totals(line):
+    cached = BillLine.bill.field.is_cached(line)
+    if cached:
+        bill = line.bill
+    else:
+        bill = Bill(pk=line.bill_id)
+    deferred_totals.update(bill, cached=cached)
+
+
+@receiver(post_save, sender=BillLine, dispatch_uid='bills.update_line_totals')
+@receiver(post_delete, sender=BillLine, dispatch_uid='bills.delete_line_totals')
+def update_line_totals(sender, *args, **kwargs):
+    if kwargs.get('raw'):
+        return
+    update_bill_totals(kwargs['instance'])
+
+
+@receiver(post_save, sender=BillSubline, dispatch_uid='bills.update_subline_totals')
+@receiver(post_delete, sender=BillSubline, dispatch_uid='bills.delete_subline_totals')
+def update_subline_totals(sender, *args, **kwargs):
+    if kwargs.get('raw'):
+        return
+    subline = kwargs['instance']
+    try:
+        line = subline.line
+    except BillLine.DoesNotExist:
+        # Deleted in cascade with its line
+        return
+    update_bill_totals(line)
+
+
+@receiver(post_save, sender='payments.Transaction', dispatch_uid='bills.update_transaction_payment_state')
+@receiver(post_delete, sender='payments.Transaction', dispatch_uid='bills.delete_transaction_payment_state')
+def update_transaction_payment_state(sender, *args, **kwargs):
+    if kwargs.get('raw'):
+        return
+    transaction = kwargs['instance']
+    cached = type(transaction).bill.field.is_cached(transaction)
+    if cached:
+        bill = transaction.bill
+    else:
+        bill = Bill(pk=transaction.bill_id)
+    deferred_payment_states.update(bill, cached=cached)
@@ -0,0 +1,178 @@
+import decimal
+from unittest import mock
+
+from django.apps import apps
+from django.db import transaction
+from django.utils import timezone
+
+from orchestra.contrib.payments.models import Transaction, TransactionProcess
+from orchestra.utils.tests import BaseTestCase
+
+from ..filters import PaymentStateListFilter
+from ..models import Bill, BillLine, BillSequence, BillSubline, Fee, Invoice, deferred_totals
+
+
+class BillNumberTests(BaseTestCase):
+    def setUp(self):
+        self.account = self.create_account()
+        self.year = timezone.now().strftime("%Y")
+
+    def test_provisional(self):
+        bill = Invoice.objects.create(account=self.account)
+        self.assertEqual('OI-%i' % bill.pk, bill.number)
+        self.assertEqual(bill.number, Invoice.objects.get(pk=bill.pk).number)
+        self.assertFalse(BillSequence.objects.exists())
+
+    def test_reserve(self):
+        invoices = [Invoice.objects.create(account=self.account) for ix in range(2)]
+        fee = Fee.objects.create(account=self.account)
+        numbers = Invoice.reserve_numbers(invoices + [fee])
+        self.assertEqual({
+            invoices[0]: 'I%s0001' % self.year,
+            invoices[1]: 'I%s0002' % self.year,
+            fee: 'F%s0001' % self.year,
+        }, numbers)
+        self.assertEqual('I%s0003' % self.year, Invoice(account=self.account, is_open=False).get_number())
+
+    def test_seeding(self):
+        Invoice.objects.create(account=self.account, is_open=False, number='I%s0007' % self.year)
+        Invoice.objects.create(account=self.account, is_open=False, number='I%s0011' % (int(self.year)-1))
+        bill = Invoice(account=self.account, is_open=False)
+        self.assertEqual('I%s0008' % self.year, bill.get_number())
+        self.assertEqual('I%s0009' % self.year, bill.get_number())
+
+    def test_rollback(self):
+        bill = Invoice(account=self.account, is_open=False)
+        self.assertEqual('I%s0001' % self.year, bill.get_number())
+        try:
+            with transaction.atomic():
+                number = bill.get_number()
+                raise ValueError("Failed close")
+        except ValueError:
+            pass
+        self.assertEqual('I%s0002' % self.year, number)
+        self.assertEqual(number, bill.get_number())
+
+
+class BillTotalsTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.payments',
+    )
+
+    def setUp(self):
+        self.account = self.create_account()
+        self.bill = Invoice.objects.create(account=self.account)
+
+    def create_line(self, subtotal, tax=21):
+        return BillLine.objects.create(bill=self.bill, description="Line", subtotal=subtotal,
+            tax=tax, start_on=timezone.now().date())
+
+    def assertTotals(self, total, base, tax):
+        bill = Bill.objects.get(pk=self.bill.pk)
+        self.assertEqual((total, base, tax), (bill.total, bill.base, bill.tax))
+        self.assertEqual(bill.aggregate_totals()[:3], (bill.total, bill.base, bill.tax))
+
+    def test_lines(self):
+        self.assertTotals(0, 0, 0)
+        line = self.create_line(100)
+        self.create_line(10, tax=0)
+        self.assertTotals(131, 110, 21)
+        self.assertEqual(decimal.Decimal(131), self.bill.total)
+        subline = BillSubline.objects.create(line=line, description="Discount", total=-50)
+        self.assertTotals(decimal.Decimal('70.50'), 60, decimal.Decimal('10.50'))
+        subline.delete()
+        line.subtotal = 200
+        line.save()
+        self.assertTotals(252, 210, 42)
+        line.delete()
+        self.assertTotals(10, 10, 0)
+
+    def test_deferred(self):
+        with mock.patch.object(Bill, 'update_totals', autospec=True,
+                side_effect=Bill.update_totals) as update_totals:
+            with deferred_totals():
+                with deferred_totals():
+                    for ix in range(3):
+                        self.create_line(100)
+                self.assertFalse(update_totals.called)
+                self.assertTotals(0, 0, 0)
+        self.assertEqual(1, update_totals.call_count)
+        self.assertTotals(363, 300, 63)
+        self.assertEqual(decimal.Decimal(363), self.bill.total)
+
+    def test_not_backfilled(self):
+        self.create_line(100)
+        Bill.objects.filter(pk=self.bill.pk).update(total=None, base=None, tax=None, subtotals=None)
+        bill = Bill.objects.get(pk=self.bill.pk)
+        self.assertEqual(decimal.Decimal(121), bill.compute_total())
+        self.assertEqual({decimal.Decimal(21): [decimal.Decimal(100), decimal.Decimal(21)]},
+            bill.compute_subtotals())
+        apps.get_app_config('bills').backfill_totals()
+        self.assertTotals(121, 100, 21)
+
+
+class PaymentStateTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.payments',
+    )
+
+    def setUp(self):
+        self.account = self.create_account()
+        self.bill = Invoice.objects.create(account=self.account, is_open=False,
+            number='I%s0001' % timezone.now().strftime("%Y"))
+        self.line = BillLine.objects.create(bill=self.bill, description="Line", subtotal=100,
+            tax=0, start_on=timezone.now().date())
+
+    def assertState(self, state, bill=None):
+        bill = bill or self.bill
+        self.assertEqual(state, Bill.objects.get(pk=bill.pk).payment_state)
+
+    def test_transitions(self):
+        self.assertState(Bill.BAD_DEBT)
+        transaction = Transaction.objects.create(bill=self.bill, amount=100)
+        self.assertState(Bill.PROCESSED)
+        transaction.mark_as_executed()
+        self.assertState(Bill.EXECUTED)
+        transaction.mark_as_secured()
+        self.assertState(Bill.PAID)
+        # Line total changes
+        self.line.subtotal = 150
+        self.line.save()
+        self.assertState(Bill.INCOMPLETE)
+        transaction.mark_as_rejected()
+        self.assertState(Bill.BAD_DEBT)
+        # Plain saves, like the admin change form
+        transaction.state = Transaction.SECURED
+        transaction.save()
+        self.assertState(Bill.INCOMPLETE)
+        Transaction.objects.get(pk=transaction.pk).delete()
+        self.assertState(Bill.BAD_DEBT)
+
+    def test_process(self):
+        process = TransactionProcess.objects.create()
+        for amount in (60, 40):
+            Transaction.objects.create(bill=self.bill, amount=amount, process=process)
+        self.assertState(Bill.PROCESSED)
+        with mock.patch.object(Bill, 'update_payment_state', autospec=True,
+                side_effect=Bill.update_payment_state) as update_payment_state:
+            process.commit()
+        self.assertEqual(1, update_payment_state.call_count)
+        self.assertState(Bill.PAID)
+
+    def test_filter(self):
+        paid = Invoice.objects.create(account=self.account, is_open=False,
+            number='I%s0002' % timezone.now().strftime("%Y"))
+        Transaction.objects.create(bill=paid, amount=0)
+        pending = Invoice.objects.create(account=self.account, is_open=False,
+            number='I%s0003' % timezone.now().strftime("%Y"))
+        BillLine.objects.create(bill=pending, description="Line", subtotal=10, tax=0,
+            start_on=timezone.now().date())
+        Transaction.objects.create(bill=pending, amount=10)
+        open_bill = Invoice.objects.create(account=self.account)
+        self.assertState(Bill.PAID, bill=paid)
+        self.assertState(Bill.PROCESSED, bill=pending)
+        for value, bills in (('OPEN', [open_bill]), ('PAID', [paid]), ('PENDING', [pending]),
+                ('BAD_DEBT', [self.bill])):
+            payment_state = PaymentStateListFilter(None, {'payment_state': value}, Bill, None)
+            queryset = payment_state.queryset(None, Bill.objects.filter(account=self.account))
+            self.assertEqual(set(bill.pk for bill in bills), set(queryset.values_list('pk', flat=True)))
@@ -26,6 +26,8 @@ class Bind9MasterDomainController(ServiceController):
         ('domains.Domain', 'origin'),
     )
     ignore_fields = ('serial',)
+    # Zone changes of concurrent requests are applied with a single bind9 reload
+    coalesce_window = 5
     doc_settings = (settings,
         ('DOMAINS_MASTERS_PATH',)
     )
@@ -208,8 +208,9 @@ class MailmanTraffic(ServiceMonitor):
     def prepare(self):
         postlog = settings.LISTS_MAILMAN_POST_LOG_PATH
         context = {
-            'postlogs': str((postlog, postlog+'.1')),
+            'postlogs': str((postlog+'.1', postlog)),
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
+            'log_offsets': self.get_log_offsets_script(),
         }
         self.append(textwrap.dedent("""\
             import re
@@ -218,6 +219,8 @@ class MailmanTraffic(ServiceMonitor):
             from datetime import datetime
             from dateutil import tz
             
+            {log_offsets}
+            
             def to_local_timezone(date, tzlocal=tz.tzlocal()):
                 date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
                 date = date.replace(tzinfo=tz.tzutc())
@@ -247,37 +250,39 @@ class MailmanTraffic(ServiceMonitor):
             
             def prepare(object_id, list_name, ini_date):
                 global lists
+                log_offsets.prepare(object_id, ini_date)
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 lists[list_name] = [ini_date, object_id, 0]
             
             def monitor(lists, end_date, months, postlogs):
-                for postlog in postlogs:
+                object_ids = [list[1] for list in lists.values()]
+                # Only the lines appended since the last execution
+                for inode, position, line in log_offsets.readlines(postlogs, object_ids):
+                    line = line.split()
+                    if len(line) < 11:
+                        continue
+                    month, day, time, year, __, __, __, list_name, __, addr, size = line[:11]
                     try:
-                        with open(postlog, 'r') as postlog:
-                            for line in postlog.readlines():
-                                line = line.split()
-                                if len(line) < 11:
-                                    continue
-                                month, day, time, year, __, __, __, list_name, __, addr, size = line[:11]
-                                try:
-                                    list = lists[list_name]
-                                except KeyError:
-                                    continue
-                                else:
-                                    # discard mailman messages because of inconsistent POST logging
-                                    if mailman_addr.match(addr):
-                                        continue
-                                    date = year + months[month] + day + time.replace(':', '')
-                                    if list[0] < int(date) < end_date:
-                                        size = size[5:-1]
-                                        try:
-                                            list[2] += int(size)
-                                        except ValueError:
-                                            # anonymized post
-                                            pass
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
+                        list = lists[list_name]
+                    except KeyError:
+                        continue
+                    else:
+                        # discard mailman messages because of inconsistent POST logging
+                        if mailman_addr.match(addr):
+                            continue
+                        new = log_offsets.is_new(list[1], inode, position)
+                        if new is None:
+                            date = year + months[month] + day + time.replace(':', '')
+                            new = list[0] < int(date) < end_date
+                        if new:
+                            size = size[5:-1]
+                            try:
+                                list[2] += int(size)
+                            except ValueError:
+                                # anonymized post
+                                pass
+                log_offsets.save()
                 
                 for list_name, opts in lists.items():
                     __, object_id, size = opts
@@ -478,7 +478,8 @@ class PostfixMailscannerTraffic(ServiceMonitor):
         mail_log = settings.MAILBOXES_MAIL_LOG_PATH
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'mail_logs': str((mail_log, mail_log+'.1')),
+            'mail_logs': str((mail_log+'.1', mail_log)),
+            'log_offsets': self.get_log_offsets_script(),
         }
         self.append(textwrap.dedent("""\
             import re
@@ -486,6 +487,8 @@ class PostfixMailscannerTraffic(ServiceMonitor):
             from datetime import datetime
             from dateutil import tz
             
+            {log_offsets}
+            
             def to_local_timezone(date, tzlocal=tz.tzlocal()):
                 # Converts orchestra's UTC dates to local timezone
                 date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
@@ -521,6 +524,7 @@ class PostfixMailscannerTraffic(ServiceMonitor):
                 global users
                 global delivers
                 global reverse
+                log_offsets.prepare(object_id, ini_date)
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[mailbox] = (ini_date, object_id)
@@ -530,64 +534,100 @@ class PostfixMailscannerTraffic(ServiceMonitor):
             def monitor(users, delivers, reverse, maillogs):
                 targets = {{}}
                 counter = {{}}
+                # Emails of previous executions still being delivered, with the date they were seen,
+                # kept until they are removed from the queue
+                for username, user in users.items():
+                    carried = log_offsets.get_data(user[1])
+                    for key in ('delivers', 'targets'):
+                        carried[key] = dict(
+                            (id, value) for id, value in carried.get(key, {{}}).items()
+                                if value[-1] >= log_offsets.expire_date
+                        )
+                    for id in carried['delivers']:
+                        delivers[id] = username
+                    for req_id, target in carried['targets'].items():
+                        targets[req_id] = (username, target[0])
+                object_ids = [user[1] for user in users.values()]
                 user_regex = re.compile(r'\(Authenticated sender: ([^ ]+)\)')
-                for maillog in maillogs:
-                    try:
-                        with open(maillog, 'r') as maillog:
-                            for line in maillog.readlines():
-                                # Only search for Authenticated sendings
-                                if '(Authenticated sender: ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        month, day, time, __, proc, id = line.split()[:6]
-                                        if inside_period(month, day, time, sender[0]):
-                                            # Add new email
-                                            delivers[id[:-1]] = username
-                                # Look for a MailScanner requeue ID
-                                elif ' Requeue: ' in line:
-                                    id, __, req_id = line.split()[6:9]
-                                    id = id.split('.')[0]
-                                    try:
-                                        username = delivers[id]
-                                    except KeyError:
-                                        pass
-                                    else:
-                                        targets[req_id] = (username, 0)
-                                        reverse[username].add(req_id)
-                                # Look for the mail size and count the number of recipients of each email
+                # Only the lines appended since the last execution
+                for inode, position, line in log_offsets.readlines(maillogs, object_ids):
+                    # Only search for Authenticated sendings
+                    if '(Authenticated sender: ' in line:
+                        username = user_regex.search(line).groups()[0]
+                        try:
+                            sender = users[username]
+                        except KeyError:
+                            continue
+                        else:
+                            month, day, time, __, proc, id = line.split()[:6]
+                            new = log_offsets.is_new(sender[1], inode, position)
+                            if new is None:
+                                new = inside_period(month, day, time, sender[0])
+                            if new:
+                                # Add new email
+                                delivers[id[:-1]] = username
+                                carried = log_offsets.get_data(sender[1])
+                                carried['delivers'][id[:-1]] = [log_offsets.current_date]
+                    # Look for a MailScanner requeue ID
+                    elif ' Requeue: ' in line:
+                        id, __, req_id = line.split()[6:9]
+                        id = id.split('.')[0]
+                        try:
+                            username = delivers[id]
+                        except KeyError:
+                            pass
+                        else:
+                            targets[req_id] = (username, 0)
+                            carried = log_offsets.get_data(users[username][1])
+                            carried['delivers'].pop(id, None)
+                            carried['targets'][req_id] = [0, log_offsets.current_date]
+                    # Delivered or expired, no more recipients
+                    elif line.rstrip().endswith(': removed'):
+                        req_id = line.split()[5][:-1]
+                        try:
+                            target = targets[req_id]
+                        except KeyError:
+                            pass
+                        else:
+                            log_offsets.get_data(users[target[0]][1])['targets'].pop(req_id, None)
+                    # Look for the mail size and count the number of recipients of each email
+                    else:
+                        try:
+                            month, day, time, __, proc, req_id, __, msize = line.split()[:8]
+                        except ValueError:
+                            # not interested in this line
+                            continue
+                        if proc.startswith('postfix/'):
+                            req_id = req_id[:-1]
+                            if msize.startswith('size='):
+                                try:
+                                    target = targets[req_id]
+                                except KeyError:
+                                    pass
+                                else:
+                                    targets[req_id] = (target[0], int(msize[5:-1]))
+                                    carried = log_offsets.get_data(users[target[0]][1])
+                                    if req_id in carried['targets']:
+                                        carried['targets'][req_id][0] = targets[req_id][1]
+                            elif proc.startswith('postfix/smtp'):
+                                try:
+                                    target = targets[req_id]
+                                except KeyError:
+                                    pass
                                 else:
-                                    try:
-                                        month, day, time, __, proc, req_id, __, msize = line.split()[:8]
-                                    except ValueError:
-                                        # not interested in this line
-                                        continue
-                                    if proc.startswith('postfix/'):
-                                        req_id = req_id[:-1]
-                                        if msize.startswith('size='):
-                                            try:
-                                                target = targets[req_id]
-                                            except KeyError:
-                                                pass
-                                            else:
-                                                targets[req_id] = (target[0], int(msize[5:-1]))
-                                        elif proc.startswith('postfix/smtp'):
-                                            try:
-                                                target = targets[req_id]
-                                            except KeyError:
-                                                pass
-                                            else:
-                                                if inside_period(month, day, time, users[target[0]][0]):
-                                                    try:
-                                                        counter[req_id] += 1
-                                                    except KeyError:
-                                                        counter[req_id] = 1
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
-                    
+                                    sender = users[target[0]]
+                                    new = log_offsets.is_new(sender[1], inode, position)
+                                    if new is None:
+                                        new = inside_period(month, day, time, sender[0])
+                                    if new:
+                                        try:
+                                            counter[req_id] += 1
+                                        except KeyError:
+                                            counter[req_id] = 1
+                log_offsets.save()
+                
+                for req_id, count in counter.items():
+                    reverse[targets[req_id][0]].add(req_id)
                 for username, opts in users.iteritems():
                     size = 0
                     for req_id in reverse[username]:
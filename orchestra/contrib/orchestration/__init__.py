@@ -24,24 +24,49 @@ class Operation():
 
     def __hash__(self):
         """ set() """
-        return hash((self.backend, self.instance, self.action))
+        return hash(self.key)
 
     def __eq__(self, operation):
-        """ set() """
-        return hash(self) == hash(operation)
+        """ set() and dict lookups by key, e.g. Operation.get_key(...) in operations """
+        if isinstance(operation, Operation):
+            return self.key == operation.key
+        return self.key == operation
 
     def __init__(self, backend, instance, action, routes=None):
         self.backend = backend
-        # instance should maintain any dynamic attribute until backend execution
-        # deep copy is prefered over copy otherwise objects will share same atributes (queryset cache)
-        self.instance = copy.deepcopy(instance)
         self.action = action
         self.routes = routes
+        self.key = self.get_key(backend, instance, action)
+        if action == self.DELETE:
+            # Deleted objects lose their pk and related objects, backends need the original state
+            instance = self.snapshot(instance)
+        # Otherwise the instance is shared, maintaining any dynamic attribute until execution
+        self.instance = instance
+
+    @staticmethod
+    def get_key(backend, instance, action):
+        """ operation identity, cheap enough for testing membership without instantiation """
+        pk = instance.pk
+        if pk is None:
+            pk = id(instance)
+        return (backend, instance._meta.label_lower, pk, action)
+
+    @staticmethod
+    def snapshot(instance):
+        """
+        shallow copy with its own state and related caches (queryset cache)
+        deep copy is avoided because of its CPU and memory cost
+        """
+        clone = copy.copy(instance)
+        prefetched = getattr(instance, '_prefetched_objects_cache', None)
+        if prefetched is not None:
+            clone._prefetched_objects_cache = dict(prefetched)
+        return clone
 
     @classmethod
-    def execute(cls, operations, serialize=False, run_async=None):
+    def execute(cls, operations, serialize=False, run_async=None, force=False):
         from . import manager
-        scripts, backend_serialize = manager.generate(operations)
+        scripts, backend_serialize = manager.generate(operations, force=force)
         return manager.execute(scripts, serialize=(serialize or backend_serialize), run_async=run_async)
 
     @classmethod
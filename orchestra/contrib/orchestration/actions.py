@@ -27,7 +27,7 @@ def retry_backend(modeladmin, request, queryset):
         if not operations:
             messages.warning(request, _("No backend operation has been executed."))
         else:
-            logs = Operation.execute(operations)
+            logs = Operation.execute(operations, force=True)
             message_user(request, logs)
         for backendlog in queryset:
             modeladmin.log_change(request, backendlog, 'Retried')
@@ -106,7 +106,7 @@ def orchestrate(modeladmin, request, queryset):
         return
     
     if request.POST.get('post') == 'generic_confirmation':
-        logs = Operation.execute(operations)
+        logs = Operation.execute(operations, force=True)
         message_user(request, logs)
         for obj in queryset:
             modeladmin.log_change(request, obj, 'Orchestrated')
@@ -8,7 +8,7 @@ from django.utils.translation import gettext_lazy as _
 
 from orchestra import plugins
 
-from . import methods
+from . import methods, settings
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +52,8 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     # By default backend will not run if actions do not generate insctructions,
     # If your backend uses prepare() or commit() only then you should set force_empty_action_execution = True
     force_empty_action_execution = False
+    # Seconds queued operations wait for further changes, prepare() and commit() run once per window
+    coalesce_window = 0
 
     def __str__(self):
         return type(self).__name__
@@ -60,6 +62,8 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         self.head = []
         self.content = []
         self.tail = []
+        # Script fragments to be stored after a successful execution
+        self.fragments = []
 
     def __getattribute__(self, attr):
         """ Select head, content or tail section depending on the method name """
@@ -145,6 +149,10 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     def get_backend(cls, name):
         return cls.get(name)
 
+    @classmethod
+    def get_coalesce_window(cls):
+        return settings.ORCHESTRATION_COALESCE_WINDOWS.get(cls.get_name(), cls.coalesce_window)
+
     @classmethod
     def model_class(cls):
         return apps.get_model(cls.model)
@@ -169,12 +177,16 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         time = now.strftime("%h %d, %Y %I:%M:%S %Z")
         return "Generated by Orchestra at %s" % time
 
-    def create_log(self, server, **kwargs):
+    def get_log_state(self):
         from .models import BackendLog
-        state = BackendLog.RECEIVED
         run = bool(self.scripts) or (self.force_empty_action_execution or bool(self.content))
         if not run:
-            state = BackendLog.NOTHING
+            return BackendLog.NOTHING
+        return BackendLog.RECEIVED
+
+    def create_log(self, server, **kwargs):
+        from .models import BackendLog
+        state = self.get_log_state()
         using = kwargs.pop('using', None)
         manager = BackendLog.objects
         if using:
@@ -195,6 +207,25 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
                     break
         return log
 
+    async def execute_async(self, server, run_async=False, log=None):
+        """ execute() for event loops, methods providing a coroutine do not block the loop """
+        from .executors import run_sync
+        from .models import BackendLog
+        if log is None:
+            log = await run_sync(self.create_log, server)
+        run = log.state != BackendLog.NOTHING
+        if run:
+            scripts = self.scripts
+            for method, commands in scripts:
+                coroutine = methods.get_coroutine(method)
+                if coroutine is not None:
+                    await coroutine(self, log, server, commands, run_async)
+                else:
+                    await run_sync(method, log, server, commands, run_async)
+                if log.state != BackendLog.SUCCESS:
+                    break
+        return log
+
     def append(self, *cmd):
         # aggregate commands acording to its execution method
         if isinstance(cmd[0], str):
@@ -0,0 +1,230 @@
+"""
+Orchestration benchmark: synthesises accounts with their services, routes them to fake
+servers and measures the collect, generate and execute phases of the save, delete and
+bulk orchestrate paths.
+
+Scripts are recorded by methods.Record instead of being executed on the servers, and
+the benchmark objects are created on a test database, never on the current one.
+"""
+import gc
+import threading
+import time
+import tracemalloc
+import types
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+
+from orchestra.utils.python import OrderedSet, random_ascii
+
+from . import manager, methods
+from .backends import ServiceController
+from .managers import orchestrate
+from .models import Route, Server
+from .signals import pre_prepare
+
+
+@contextmanager
+def test_database(verbosity=0, interactive=False, keepdb=False):
+    """ switches all the database connections of the process to test databases """
+    old_config = setup_databases(verbosity, interactive, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity, keepdb=keepdb)
+
+
+class collect_operations(orchestrate):
+    """ orchestrate() that keeps the collected operations instead of executing them """
+    def __exit__(self, exc_type, exc_value, traceback):
+        cls = type(self)
+        self.operations = cls.thread_locals.pending_operations
+        cls.thread_locals.pending_operations = self.old_pending_operations
+        cls.thread_locals.route_cache = self.old_route_cache
+
+
+class Phase(object):
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.seconds = 0
+        self.queries = 0
+        self.peak_memory = 0
+        self.operations = 0
+
+    def as_dict(self):
+        return {
+            'path': self.path,
+            'phase': self.name,
+            'seconds': round(self.seconds, 4),
+            'queries': self.queries,
+            'peak_memory': self.peak_memory,
+            'operations': self.operations,
+            'ops_per_second': round(self.operations/self.seconds, 2) if self.seconds else None,
+        }
+
+
+class Benchmark(object):
+    """
+    accounts: number of synthesised accounts, each one with a domain, a mailbox, a webapp,
+        a website and its main system user
+    servers: number of fake servers, every backend is routed to all of them with a
+        match expression distributing the objects between servers
+    """
+    def __init__(self, accounts=100, servers=4, prefix=None):
+        self.num_accounts = accounts
+        self.num_servers = servers
+        self.prefix = prefix or 'bench%s' % random_ascii(5)
+        self.phases = []
+
+    @contextmanager
+    def measure(self, path, name):
+        phase = Phase(path, name)
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                yield phase
+        finally:
+            phase.seconds = time.perf_counter()-start
+            phase.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # Executor workers use their own connections
+            phase.queries = len(queries)
+            self.phases.append(phase)
+
+    @contextmanager
+    def fake_transport(self):
+        """
+        records scripts of the backends generated by the benchmark instead of executing
+        them, backends of other threads keep their methods
+        """
+        thread = threading.current_thread()
+
+        def record(sender, backend, **kwargs):
+            if threading.current_thread() is thread:
+                backend.script_method = types.MethodType(methods.Record, backend)
+                backend.function_method = types.MethodType(methods.Record, backend)
+
+        pre_prepare.connect(record)
+        try:
+            yield
+        finally:
+            pre_prepare.disconnect(record)
+
+    def create_servers(self):
+        self.servers = []
+        for ix in range(self.num_servers):
+            name = '%s-%i.orchestra.lan' % (self.prefix, ix)
+            self.servers.append(Server.objects.create(name=name, address='127.0.0.%i' % (ix+1)))
+        for backend in ServiceController.get_backends():
+            for ix, server in enumerate(self.servers):
+                match = 'True'
+                if self.num_servers > 1:
+                    match = 'instance.pk %% %i == %i' % (self.num_servers, ix)
+                Route.objects.create(backend=backend.get_name(), host=server, match=match)
+
+    def create_accounts(self):
+        Account = apps.get_model('accounts.Account')
+        Domain = apps.get_model('domains.Domain')
+        Mailbox = apps.get_model('mailboxes.Mailbox')
+        WebApp = apps.get_model('webapps.WebApp')
+        Website = apps.get_model('websites.Website')
+        Content = apps.get_model('websites.Content')
+        server = self.servers[0]
+        for ix in range(self.num_accounts):
+            username = '%s%i' % (self.prefix, ix)
+            account = Account.objects.create_user(username, email='%s@orchestra.lan' % username,
+                password=username)
+            domain = Domain.objects.create(name='%s.orchestra.lan' % username, account=account)
+            Mailbox.objects.create(name=username, account=account, password=username)
+            webapp = WebApp.objects.create(name='web', type='static', account=account,
+                target_server=server)
+            website = Website.objects.create(name='web', account=account, target_server=server)
+            website.domains.add(domain)
+            Content.objects.create(website=website, webapp=webapp, path='/')
+
+    def get_accounts(self):
+        Account = apps.get_model('accounts.Account')
+        return Account.objects.filter(username__startswith=self.prefix)
+
+    def execute(self, path, operations):
+        with self.measure(path, 'generate') as phase:
+            scripts, serialize = manager.generate(operations)
+            phase.operations = len(operations)
+        with self.measure(path, 'execute') as phase:
+            logs = manager.execute(scripts, serialize=serialize, run_async=False)
+            phase.operations = len(operations)
+        return logs
+
+    def run_save(self):
+        with self.measure('save', 'collect') as phase:
+            with collect_operations() as collector:
+                self.create_accounts()
+            phase.operations = len(collector.operations)
+        self.execute('save', collector.operations)
+
+    def run_orchestrate(self):
+        """ bulk collection as performed by the orchestrate management command """
+        accounts = self.get_accounts()
+        querysets = [
+            accounts,
+            apps.get_model('systemusers.SystemUser').objects.filter(account__in=accounts),
+            apps.get_model('domains.Domain').objects.filter(account__in=accounts),
+            apps.get_model('mailboxes.Mailbox').objects.filter(account__in=accounts),
+            apps.get_model('webapps.WebApp').objects.filter(account__in=accounts),
+            apps.get_model('websites.Website').objects.filter(account__in=accounts),
+        ]
+        with self.measure('orchestrate', 'collect') as phase:
+            operations = OrderedSet()
+            route_cache = {}
+            for queryset in querysets:
+                for instance in queryset.order_by('id'):
+                    manager.collect(instance, 'save', operations=operations, route_cache=route_cache)
+            phase.operations = len(operations)
+        self.execute('orchestrate', operations)
+
+    def run_delete(self):
+        with self.measure('delete', 'collect') as phase:
+            with collect_operations() as collector:
+                for account in self.get_accounts():
+                    account.delete()
+            phase.operations = len(collector.operations)
+        self.execute('delete', collector.operations)
+
+    def cleanup(self):
+        self.get_accounts().delete()
+        Server.objects.filter(name__startswith=self.prefix).delete()
+
+    def run(self):
+        self.phases = []
+        del methods.recorded_scripts[:]
+        with self.fake_transport():
+            self.create_servers()
+            try:
+                self.run_save()
+                self.run_orchestrate()
+                self.run_delete()
+            finally:
+                self.cleanup()
+        return self.phases
+
+    def get_summary(self):
+        summary = {}
+        for phase in self.phases:
+            totals = summary.setdefault(phase.path, {
+                'path': phase.path,
+                'seconds': 0,
+                'queries': 0,
+                'peak_memory': 0,
+                'operations': phase.operations,
+            })
+            totals['seconds'] = round(totals['seconds']+phase.seconds, 4)
+            totals['queries'] += phase.queries
+            totals['peak_memory'] = max(totals['peak_memory'], phase.peak_memory)
+            seconds = totals['seconds']
+            totals['ops_per_second'] = round(totals['operations']/seconds, 2) if seconds else None
+        return list(summary.values())
@@ -0,0 +1,217 @@
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from orchestra.settings import ORCHESTRA_SSH_CONTROL_PATH, ORCHESTRA_SSH_DEFAULT_USER
+from orchestra.utils.sys import run, sshrun
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class Connection(object):
+    """ Persistent session to a server, it can carry several channels at once """
+    def __init__(self, addr):
+        self.addr = addr
+        self.channels = 0
+        self.created_at = self.last_used = self.last_checked = time.monotonic()
+
+    def __str__(self):
+        return '%s(%s, channels=%i)' % (type(self).__name__, self.addr, self.channels)
+
+    def connect(self):
+        raise NotImplementedError
+
+    def is_active(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class ParamikoConnection(Connection):
+    def connect(self):
+        import paramiko
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        key = settings.ORCHESTRATION_SSH_KEY_PATH
+        self.ssh.connect(self.addr, username=ORCHESTRA_SSH_DEFAULT_USER, key_filename=key)
+
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, socket.error):
+            return False
+        return True
+
+    def open_session(self):
+        return self.ssh.get_transport().open_session()
+
+    def close(self):
+        self.ssh.close()
+
+
+class OpenSSHConnection(Connection):
+    """
+    ControlMaster session, shared with other processes through ORCHESTRA_SSH_CONTROL_PATH
+    """
+    def get_control_command(self, command):
+        return 'ssh -o ControlPath={path} -O {command} {user}@{addr}'.format(
+            path=ORCHESTRA_SSH_CONTROL_PATH, command=command, user=ORCHESTRA_SSH_DEFAULT_USER,
+            addr=self.addr)
+
+    def connect(self):
+        if not self.is_active():
+            # Starts the master with ControlPersist
+            sshrun(self.addr, 'true', persist=True, silent=True)
+
+    def is_active(self):
+        return run(self.get_control_command('check'), silent=True).exit_code == 0
+
+    def run(self, script, executable='bash', run_async=False):
+        return sshrun(self.addr, script, executable=executable, persist=True,
+            run_async=run_async, silent=True)
+
+    def close(self):
+        # stop instead of exit, running sessions of other processes will finish normally
+        run(self.get_control_command('stop'), silent=True)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent connections keyed by server address
+
+    max_channels: concurrent channels carried by a single connection
+    max_connections: connections opened to the same server
+    idle_timeout: seconds before closing an unused connection
+    check_interval: idle seconds before checking the connection health on checkout
+    """
+    def __init__(self, connection_class, max_channels=10, max_connections=1, idle_timeout=300,
+                 check_interval=60):
+        self.connection_class = connection_class
+        self.max_channels = max_channels
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.connections = {}
+        self.condition = threading.Condition()
+
+    def evict_idle(self):
+        """ closes connections without channels that have not been used for a while """
+        now = time.monotonic()
+        evicted = []
+        with self.condition:
+            for addr, connections in list(self.connections.items()):
+                for connection in list(connections):
+                    if not connection.channels and now-connection.last_used > self.idle_timeout:
+                        connections.remove(connection)
+                        evicted.append(connection)
+                if not connections:
+                    self.connections.pop(addr)
+        for connection in evicted:
+            logger.debug('Evicting idle %s' % connection)
+            self.close(connection)
+        return evicted
+
+    def close(self, connection):
+        try:
+            connection.close()
+        except Exception as exc:
+            logger.warning('Error closing %s: %s' % (connection, exc))
+
+    def discard(self, connection):
+        with self.condition:
+            connections = self.connections.get(connection.addr, [])
+            if connection in connections:
+                connections.remove(connection)
+            self.condition.notify_all()
+        self.close(connection)
+
+    def acquire(self, addr):
+        self.evict_idle()
+        while True:
+            with self.condition:
+                connections = self.connections.setdefault(addr, [])
+                connection = None
+                for candidate in connections:
+                    if candidate.channels < self.max_channels:
+                        connection = candidate
+                        break
+                if connection is None:
+                    if len(connections) >= self.max_connections:
+                        self.condition.wait()
+                        continue
+                    # Connect outside the lock, reserving the slot meanwhile
+                    connection = self.connection_class(addr)
+                    connection.channels += 1
+                    connections.append(connection)
+                    new = True
+                else:
+                    connection.channels += 1
+                    new = False
+            if new:
+                try:
+                    connection.connect()
+                except:
+                    self.discard(connection)
+                    raise
+                return connection
+            now = time.monotonic()
+            if now-connection.last_used > self.check_interval and now-connection.last_checked > self.check_interval:
+                connection.last_checked = now
+                if not connection.is_active():
+                    logger.debug('Discarding stale %s' % connection)
+                    self.discard(connection)
+                    continue
+            return connection
+
+    def release(self, connection, error=False):
+        with self.condition:
+            connection.channels -= 1
+            connection.last_used = time.monotonic()
+            self.condition.notify_all()
+        # Broken connections can not be reused
+        if error and not connection.is_active():
+            self.discard(connection)
+
+    @contextmanager
+    def checkout(self, addr):
+        connection = self.acquire(addr)
+        try:
+            yield connection
+        except:
+            self.release(connection, error=True)
+            raise
+        else:
+            self.release(connection)
+
+    def close_all(self):
+        with self.condition:
+            connections = [conn for conns in self.connections.values() for conn in conns]
+            self.connections = {}
+        for connection in connections:
+            self.close(connection)
+
+
+paramiko_pool = ConnectionPool(ParamikoConnection,
+    max_channels=settings.ORCHESTRATION_SSH_POOL_MAX_CHANNELS,
+    max_connections=settings.ORCHESTRATION_SSH_POOL_MAX_CONNECTIONS,
+    idle_timeout=settings.ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT,
+    check_interval=settings.ORCHESTRATION_SSH_POOL_CHECK_INTERVAL,
+)
+
+
+# A single ControlMaster can exist per ControlPath
+openssh_pool = ConnectionPool(OpenSSHConnection,
+    max_channels=settings.ORCHESTRATION_SSH_POOL_MAX_CHANNELS,
+    max_connections=1,
+    idle_timeout=settings.ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT,
+    check_interval=settings.ORCHESTRATION_SSH_POOL_CHECK_INTERVAL,
+)
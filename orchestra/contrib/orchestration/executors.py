@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import partial
+
+from django import db
+
+from orchestra.utils.python import AttrDict, import_class
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionTask(object):
+    """ A backend execution waiting on the executor queue """
+    def __init__(self, func, key, args, kwargs):
+        self.func = func
+        self.key = key
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished = threading.Event()
+
+    def __str__(self):
+        return '%s@%s' % (getattr(self.func, '__name__', self.func), self.key)
+
+    @property
+    def wait_time(self):
+        if self.started_at is None:
+            return time.monotonic()-self.queued_at
+        return self.started_at-self.queued_at
+
+    def run(self):
+        self.started_at = time.monotonic()
+        try:
+            self.func(*self.args, **self.kwargs)
+        finally:
+            self.finished.set()
+
+    def join(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class BackendExecutor(object):
+    """
+    Bounded pool of worker threads used for executing backend scripts
+
+    max_workers: global number of concurrent executions
+    max_per_host: number of concurrent executions per server
+    max_queue: number of queued executions before submit() blocks the caller (backpressure)
+
+    Worker threads are spawned on demand and reused afterwards, tasks of a host that has
+    reached its concurrency limit do not prevent other hosts from being served.
+    Workers are not daemonic, pending executions are completed before the process exits.
+    """
+    poll_interval = 1
+    is_async = False
+
+    def __init__(self, max_workers, max_per_host=0, max_queue=0):
+        self.max_workers = max(1, max_workers)
+        self.max_per_host = max_per_host
+        self.max_queue = max_queue
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        self.running = {}
+        self.workers = []
+        self.idle = 0
+        self.queued = 0
+        self.local = threading.local()
+        self.stats = AttrDict(submitted=0, executed=0, max_queued=0, wait_time=0.0, max_wait_time=0.0)
+
+    def __str__(self):
+        return '%s(workers=%i, queued=%i, running=%i)' % (
+            type(self).__name__, len(self.workers), self.queued, sum(self.running.values()))
+
+    @property
+    def is_worker(self):
+        """ whether the current thread belongs to this executor """
+        return getattr(self.local, 'is_worker', False)
+
+    def submit(self, func, key, *args, **kwargs):
+        """ queues func for execution, blocking while the queue is full """
+        task = ExecutionTask(func, key, args, kwargs)
+        if self.is_worker:
+            # Nested executions would deadlock waiting for a free worker
+            task.run()
+            return task
+        with self.condition:
+            while self.max_queue and self.queued >= self.max_queue:
+                logger.debug('%s queue is full, waiting for a free slot.', self)
+                self.condition.wait()
+            self.pending.setdefault(key, deque()).append(task)
+            self.queued += 1
+            self.stats.submitted += 1
+            self.stats.max_queued = max(self.stats.max_queued, self.queued)
+            # Idle workers that have not woken up yet are already taken by queued tasks
+            if self.queued > self.idle and len(self.workers) < self.max_workers:
+                self.spawn_worker()
+            self.condition.notify_all()
+        return task
+
+    def spawn_worker(self):
+        worker = threading.Thread(target=self.work, name='orchestration-%i' % len(self.workers))
+        self.workers.append(worker)
+        worker.start()
+
+    def get_next_task(self):
+        for key, tasks in self.pending.items():
+            if not self.max_per_host or self.running.get(key, 0) < self.max_per_host:
+                task = tasks.popleft()
+                if not tasks:
+                    self.pending.pop(key)
+                return task
+        return None
+
+    def work(self):
+        self.local.is_worker = True
+        main_thread = threading.main_thread()
+        while True:
+            with self.condition:
+                task = self.get_next_task()
+                while task is None:
+                    if not main_thread.is_alive():
+                        # Interpreter shutdown, no more tasks are coming
+                        self.workers.remove(threading.current_thread())
+                        return
+                    self.idle += 1
+                    self.condition.wait(self.poll_interval)
+                    self.idle -= 1
+                    task = self.get_next_task()
+                self.queued -= 1
+                self.running[task.key] = self.running.get(task.key, 0) + 1
+                wait_time = task.wait_time
+                self.stats.wait_time += wait_time
+                self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+                # Wake up producers waiting for queue space
+                self.condition.notify_all()
+            logger.debug('%s started after waiting %.3f seconds on queue.', task, wait_time)
+            try:
+                task.run()
+            except Exception:
+                logger.exception('Exception while executing %s.', task)
+            finally:
+                with self.condition:
+                    self.running[task.key] -= 1
+                    if not self.running[task.key]:
+                        self.running.pop(task.key)
+                    self.stats.executed += 1
+                    self.condition.notify_all()
+
+    def get_metrics(self):
+        """ queue depth and wait-time metrics """
+        with self.condition:
+            executed = self.stats.executed
+            return {
+                'workers': len(self.workers),
+                'idle_workers': self.idle,
+                'queued': self.queued,
+                'running': sum(self.running.values()),
+                'running_per_host': dict(self.running),
+                'submitted': self.stats.submitted,
+                'executed': executed,
+                'max_queued': self.stats.max_queued,
+                'avg_wait_time': self.stats.wait_time/executed if executed else 0.0,
+                'max_wait_time': self.stats.max_wait_time,
+            }
+
+
+def close_connections(func, *args, **kwargs):
+    """ runs func with a fresh database connection, closing it afterwards """
+    db.close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        db.connection.close()
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    runs blocking work of a coroutine (database queries, mail) on a thread of the loop
+    executor instead of stalling all the executions driven by the event loop
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(close_connections, func, *args, **kwargs))
+
+
+class AsyncioTask(object):
+    """ BackendExecutor task API on top of a concurrent.futures.Future """
+    def __init__(self, future):
+        self.future = future
+
+    def join(self, timeout=None):
+        try:
+            self.future.result(timeout)
+        except Exception:
+            pass
+        return self.future.done()
+
+
+class AsyncioExecutor(object):
+    """
+    Drives all backend executions of a process from a single event loop running on
+    its own thread, concurrency is bounded globally and per host with semaphores.
+
+    Database queries must not be performed by the loop thread, use run_sync().
+    """
+    is_async = True
+
+    def __init__(self, max_executions, max_per_host=0):
+        self.max_executions = max_executions
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.semaphore = None
+        self.running = 0
+        self.stats = AttrDict(submitted=0, executed=0, wait_time=0.0, max_wait_time=0.0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_forever, name='orchestration-loop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        return '%s(running=%i)' % (type(self).__name__, self.running)
+
+    @property
+    def is_worker(self):
+        return threading.current_thread() is self.thread
+
+    def run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def get_semaphore(self, key):
+        """ semaphores are created lazily, they must belong to the running loop """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_executions)
+        if not self.max_per_host:
+            return None
+        try:
+            return self.semaphores[key]
+        except KeyError:
+            semaphore = self.semaphores[key] = asyncio.Semaphore(self.max_per_host)
+            return semaphore
+
+    async def execute(self, coroutine_func, key, args, kwargs):
+        queued_at = time.monotonic()
+        semaphore = self.get_semaphore(key)
+        # Per host first, tasks waiting on a busy host must not hold global slots
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            async with self.semaphore:
+                wait_time = time.monotonic()-queued_at
+                self.stats.wait_time += wait_time
+                self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+                self.running += 1
+                try:
+                    return await coroutine_func(*args, **kwargs)
+                finally:
+                    self.running -= 1
+                    self.stats.executed += 1
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def submit(self, coroutine_func, key, *args, **kwargs):
+        self.stats.submitted += 1
+        coroutine = self.execute(coroutine_func, key, args, kwargs)
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        return AsyncioTask(future)
+
+    def run(self, coroutine):
+        """ runs a coroutine on the loop, blocking until its completion """
+        if self.is_worker:
+            raise RuntimeError("Blocking on the event loop thread would deadlock it.")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def get_metrics(self):
+        executed = self.stats.executed
+        return {
+            'running': self.running,
+            'queued': self.stats.submitted-executed-self.running,
+            'submitted': self.stats.submitted,
+            'executed': executed,
+            'avg_wait_time': self.stats.wait_time/executed if executed else 0.0,
+            'max_wait_time': self.stats.max_wait_time,
+        }
+
+
+_executors = {}
+_executors_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(use_asyncio=None):
+    """
+    process-wide executor, recreated after fork since threads do not survive it
+    the asyncio executor is used when the ssh method backend provides a coroutine
+    """
+    global _executors_pid
+    if use_asyncio is None:
+        method = import_class(settings.ORCHESTRATION_SSH_METHOD_BACKEND)
+        use_asyncio = hasattr(method, 'coroutine')
+    with _executor_lock:
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+        try:
+            return _executors[use_asyncio]
+        except KeyError:
+            if use_asyncio:
+                executor = AsyncioExecutor(
+                    settings.ORCHESTRATION_ASYNC_MAX_EXECUTIONS,
+                    max_per_host=settings.ORCHESTRATION_MAX_WORKERS_PER_HOST,
+                )
+            else:
+                executor = BackendExecutor(
+                    settings.ORCHESTRATION_MAX_WORKERS,
+                    max_per_host=settings.ORCHESTRATION_MAX_WORKERS_PER_HOST,
+                    max_queue=settings.ORCHESTRATION_MAX_QUEUE_SIZE,
+                )
+            _executors[use_asyncio] = executor
+            return executor
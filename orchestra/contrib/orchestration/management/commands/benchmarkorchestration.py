@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orchestra import get_version
+from orchestra.contrib.orchestration.benchmark import Benchmark, test_database
+
+
+def get_revision():
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision.decode('ascii').strip()
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the orchestration save, delete and bulk orchestrate paths against '
+            'fake servers that record the generated scripts, on a test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-a', '--accounts', action='store', dest='accounts', type=int,
+            default=100, help='Number of synthesised accounts. Defaults to 100.')
+        parser.add_argument('-s', '--servers', action='store', dest='servers', type=int,
+            default=4, help='Number of fake servers. Defaults to 4.')
+        parser.add_argument('--json', action='store', dest='json', default='',
+            help='Writes the results as JSON to the provided path, for comparing commits.')
+        parser.add_argument('--noinput', action='store_false', dest='interactive', default=True,
+            help='Tells Django to NOT prompt the user for input of any kind.')
+        parser.add_argument('--keepdb', action='store_true', dest='keepdb', default=False,
+            help='Preserves the test database between runs.')
+
+    def handle(self, *args, **options):
+        accounts = options.get('accounts')
+        servers = options.get('servers')
+        if accounts < 1 or servers < 1:
+            raise CommandError("--accounts and --servers should be positive numbers.")
+        benchmark = Benchmark(accounts=accounts, servers=servers)
+        verbosity = int(options.get('verbosity'))
+        with test_database(verbosity, interactive=options.get('interactive'),
+                keepdb=options.get('keepdb')):
+            phases = benchmark.run()
+        row = '%-12s %-9s %10s %10s %9s %12s %14s\n'
+        self.stdout.write(row % ('path', 'phase', 'operations', 'seconds', 'queries', 'ops/sec', 'peak memory'))
+        for phase in phases:
+            phase = phase.as_dict()
+            self.stdout.write(row % (
+                phase['path'], phase['phase'], phase['operations'], '%.3f' % phase['seconds'],
+                phase['queries'], phase['ops_per_second'], phase['peak_memory']
+            ))
+        self.stdout.write(
+            "Database queries performed by executor threads are not accounted.\n")
+        if options.get('json'):
+            results = {
+                'version': get_version(),
+                'revision': get_revision(),
+                'accounts': accounts,
+                'servers': servers,
+                'phases': [phase.as_dict() for phase in phases],
+                'summary': benchmark.get_summary(),
+            }
+            with open(options['json'], 'w') as handler:
+                json.dump(results, handler, indent=4)
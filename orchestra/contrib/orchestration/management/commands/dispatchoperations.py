@@ -0,0 +1,50 @@
+import logging
+import time
+
+from django import db
+from django.core.management.base import BaseCommand
+
+from orchestra.contrib.orchestration import manager, settings
+from orchestra.contrib.orchestration.helpers import get_messages
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Executes the operations queued by OperationsMiddleware when '
+            'ORCHESTRATION_QUEUE_OPERATIONS is enabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+            help='Dispatches the operations currently on the queue and exits.')
+        parser.add_argument('-b', '--batch-size', action='store', dest='batch_size', type=int,
+            default=settings.ORCHESTRATION_QUEUE_BATCH_SIZE,
+            help='Maximum number of operations coalesced on each iteration.')
+        parser.add_argument('-i', '--interval', action='store', dest='interval', type=float,
+            default=settings.ORCHESTRATION_QUEUE_POLL_INTERVAL,
+            help='Seconds between checks of an empty queue.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity'))
+        batch_size = options.get('batch_size')
+        while True:
+            # Long running process, discard stale connections
+            db.close_old_connections()
+            try:
+                logs = manager.dispatch(limit=batch_size)
+            except Exception:
+                # e.g. the database is temporarily unavailable, keep dispatching
+                logger.exception("Failed to dispatch queued operations")
+                if options.get('once'):
+                    raise
+                time.sleep(options.get('interval'))
+                continue
+            if logs and verbosity:
+                for t, msg in get_messages(logs):
+                    self.stdout.write('%s: %s' % (t, msg))
+            if options.get('once'):
+                if not logs:
+                    break
+            elif not logs:
+                time.sleep(options.get('interval'))
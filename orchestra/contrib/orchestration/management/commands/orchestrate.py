@@ -28,6 +28,8 @@ class Command(BaseCommand):
             default='', help='Overrides backend.')
         parser.add_argument('-l', '--listbackends', action='store_true', dest='list_backends', default=False,
             help='List available baclends.')
+        parser.add_argument('-f', '--force', action='store_true', dest='force', default=False,
+            help='Executes operations even when their scripts are the same that were last applied.')
         parser.add_argument('--dry-run', action='store_true', dest='dry', default=False,
             help='Only prints scrtipt.')
 
@@ -98,7 +100,7 @@ class Command(BaseCommand):
         interactive = options.get('interactive')
         dry = options.get('dry')
         operations = self.collect_operations(**options)
-        scripts, serialize = manager.generate(operations)
+        scripts, serialize = manager.generate(operations, force=options.get('force'))
         servers = set()
         # Print scripts
         for key, value in scripts.items():
@@ -118,20 +120,22 @@ class Command(BaseCommand):
         if not dry:
             logs = manager.execute(scripts, serialize=serialize, run_async=True)
             running = list(logs)
-            stdout = 0
-            stderr = 0
+            # Output offsets of each log
+            offsets = {log: (0, 0) for log in logs}
             while running:
-                for log in running:
+                for log in list(running):
+                    stdout, stderr = offsets[log]
+                    # Running logs are updated in-memory by the executor worker
+                    has_finished = log.has_finished
                     cstdout = len(log.stdout)
                     cstderr = len(log.stderr)
                     if cstdout > stdout:
                         self.stdout.write(log.stdout[stdout:])
-                        stdout = cstdout
                     if cstderr > stderr:
                         self.stderr.write(log.stderr[stderr:])
-                        stderr = cstderr
-                    if log.has_finished:
+                    offsets[log] = (cstdout, cstderr)
+                    if has_finished:
                         running.remove(log)
-                    time.sleep(0.05)
+                time.sleep(0.05)
             for log in logs:
                 self.stdout.write(' '.join((log.backend, log.state)))
@@ -1,17 +1,21 @@
+import hashlib
 import logging
-import threading
+import re
 import traceback
 from collections import OrderedDict
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.mail import mail_admins
+from django.utils import timezone
 
 from orchestra.utils import db
 from orchestra.utils.python import import_class, OrderedSet
 
 from . import settings, Operation
 from .backends import ServiceBackend
+from .executors import get_executor, run_sync
 from .helpers import send_report
-from .models import BackendLog
+from .models import BackendLog, QueuedOperation, ScriptFragment
 from .signals import pre_action, post_action, pre_commit, post_commit, pre_prepare, post_prepare
 
 
@@ -19,6 +23,37 @@ logger = logging.getLogger(__name__)
 router = import_class(settings.ORCHESTRATION_ROUTER)
 
 
+def log_exception(log, args, kwargs):
+    trace = traceback.format_exc()
+    log.state = log.EXCEPTION
+    log.stderr += trace
+    log.save()
+    subject = 'EXCEPTION executing backend(s) %s %s' % (args, kwargs)
+    logger.error(subject)
+    logger.error(trace)
+    mail_admins(subject, trace)
+
+
+def log_operations(execute, args, log, operations):
+    # Store and log the operation
+    for operation in operations:
+        logger.info("Executed %s" % operation)
+        operation.store(log)
+    fragments = getattr(execute.__self__, 'fragments', None)
+    if fragments:
+        if log.is_success:
+            ScriptFragment.objects.store(fragments)
+        else:
+            # The server may be left on an unknown state
+            ScriptFragment.objects.forget(fragments)
+    if not log.is_success:
+        send_report(execute, args, log)
+    stdout = log.stdout.strip()
+    stdout and logger.debug('STDOUT %s', stdout.encode('ascii', errors='replace').decode())
+    stderr = log.stderr.strip()
+    stderr and logger.debug('STDERR %s', stderr.encode('ascii', errors='replace').decode())
+
+
 def keep_log(execute, log, operations):
     def wrapper(*args, **kwargs):
         """ send report """
@@ -28,38 +63,102 @@ def keep_log(execute, log, operations):
         try:
             log = execute(*args, **kwargs)
         except Exception as e:
-            trace = traceback.format_exc()
-            log.state = log.EXCEPTION
-            log.stderr += trace
-            log.save()
-            subject = 'EXCEPTION executing backend(s) %s %s' % (args, kwargs)
-            logger.error(subject)
-            logger.error(trace)
-            mail_admins(subject, trace)
+            log_exception(log, args, kwargs)
             # We don't propagate the exception further to avoid transaction rollback
         finally:
-            # Store and log the operation
-            for operation in operations:
-                logger.info("Executed %s" % operation)
-                operation.store(log)
-            if not log.is_success:
-                send_report(execute, args, log)
-            stdout = log.stdout.strip()
-            stdout and logger.debug('STDOUT %s', stdout.encode('ascii', errors='replace').decode())
-            stderr = log.stderr.strip()
-            stderr and logger.debug('STDERR %s', stderr.encode('ascii', errors='replace').decode())
+            log_operations(execute, args, log, operations)
     return wrapper
 
 
-def generate(operations):
+def keep_log_async(execute, log, operations):
+    """ keep_log() for coroutines """
+    async def wrapper(*args, **kwargs):
+        log = kwargs['log']
+        try:
+            log = await execute(*args, **kwargs)
+        except Exception as e:
+            await run_sync(log_exception, log, args, kwargs)
+        finally:
+            await run_sync(log_operations, execute, args, log, operations)
+    return wrapper
+
+
+def get_content_mark(backend):
+    """ position on the backend content where the next command is going to be appended """
+    if not backend.content:
+        return (0, 0)
+    return (len(backend.content), len(backend.content[-1][1]))
+
+
+def get_fragment(backend, mark):
+    """ commands appended to the backend content after mark """
+    groups, commands = mark
+    fragment = []
+    if groups:
+        fragment.extend(backend.content[groups-1][1][commands:])
+    for method, cmds in backend.content[groups:]:
+        fragment.extend(cmds)
+    return fragment
+
+
+def truncate_content(backend, mark):
+    groups, commands = mark
+    del backend.content[groups:]
+    if groups:
+        del backend.content[groups-1][1][commands:]
+
+
+# Time of ServiceBackend.get_banner(), embedded on the configuration files of many backends
+banner_time_re = re.compile(r'(Generated by Orchestra at )\S+ \d{2}, \d{4} \d{2}:\d{2}:\d{2}')
+
+
+def get_digest(action, commands):
+    """
+    sha256 of the script fragment, None when it can not be compared
+    banner times are left out, otherwise no fragment would ever be the same
+    """
+    if not commands:
+        return None
+    digest = hashlib.sha256(action.encode())
+    for command in commands:
+        if not isinstance(command, str):
+            # Python functions have no comparable representation
+            return None
+        command = banner_time_re.sub(r'\1', command)
+        digest.update(b'\0')
+        digest.update(command.encode('utf8', errors='surrogateescape'))
+    return digest.hexdigest()
+
+
+def get_digests(operations):
+    """ digests of the last fragments applied for the operations that can be skipped """
+    route_ids, object_ids = set(), set()
+    for operation in operations:
+        if operation.action == Operation.SAVE and operation.instance.pk is not None:
+            object_ids.add(operation.instance.pk)
+            route_ids.update(route.pk for route in operation.routes)
+    if not object_ids:
+        return {}
+    return ScriptFragment.objects.get_digests(route_ids, object_ids)
+
+
+def generate(operations, force=False):
+    """
+    force: execute operations even if they generate the same script fragment
+        that was last applied for their object
+    """
     scripts = OrderedDict()
     cache = {}
     serialize = False
-    # Generate scripts per route+backend
+    operations = list(operations)
     for operation in operations:
-        logger.debug("Queued %s" % operation)
         if operation.routes is None:
             operation.routes = router.objects.get_for_operation(operation, cache=cache)
+    skip_unchanged = settings.ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS and not force
+    digests = get_digests(operations) if skip_unchanged else {}
+    # Generate scripts per route+backend
+    for operation in operations:
+        logger.debug("Queued %s" % operation)
         for route in operation.routes:
             # TODO key by action.async
             async_action = route.action_is_async(operation.action)
@@ -83,9 +182,12 @@ def generate(operations):
                 'action': operation.action,
             }
             backend.set_content()
+            mark = get_content_mark(backend)
             pre_action.send(**kwargs)
             method(operation.instance)
             post_action.send(**kwargs)
+            if skip_unchanged:
+                skip_unchanged_fragment(backend, route, operation, mark, digests)
             if backend.serialize:
                 serialize = True
     for value in scripts.values():
@@ -97,19 +199,45 @@ def generate(operations):
     return scripts, serialize
 
 
-def execute(scripts, serialize=False, run_async=None):
+def skip_unchanged_fragment(backend, route, operation, mark, digests):
+    """
+    removes the commands generated by operation when they are the same that were last
+    successfully applied, otherwise the fragment is stored after execution
+    """
+    instance = operation.instance
+    if instance.pk is None or backend.force_empty_action_execution:
+        return
+    if operation.action not in (Operation.SAVE, Operation.DELETE):
+        return
+    content_type = ContentType.objects.get_for_model(instance)
+    digest = None
+    if operation.action == Operation.SAVE:
+        digest = get_digest(operation.action, get_fragment(backend, mark))
+        if digest and digests.get((route.pk, content_type.pk, instance.pk)) == digest:
+            truncate_content(backend, mark)
+            logger.debug("Skipped unchanged %s on %s" % (operation, route.host))
+            return
+    # Deleted objects (digest None) are forgotten
+    backend.fragments.append(
+        ScriptFragment(route=route, content_type=content_type, object_id=instance.pk, digest=digest)
+    )
+
+
+def execute(scripts, serialize=False, run_async=None, queued_logs=None):
     """
     executes the operations on the servers
 
     serialize: execute one backend at a time
-    run_async: do not join threads (overrides route.run_async)
+    run_async: do not wait for executions to finish (overrides route.run_async),
+        False waits for all executions, including async actions
+    queued_logs: {(route, backend name): log} logs created when the operations were queued
     """
     if settings.ORCHESTRATION_DISABLE_EXECUTION:
         logger.info('Orchestration execution is dissabled by ORCHESTRATION_DISABLE_EXECUTION.')
         return []
     # Execute scripts on each server
-    executions = []
-    threads_to_join = []
+    executor = get_executor()
+    tasks_to_join = []
     logs = []
     for key, value in scripts.items():
         route, __, async_action = key
@@ -119,27 +247,42 @@ def execute(scripts, serialize=False, run_async=None):
             is_async = not serialize and (route.run_async or async_action)
         else:
             is_async = not serialize and (run_async or async_action)
+        join = not is_async or run_async is False
         kwargs = {
             'run_async': is_async,
         }
-        # we clone the connection just in case we are isolated inside a transaction
-        with db.clone(model=BackendLog) as handle:
-            log = backend.create_log(*args, using=handle.target)
-            log._state.db = handle.origin
+        log = None
+        if queued_logs:
+            log = queued_logs.pop((route, backend.get_name()), None)
+        if log is not None:
+            log.state = backend.get_log_state()
+            log.save(update_fields=('state', 'updated_at'))
+        else:
+            # we clone the connection just in case we are isolated inside a transaction
+            with db.clone(model=BackendLog) as handle:
+                log = backend.create_log(*args, using=handle.target)
+                log._state.db = handle.origin
         kwargs['log'] = log
         task = keep_log(backend.execute, log, operations)
         logger.debug('%s is going to be executed on %s.' % (backend, route.host))
         if serialize:
             # Execute one backend at a time, no need for threads
             task(*args, **kwargs)
+        elif executor.is_async:
+            # All executions are driven by the executor event loop
+            task = keep_log_async(backend.execute_async, log, operations)
+            task = executor.submit(task, route.host.pk, *args, **kwargs)
+            if join:
+                tasks_to_join.append(task)
         else:
+            # Workers have their own connection, bounded by ORCHESTRATION_MAX_WORKERS
             task = db.close_connection(task)
-            thread = threading.Thread(target=task, args=args, kwargs=kwargs)
-            thread.start()
-            if not is_async:
-                threads_to_join.append(thread)
+            task = executor.submit(task, route.host.pk, *args, **kwargs)
+            if join:
+                tasks_to_join.append(task)
         logs.append(log)
-    [ thread.join() for thread in threads_to_join ]
+    [ task.join() for task in tasks_to_join ]
+    logger.debug('%s metrics: %s' % (executor, executor.get_metrics()))
     return logs
 
 
@@ -165,19 +308,15 @@ def collect(instance, action, **kwargs):
                         candidates = [candidate]
                     for candidate in candidates:
                         # Check if a delete for candidate is in operations
-                        delete_mock = Operation(backend_cls, candidate, Operation.DELETE)
-                        if delete_mock not in operations:
+                        delete_key = Operation.get_key(backend_cls, candidate, Operation.DELETE)
+                        if delete_key not in operations:
                             # related objects with backend.model trigger save()
                             instances.append((candidate, Operation.SAVE))
         for selected, iaction in instances:
             # Maintain consistent state of operations based on save/delete behaviour
             # Prevent creating a deleted selected by deleting existing saves
             if iaction == Operation.DELETE:
-                save_mock = Operation(backend_cls, selected, Operation.SAVE)
-                try:
-                    operations.remove(save_mock)
-                except KeyError:
-                    pass
+                operations.discard(Operation.get_key(backend_cls, selected, Operation.SAVE))
             else:
                 update_fields = kwargs.get('update_fields', None)
                 if update_fields is not None:
@@ -207,3 +346,119 @@ def collect(instance, action, **kwargs):
                     operation.preload_context()
                 operations.add(operation)
     return operations
+
+
+def enqueue(operations):
+    """
+    stores the operations on the queue for being executed by the dispatcher,
+    returns the queued logs, one per route and backend
+    """
+    logs = OrderedDict()
+    queued = []
+    cache = {}
+    for operation in operations:
+        if operation.routes is None:
+            operation.routes = router.objects.get_for_operation(operation, cache=cache)
+        for route in operation.routes:
+            key = (route, operation.backend)
+            try:
+                log = logs[key]
+            except KeyError:
+                log = BackendLog.objects.create(
+                    backend=operation.backend.get_name(), state=BackendLog.QUEUED, server=route.host)
+                logs[key] = log
+            queued.append(QueuedOperation.from_operation(operation, route, log))
+            logger.debug("Queued %s on %s" % (operation, route.host))
+    QueuedOperation.objects.bulk_create(queued)
+    return list(logs.values())
+
+
+def dispatch(limit=None):
+    """
+    executes queued operations, coalescing them by route and backend across requests
+    an object saved several times is executed once with its last state,
+    and not at all when it has been deleted afterwards
+    """
+    claimed = QueuedOperation.objects.claim(limit=limit)
+    if not claimed:
+        return []
+    loaded = []
+    failed_logs = OrderedDict()
+    for queued in claimed:
+        try:
+            backend_cls = queued.backend_class
+            instance = queued.get_instance()
+        except Exception:
+            logger.exception("Failed to load %s" % queued)
+            log = queued.log
+            log.state = BackendLog.ERROR
+            log.traceback = traceback.format_exc()
+            log.save(update_fields=('state', 'traceback', 'updated_at'))
+            failed_logs[log.pk] = log
+            continue
+        loaded.append((queued, backend_cls, instance))
+    operations = OrderedDict()
+    queued_logs = OrderedDict()
+    coalesced_logs = OrderedDict()
+    for queued, backend_cls, instance in loaded:
+        route = queued.route
+        log = queued.log
+        if log.pk not in failed_logs:
+            # The first loaded log of each route and backend is executed, the rest coalesced
+            log_key = (route, queued.backend)
+            executed = queued_logs.setdefault(log_key, log)
+            if executed.pk != log.pk:
+                coalesced_logs[log.pk] = (log_key, log)
+        if instance is None:
+            # Deleted since queued, along with a queued delete operation
+            continue
+        key = Operation.get_key(backend_cls, instance, queued.action)
+        routes = [route]
+        previous = operations.pop(key, None)
+        if previous is not None:
+            routes = previous.routes + [r for r in routes if r not in previous.routes]
+        # Keep the last state of the object, at the position of its last change
+        operations[key] = Operation(backend_cls, instance, queued.action, routes=routes)
+    for key, operation in list(operations.items()):
+        backend_cls, label, pk, action = key
+        if action != Operation.DELETE:
+            if (backend_cls, label, pk, Operation.DELETE) in operations:
+                operations.pop(key)
+    operations = OrderedSet(operations.values())
+    executed_logs = dict(queued_logs)
+    logs = []
+    try:
+        if operations:
+            scripts, serialize = generate(operations)
+            logs = execute(scripts, serialize=serialize, run_async=False, queued_logs=queued_logs)
+    except Exception:
+        # Completed anyway, otherwise the same batch is claimed and fails again
+        logger.exception("Failed to dispatch %i queued operations" % len(claimed))
+        trace = traceback.format_exc()
+        unfinished = (BackendLog.QUEUED, BackendLog.RECEIVED)
+        for log in executed_logs.values():
+            BackendLog.objects.filter(pk=log.pk, state__in=unfinished).update(
+                state=BackendLog.ERROR, traceback=trace, updated_at=timezone.now())
+            log.refresh_from_db()
+        logs = list(executed_logs.values())
+    else:
+        # Logs without scripts left, e.g. all its operations are superseded by a later delete
+        for log in queued_logs.values():
+            log.state = BackendLog.NOTHING
+            log.save(update_fields=('state', 'updated_at'))
+            logs.append(log)
+    for log_key, log in coalesced_logs.values():
+        executed = executed_logs[log_key]
+        BackendLog.objects.filter(pk=log.pk).update(
+            state=executed.state,
+            script=executed.script,
+            stdout="Coalesced into backend log %i.\n%s" % (executed.pk, executed.stdout),
+            stderr=executed.stderr,
+            traceback=executed.traceback,
+            exit_code=executed.exit_code,
+            updated_at=timezone.now(),
+        )
+    logs.extend(failed_logs.values())
+    # Operations of a dispatcher crashing before this point are queued again
+    QueuedOperation.objects.complete(claimed)
+    return logs
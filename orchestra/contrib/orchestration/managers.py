@@ -10,19 +10,19 @@ from orchestra.utils.python import OrderedSet
 
 from . import manager, Operation, helpers
 from .middlewares import OperationsMiddleware
-from .models import BackendLog, BackendOperation
+from .models import BackendLog, BackendOperation, QueuedOperation, ScriptFragment
 
 
 @receiver(post_save, dispatch_uid='orchestration.post_save_manager_collector')
 def post_save_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendOperation, QueuedOperation, ScriptFragment, LogEntry):
         instance = kwargs.get('instance')
         orchestrate.collect(Operation.SAVE, **kwargs)
 
 
 @receiver(pre_delete, dispatch_uid='orchestration.pre_delete_manager_collector')
 def pre_delete_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendOperation, QueuedOperation, ScriptFragment, LogEntry):
         orchestrate.collect(Operation.DELETE, **kwargs)
 
 
@@ -42,11 +42,16 @@ class orchestrate(ContextDecorator):
         user = SystemUser.objects.get(username='rata')
         user.shell = '/dev/null'
         user.save(update_fields=('shell',))
+
+    force: execute the operations even when their scripts are the same that were last applied
     """
     thread_locals = local()
     thread_locals.pending_operations = None
     thread_locals.route_cache = None
     
+    def __init__(self, force=False):
+        self.force = force
+
     @classmethod
     def collect(cls, action, **kwargs):
         """ Collects all pending operations derived from model signals """
@@ -70,7 +75,7 @@ class orchestrate(ContextDecorator):
         if not exc_type:
             operations = cls.thread_locals.pending_operations
             if operations:
-                scripts, serialize = manager.generate(operations)
+                scripts, serialize = manager.generate(operations, force=self.force)
                 logs = manager.execute(scripts, serialize=serialize)
                 for t, msg in helpers.get_messages(logs):
                     if t == 'error':
@@ -1,15 +1,19 @@
+import asyncio
+import codecs
 import inspect
 import logging
 import socket
 import sys
 import select
 import textwrap
+import threading
+import time
 
 from celery.datastructures import ExceptionInfo
+from django.utils import timezone
 
-from orchestra.settings import ORCHESTRA_SSH_DEFAULT_USER
-from orchestra.utils.sys import sshrun
 from orchestra.utils.python import CaptureStdout, import_class
+from orchestra.utils.sys import get_ssh_command
 
 from . import settings
 
@@ -17,11 +21,63 @@ from . import settings
 logger = logging.getLogger(__name__)
 
 
-def Paramiko(backend, log, server, cmds, run_async=False, paramiko_connections={}):
+class LogWriter(object):
+    """
+    Appends output of running backends to their log, flushing buffered content as new
+    BackendLogChunks by size or time instead of rewriting the whole stdout and stderr
+    """
+    def __init__(self, log):
+        self.log = log
+        self.buffers = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    @property
+    def is_due(self):
+        return bool(self.buffers) and (
+            self.size >= settings.ORCHESTRATION_LOG_FLUSH_SIZE or
+            time.monotonic()-self.last_flush >= settings.ORCHESTRATION_LOG_FLUSH_INTERVAL)
+
+    def write(self, stream, content, flush=True):
+        """ flush=False leaves flushing to the caller, when is_due """
+        if not content:
+            return
+        setattr(self.log, stream, getattr(self.log, stream) + content)
+        self.buffers.append((stream, content))
+        self.size += len(content)
+        if flush and self.is_due:
+            self.flush()
+
+    def pop_chunks(self):
+        """ buffered content as unsaved chunks """
+        from .models import BackendLogChunk
+        self.last_flush = time.monotonic()
+        chunks = []
+        for stream, content in self.buffers:
+            if chunks and chunks[-1].stream == stream:
+                chunks[-1].content += content
+            else:
+                chunks.append(BackendLogChunk(log=self.log, stream=stream, content=content))
+        self.buffers = []
+        self.size = 0
+        return chunks
+
+    def store(self, chunks):
+        from .models import BackendLog, BackendLogChunk
+        if not chunks:
+            return
+        BackendLogChunk.objects.bulk_create(chunks)
+        BackendLog.objects.filter(pk=self.log.pk).update(updated_at=timezone.now())
+
+    def flush(self):
+        self.store(self.pop_chunks())
+
+
+def Paramiko(backend, log, server, cmds, run_async=False):
     """
     Executes cmds to remote server using Pramaiko
     """
-    import paramiko
+    from .connections import paramiko_pool
     script = '\n'.join(cmds)
     script = script.replace('\r', '')
     log.state = log.STARTED
@@ -29,57 +85,57 @@ def Paramiko(backend, log, server, cmds, run_async=False, paramiko_connections={
     log.save(update_fields=('script', 'state', 'updated_at'))
     if not cmds:
         return
-    channel = None
-    ssh = None
     try:
         addr = server.get_address()
         # ssh connection
-        ssh = paramiko_connections.get(addr)
-        if not ssh:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            key = settings.ORCHESTRATION_SSH_KEY_PATH
-            try:
-                ssh.connect(addr, username=ORCHESTRA_SSH_DEFAULT_USER, key_filename=key)
-            except socket.error as e:
-                logger.error('%s timed out on %s' % (backend, addr))
-                log.state = log.TIMEOUT
-                log.stderr = str(e)
-                log.save(update_fields=('state', 'stderr', 'updated_at'))
-                return
-            paramiko_connections[addr] = ssh
-        transport = ssh.get_transport()
-        channel = transport.open_session()
-        channel.exec_command(backend.script_executable)
-        channel.sendall(script)
-        channel.shutdown_write()
-        # Log results
-        logger.debug('%s running on %s' % (backend, server))
-        if run_async:
-            second = False
-            while True:
-                # Non-blocking is the secret ingridient in the async sauce
-                select.select([channel], [], [])
-                if channel.recv_ready():
-                    part = channel.recv(1024).decode('utf-8')
-                    while part:
-                        log.stdout += part
+        try:
+            connection = paramiko_pool.acquire(addr)
+        except socket.error as e:
+            logger.error('%s timed out on %s' % (backend, addr))
+            log.state = log.TIMEOUT
+            log.stderr = str(e)
+            log.save(update_fields=('state', 'stderr', 'updated_at'))
+            return
+        channel = None
+        error = True
+        try:
+            channel = connection.open_session()
+            channel.exec_command(backend.script_executable)
+            channel.sendall(script)
+            channel.shutdown_write()
+            # Log results
+            logger.debug('%s running on %s' % (backend, server))
+            if run_async:
+                writer = LogWriter(log)
+                second = False
+                while True:
+                    # Non-blocking is the secret ingridient in the async sauce
+                    select.select([channel], [], [])
+                    if channel.recv_ready():
                         part = channel.recv(1024).decode('utf-8')
-                if channel.recv_stderr_ready():
-                    part = channel.recv_stderr(1024).decode('utf-8')
-                    while part:
-                        log.stderr += part
+                        while part:
+                            writer.write('stdout', part)
+                            part = channel.recv(1024).decode('utf-8')
+                    if channel.recv_stderr_ready():
                         part = channel.recv_stderr(1024).decode('utf-8')
-                log.save(update_fields=('stdout', 'stderr', 'updated_at'))
-                if channel.exit_status_ready():
-                    if second:
-                        break
-                    second = True
-        else:
-            log.stdout += channel.makefile('rb', -1).read().decode('utf-8')
-            log.stderr += channel.makefile_stderr('rb', -1).read().decode('utf-8')
-
-        log.exit_code = channel.recv_exit_status()
+                        while part:
+                            writer.write('stderr', part)
+                            part = channel.recv_stderr(1024).decode('utf-8')
+                    if channel.exit_status_ready():
+                        if second:
+                            break
+                        second = True
+                writer.flush()
+            else:
+                log.stdout += channel.makefile('rb', -1).read().decode('utf-8')
+                log.stderr += channel.makefile_stderr('rb', -1).read().decode('utf-8')
+
+            log.exit_code = channel.recv_exit_status()
+            error = False
+        finally:
+            if channel is not None:
+                channel.close()
+            paramiko_pool.release(connection, error=error)
         log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
         log.save()
@@ -93,14 +149,13 @@ def Paramiko(backend, log, server, cmds, run_async=False, paramiko_connections={
         if log.state == log.STARTED:
             log.state = log.ABORTED
             log.save(update_fields=('state', 'updated_at'))
-        if channel is not None:
-            channel.close()
 
 
 def OpenSSH(backend, log, server, cmds, run_async=False):
     """
     Executes cmds to remote server using SSH with connection resuse for maximum performance
     """
+    from .connections import openssh_pool
     script = '\n'.join(cmds)
     script = script.replace('\r', '')
     log.state = log.STARTED
@@ -109,19 +164,20 @@ def OpenSSH(backend, log, server, cmds, run_async=False):
     if not cmds:
         return
     try:
-        ssh = sshrun(server.get_address(), script, executable=backend.script_executable,
-            persist=True, run_async=run_async, silent=True)
-        logger.debug('%s running on %s' % (backend, server))
-        if run_async:
-            for state in ssh:
-                log.stdout += state.stdout.decode('utf8')
-                log.stderr += state.stderr.decode('utf8')
-                log.save(update_fields=('stdout', 'stderr', 'updated_at'))
-            exit_code = state.exit_code
-        else:
-            log.stdout += ssh.stdout.decode('utf8')
-            log.stderr += ssh.stderr.decode('utf8')
-            exit_code = ssh.exit_code
+        with openssh_pool.checkout(server.get_address()) as connection:
+            ssh = connection.run(script, executable=backend.script_executable, run_async=run_async)
+            logger.debug('%s running on %s' % (backend, server))
+            if run_async:
+                writer = LogWriter(log)
+                for state in ssh:
+                    writer.write('stdout', state.stdout.decode('utf8'))
+                    writer.write('stderr', state.stderr.decode('utf8'))
+                writer.flush()
+                exit_code = state.exit_code
+            else:
+                log.stdout += ssh.stdout.decode('utf8')
+                log.stderr += ssh.stderr.decode('utf8')
+                exit_code = ssh.exit_code
         if not log.exit_code:
             log.exit_code = exit_code
             if exit_code == 255 and log.stderr.startswith('ssh: connect to host'):
@@ -142,12 +198,114 @@ def OpenSSH(backend, log, server, cmds, run_async=False):
             log.save(update_fields=('state', 'updated_at'))
 
 
+async def async_openssh(backend, log, server, cmds, run_async=False):
+    """
+    Coroutine executing cmds to remote server using an asyncio SSH subprocess,
+    database work is performed on threads not to block the event loop
+    """
+    from .executors import run_sync
+    script = '\n'.join(cmds)
+    script = script.replace('\r', '')
+    log.state = log.STARTED
+    log.script = '\n'.join((log.script, script))
+    await run_sync(log.save, update_fields=('script', 'state', 'updated_at'))
+    if not cmds:
+        return
+    writer = LogWriter(log)
+
+    async def read(stream, name):
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        while True:
+            data = await stream.read(4096)
+            content = decoder.decode(data, final=not data)
+            if run_async:
+                writer.write(name, content, flush=False)
+                if writer.is_due:
+                    # Chunks are taken on the loop thread, concurrent reads can not lose them
+                    await run_sync(writer.store, writer.pop_chunks())
+            else:
+                setattr(log, name, getattr(log, name) + content)
+            if not data:
+                break
+
+    process = None
+    try:
+        cmd = get_ssh_command(server.get_address(), executable=backend.script_executable, persist=True)
+        process = await asyncio.create_subprocess_shell(cmd, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        logger.debug('%s running on %s' % (backend, server))
+        process.stdin.write(script.encode('utf8'))
+        process.stdin.close()
+        await asyncio.gather(read(process.stdout, 'stdout'), read(process.stderr, 'stderr'))
+        exit_code = await process.wait()
+        await run_sync(writer.store, writer.pop_chunks())
+        if not log.exit_code:
+            log.exit_code = exit_code
+            if exit_code == 255 and log.stderr.startswith('ssh: connect to host'):
+                log.state = log.TIMEOUT
+            else:
+                log.state = log.SUCCESS if exit_code == 0 else log.FAILURE
+        logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+        await run_sync(log.save)
+    except asyncio.CancelledError:
+        if process is not None and process.returncode is None:
+            process.kill()
+        raise
+    except:
+        log.state = log.ERROR
+        log.traceback = ExceptionInfo(sys.exc_info()).traceback
+        logger.error('Exception while executing %s on %s' % (backend, server))
+        logger.debug(log.traceback)
+        await run_sync(log.save)
+    finally:
+        if log.state == log.STARTED:
+            log.state = log.ABORTED
+            await run_sync(log.save, update_fields=('state', 'updated_at'))
+
+
+def AsyncOpenSSH(backend, log, server, cmds, run_async=False):
+    """
+    Executes cmds to remote server using SSH subprocesses driven by a single event loop,
+    supporting thousands of concurrent executions per worker
+    """
+    from .executors import get_executor
+    executor = get_executor(use_asyncio=True)
+    return executor.run(async_openssh(backend, log, server, cmds, run_async))
+AsyncOpenSSH.coroutine = async_openssh
+
+
+recorded_scripts = []
+recorded_scripts_lock = threading.Lock()
+
+
+def Record(backend, log, server, cmds, run_async=False):
+    """
+    Records cmds instead of executing them, fake server transport used for benchmarking
+    """
+    script = '\n'.join(cmd if isinstance(cmd, str) else repr(cmd) for cmd in cmds)
+    log.state = log.STARTED
+    log.script = '\n'.join((log.script, script))
+    with recorded_scripts_lock:
+        recorded_scripts.append((backend.get_name(), server.get_address(), script))
+    log.exit_code = 0
+    log.state = log.SUCCESS
+    log.save()
+
+
 def SSH(*args, **kwargs):
     """ facade function enabling to chose between multiple SSH backends"""
     method = import_class(settings.ORCHESTRATION_SSH_METHOD_BACKEND)
     return method(*args, **kwargs)
 
 
+def get_coroutine(method):
+    """ returns the coroutine of a backend script method, if any """
+    func = getattr(method, '__func__', method)
+    if func is SSH:
+        func = import_class(settings.ORCHESTRATION_SSH_METHOD_BACKEND)
+    return getattr(func, 'coroutine', None)
+
+
 def Python(backend, log, server, cmds, run_async=False):
     script = ''
     functions = set()
@@ -162,16 +320,19 @@ def Python(backend, log, server, cmds, run_async=False):
     log.script = '\n'.join((log.script, script))
     log.save(update_fields=('script', 'state', 'updated_at'))
     stdout = ''
+    writer = LogWriter(log)
     try:
         for cmd in cmds:
             with CaptureStdout() as stdout:
                 result = cmd(server)
-            for line in stdout:
-                log.stdout += line + '\n'
+            output = ''.join(line + '\n' for line in stdout)
             if result:
-                log.stdout += '# Result: %s\n' % result
+                output += '# Result: %s\n' % result
             if run_async:
-                log.save(update_fields=('stdout', 'updated_at'))
+                writer.write('stdout', output)
+            else:
+                log.stdout += output
+        writer.flush()
     except:
         log.exit_code = 1
         log.state = log.FAILURE
@@ -9,21 +9,21 @@ from django.urls import resolve
 from django.utils.deprecation import MiddlewareMixin
 from orchestra.utils.python import OrderedSet
 
-from . import Operation, manager
+from . import Operation, manager, settings
 from .helpers import message_user
-from .models import BackendLog, BackendOperation
+from .models import BackendLog, BackendOperation, QueuedOperation, ScriptFragment
 
 
 @receiver(post_save, dispatch_uid='orchestration.post_save_collector')
 def post_save_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendOperation, QueuedOperation, ScriptFragment, LogEntry):
         instance = kwargs.get('instance')
         OperationsMiddleware.collect(Operation.SAVE, **kwargs)
 
 
 @receiver(pre_delete, dispatch_uid='orchestration.pre_delete_collector')
 def pre_delete_collector(sender, *args, **kwargs):
-    if sender not in (BackendLog, BackendOperation, LogEntry):
+    if sender not in (BackendLog, BackendOperation, QueuedOperation, ScriptFragment, LogEntry):
         OperationsMiddleware.collect(Operation.DELETE, **kwargs)
 
 
@@ -38,7 +38,8 @@ def m2m_collector(sender, *args, **kwargs):
 class OperationsMiddleware(MiddlewareMixin):
     """
     Stores all the operations derived from save and delete signals and executes them
-    at the end of the request/response cycle
+    at the end of the request/response cycle, or queues them for the dispatcher when
+    ORCHESTRATION_QUEUE_OPERATIONS is enabled
 
     It also works as a transaction middleware, making requets to run within an atomic block.
     """
@@ -99,7 +100,18 @@ class OperationsMiddleware(MiddlewareMixin):
         """ Processes pending backend operations """
         if response.status_code != 500:
             operations = self.get_pending_operations()
-            if operations:
+            if operations and settings.ORCHESTRATION_QUEUE_OPERATIONS:
+                try:
+                    # Queued within the transaction, operations are stored along with the changes
+                    logs = manager.enqueue(operations)
+                except Exception as exception:
+                    self.leave_transaction_management(exception)
+                    raise
+                self.leave_transaction_management()
+                if logs and resolve(request.path).app_name == 'admin':
+                    message_user(request, logs)
+                return response
+            elif operations:
                 try:
                     scripts, serialize = manager.generate(operations)
                 except Exception as exception:
@@ -1,10 +1,20 @@
+import datetime
+import json
 import logging
+import os
 import socket
+import uuid
+from functools import lru_cache
 
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_str
 from django.utils.functional import cached_property
 from django.utils.module_loading import autodiscover_modules
@@ -12,8 +22,9 @@ from django.utils.translation import gettext_lazy as _
 
 from orchestra.core.validators import validate_ip_address, validate_hostname, OrValidator
 from orchestra.models.fields import NullableCharField, MultiSelectField
+from orchestra.utils.index import VersionedIndex
 
-from . import settings
+from . import settings, Operation
 from .backends import ServiceBackend
 
 
@@ -74,6 +85,7 @@ class BackendLog(models.Model):
     REVOKED = 'REVOKED'
     ABORTED = 'ABORTED'
     NOTHING = 'NOTHING'
+    QUEUED = 'QUEUED'
     # Special state for mocked backendlogs
     EXCEPTION = 'EXCEPTION'
 
@@ -87,6 +99,7 @@ class BackendLog(models.Model):
         (ABORTED, ABORTED),
         (REVOKED, REVOKED),
         (NOTHING, NOTHING),
+        (QUEUED, QUEUED),
     )
 
     backend = models.CharField(_("backend"), max_length=256)
@@ -114,7 +127,7 @@ class BackendLog(models.Model):
 
     @property
     def has_finished(self):
-        return self.state not in (self.STARTED, self.RECEIVED)
+        return self.state not in (self.STARTED, self.RECEIVED, self.QUEUED)
 
     @property
     def is_success(self):
@@ -123,6 +136,48 @@ class BackendLog(models.Model):
     def backend_class(self):
         return ServiceBackend.get_backend(self.backend)
 
+    def get_output(self, stream, since=0):
+        """
+        returns (output, last_chunk_id), output being the content appended after chunk <since>
+        running logs are rebuilt from their chunks, finished logs store it on the log itself
+        """
+        if self.has_finished and not since:
+            return getattr(self, stream), since
+        chunks = self.chunks.filter(stream=stream, id__gt=since).values_list('id', 'content')
+        output = []
+        for since, content in chunks:
+            output.append(content)
+        return ''.join(output), since
+
+    def get_stdout(self):
+        return self.get_output('stdout')[0]
+
+    def get_stderr(self):
+        return self.get_output('stderr')[0]
+
+
+class BackendLogChunk(models.Model):
+    """
+    Append-only output of a running backend, compacted into its BackendLog when finished
+    """
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+    STREAMS = (
+        (STDOUT, STDOUT),
+        (STDERR, STDERR),
+    )
+
+    log = models.ForeignKey(BackendLog, related_name='chunks', on_delete=models.CASCADE)
+    stream = models.CharField(_("stream"), max_length=8, choices=STREAMS)
+    content = models.TextField(_("content"))
+    created_at = models.DateTimeField(_("created"), auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return "%s %s" % (self.log, self.stream)
+
 
 class BackendOperationQuerySet(models.QuerySet):
     def create(self, **kwargs):
@@ -161,25 +216,255 @@ class BackendOperation(models.Model):
         return ServiceBackend.get_backend(self.backend)
 
 
+class QueuedOperationQuerySet(models.QuerySet):
+    def ready(self, now=None):
+        """
+        operations of routes whose backend coalescing window has elapsed since their last
+        queued change, or held for longer than ORCHESTRATION_COALESCE_MAX_DELAY
+        """
+        now = now or timezone.now()
+        max_delay = settings.ORCHESTRATION_COALESCE_MAX_DELAY
+        groups = self.order_by().values_list('route_id', 'backend').annotate(
+            first=models.Min('created_at'), last=models.Max('created_at'))
+        ready = models.Q(pk__in=[])
+        for route_id, backend, first, last in groups:
+            try:
+                window = ServiceBackend.get_backend(backend).get_coalesce_window()
+            except KeyError:
+                window = 0
+            if (now-last).total_seconds() >= window or (now-first).total_seconds() >= max_delay:
+                ready |= models.Q(route_id=route_id, backend=backend)
+        return self.filter(ready)
+
+    def requeue_stale(self, now=None):
+        """ releases the operations claimed by dispatchers that have not completed them """
+        now = now or timezone.now()
+        timeout = datetime.timedelta(seconds=settings.ORCHESTRATION_QUEUE_CLAIM_TIMEOUT)
+        stale = self.filter(claimed_at__lt=now-timeout)
+        logs = stale.values_list('log_id', flat=True)
+        BackendLog.objects.filter(id__in=logs, state=BackendLog.RECEIVED).update(
+            state=BackendLog.QUEUED)
+        return stale.update(claimed_by='', claimed_at=None)
+
+    def claim(self, limit=None):
+        """
+        marks the oldest ready operations as claimed by this dispatcher and returns them,
+        they stay on the queue until complete() and are queued again by requeue_stale()
+        if the dispatcher does not complete them.
+        concurrent dispatchers skip the operations already claimed by others
+        """
+        now = timezone.now()
+        owner = '%s:%i:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        with transaction.atomic():
+            self.requeue_stale(now=now)
+            queryset = self.filter(claimed_at__isnull=True).ready(now=now).order_by('id')
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            else:
+                # Concurrent dispatchers wait for each other
+                queryset = queryset.select_for_update()
+            ids = queryset.values_list('id', flat=True)
+            if limit:
+                ids = ids[:limit]
+            ids = list(ids)
+            # Only unclaimed rows, backends without row locks may have selected the same ones
+            self.filter(id__in=ids, claimed_at__isnull=True).update(claimed_by=owner, claimed_at=now)
+            claimed = list(self.filter(claimed_by=owner).select_related(
+                'log', 'route__host', 'content_type').order_by('id'))
+            logs = set(queued.log_id for queued in claimed)
+            BackendLog.objects.filter(id__in=logs).update(state=BackendLog.RECEIVED)
+        return claimed
+
+    def complete(self, claimed):
+        """ removes executed operations from the queue """
+        return self.filter(id__in=[queued.id for queued in claimed]).delete()
+
+
+class QueuedOperation(models.Model):
+    """
+    Operation waiting to be executed out of the request/response cycle by the dispatcher
+    """
+    log = models.ForeignKey(BackendLog, related_name='queued_operations', on_delete=models.CASCADE)
+    route = models.ForeignKey('orchestration.Route', related_name='queued_operations',
+        on_delete=models.CASCADE)
+    backend = models.CharField(_("backend"), max_length=256)
+    action = models.CharField(_("action"), max_length=64)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField(null=True)
+    instance_repr = models.CharField(_("instance representation"), max_length=256)
+    instance_data = models.TextField(_("instance data"), blank=True,
+        help_text=_("Field values of deleted instances, as JSON. Other instances are loaded "
+                    "with their current state when dispatched."))
+    created_at = models.DateTimeField(_("created"), auto_now_add=True)
+    claimed_by = models.CharField(_("claimed by"), max_length=256, blank=True,
+        help_text=_("Dispatcher executing this operation, as host:pid:claim."))
+    claimed_at = models.DateTimeField(_("claimed"), null=True, blank=True, db_index=True)
+
+    objects = QueuedOperationQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return '%s.%s(%s)' % (self.backend, self.action, self.instance_repr)
+
+    @classmethod
+    def from_operation(cls, operation, route, log):
+        """ deleted objects are gone by the time of execution, their field values are kept """
+        instance = operation.instance
+        instance_data = ''
+        if operation.action == Operation.DELETE:
+            instance_data = json.dumps(cls.get_snapshot(instance), cls=DjangoJSONEncoder)
+        return cls(
+            log=log,
+            route=route,
+            backend=operation.backend.get_name(),
+            action=operation.action,
+            content_type=ContentType.objects.get_for_model(instance),
+            object_id=instance.pk,
+            instance_repr=force_str(instance)[:256],
+            instance_data=instance_data,
+        )
+
+    @classmethod
+    def get_snapshot(cls, instance, visited=None):
+        """
+        field values of instance and of its loaded related objects, e.g. by preload_context(),
+        related objects may be deleted in cascade as well
+        """
+        if visited is None:
+            visited = set()
+        visited.add(id(instance))
+        fields = [field.name for field in instance._meta.concrete_fields]
+        snapshot = serializers.serialize('python', [instance], fields=fields)[0]
+        snapshot['related'] = {
+            name: cls.get_snapshot(obj, visited)
+                for name, obj in instance._state.fields_cache.items()
+                    if isinstance(obj, models.Model) and id(obj) not in visited
+        }
+        return snapshot
+
+    @classmethod
+    def load_snapshot(cls, snapshot):
+        related = snapshot.pop('related')
+        # Fields removed since the operation was queued are ignored
+        instance = next(serializers.deserialize('python', [snapshot], ignorenonexistent=True)).object
+        instance._state.adding = False
+        for name, related_snapshot in related.items():
+            instance._state.fields_cache[name] = cls.load_snapshot(related_snapshot)
+        return instance
+
+    @cached_property
+    def backend_class(self):
+        return ServiceBackend.get_backend(self.backend)
+
+    def get_instance(self):
+        """ current state of the object, None when it has been deleted since it was queued """
+        if self.action == Operation.DELETE:
+            return self.load_snapshot(json.loads(self.instance_data))
+        model = self.content_type.model_class()
+        return model._base_manager.filter(pk=self.object_id).first()
+
+
+class ScriptFragmentQuerySet(models.QuerySet):
+    def get_digests(self, route_ids, object_ids):
+        """ {(route_id, content_type_id, object_id): digest} """
+        fragments = self.filter(route_id__in=route_ids, object_id__in=object_ids).values_list(
+            'route_id', 'content_type_id', 'object_id', 'digest')
+        return {
+            (route_id, content_type_id, object_id): digest
+                for route_id, content_type_id, object_id, digest in fragments
+        }
+
+    def forget(self, fragments):
+        query = models.Q(pk__in=[])
+        for fragment in fragments:
+            query |= models.Q(route_id=fragment.route_id, content_type_id=fragment.content_type_id,
+                object_id=fragment.object_id)
+        return self.filter(query).delete()
+
+    def store(self, fragments):
+        """ replaces the digests of the provided fragments, fragments without digest are forgotten """
+        with transaction.atomic():
+            self.forget(fragments)
+            return self.bulk_create([fragment for fragment in fragments if fragment.digest])
+
+
+class ScriptFragment(models.Model):
+    """
+    Digest of the last script fragment successfully applied for an object on a route,
+    operations generating the same fragment again are not executed.
+    """
+    route = models.ForeignKey('orchestration.Route', related_name='fragments',
+        on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    digest = models.CharField(_("digest"), max_length=64)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
+
+    objects = ScriptFragmentQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('route', 'content_type', 'object_id')
+
+    def __str__(self):
+        return '%s@%s-%s' % (self.route, self.content_type_id, self.object_id)
+
+
 autodiscover_modules('backends')
 
 
+@lru_cache(maxsize=1024)
+def compile_match(match):
+    """ route match expressions are compiled once per process, None for the default 'True' """
+    match = match.strip()
+    if match in ('', 'True'):
+        return None
+    return compile(match, '<route match>', 'eval')
+
+
+class RouteIndex(VersionedIndex):
+    """ process-wide index of active routes by (backend, action), invalidated by Route and Server changes """
+    version_key = 'orchestration.route_index.version'
+
+    def get_timeout(self):
+        return settings.ORCHESTRATION_ROUTE_INDEX_TIMEOUT
+
+    def build(self, queryset):
+        routes = {}
+        for route in queryset.filter(is_active=True).select_related('host'):
+            try:
+                backend_class = route.backend_class
+            except KeyError:
+                logger.warning("Backed '%s' not installed." % route.backend)
+            else:
+                for action in backend_class.get_actions():
+                    key = (route.backend, action)
+                    try:
+                        routes[key].append(route)
+                    except KeyError:
+                        routes[key] = [route]
+        return routes
+
+
+route_index = RouteIndex()
+
+
 class RouteQuerySet(models.QuerySet):
     def get_for_operation(self, operation, **kwargs):
-        cache = kwargs.get('cache', {})
+        """
+        cache: optional dict holding a consistent snapshot of the routes during a request
+        """
+        cache = kwargs.get('cache')
         if not cache:
-            for route in self.filter(is_active=True).select_related('host'):
-                try:
-                    backend_class = route.backend_class
-                except KeyError:
-                    logger.warning("Backed '%s' not installed." % route.backend)
-                else:
-                    for action in backend_class.get_actions():
-                        key = (route.backend, action)
-                        try:
-                            cache[key].append(route)
-                        except KeyError:
-                            cache[key] = [route]
+            if self.query.has_filters():
+                index = route_index.build(self)
+            else:
+                index = route_index.get(self)
+            if cache is None:
+                cache = index
+            else:
+                cache.update(index)
         routes = []
         backend_cls = operation.backend
         key = (backend_cls.get_name(), operation.action)
@@ -250,12 +535,15 @@ class Route(models.Model):
         return action in self.async_actions
 
     def matches(self, instance):
+        code = compile_match(self.match)
+        if code is None:
+            return True
         safe_locals = {
             'instance': instance,
             'obj': instance,
             instance._meta.model_name: instance,
         }
-        return eval(self.match, safe_locals)
+        return eval(code, safe_locals)
 
     def enable(self):
         self.is_active = True
@@ -264,3 +552,23 @@ class Route(models.Model):
     def disable(self):
         self.is_active = False
         self.save()
+
+
+post_save.connect(route_index.invalidate_receiver, sender=Route,
+    dispatch_uid='orchestration.route_index.route_save')
+post_delete.connect(route_index.invalidate_receiver, sender=Route,
+    dispatch_uid='orchestration.route_index.route_delete')
+post_save.connect(route_index.invalidate_receiver, sender=Server,
+    dispatch_uid='orchestration.route_index.server_save')
+post_delete.connect(route_index.invalidate_receiver, sender=Server,
+    dispatch_uid='orchestration.route_index.server_delete')
+
+
+@receiver(post_save, sender=Route, dispatch_uid='orchestration.script_fragments.route_save')
+@receiver(post_save, sender=Server, dispatch_uid='orchestration.script_fragments.server_save')
+def invalidate_script_fragments(sender, instance, **kwargs):
+    """ the target host may not have the configuration anymore """
+    if sender is Route:
+        ScriptFragment.objects.filter(route=instance).delete()
+    else:
+        ScriptFragment.objects.filter(route__host=instance).delete()
@@ -43,9 +43,138 @@ ORCHESTRATION_BACKEND_CLEANUP_DAYS = Setting('ORCHESTRATION_BACKEND_CLEANUP_DAYS
 
 ORCHESTRATION_SSH_METHOD_BACKEND = Setting('ORCHESTRATION_SSH_METHOD_BACKEND',
     'orchestra.contrib.orchestration.methods.OpenSSH',
-    help_text=_("Two methods are provided:<br>"
+    help_text=_("Three methods are provided:<br>"
                 "1) <tt>orchestra.contrib.orchestration.methods.OpenSSH</tt> with ControlPersist.<br>"
                 "2) <tt>orchestra.contrib.orchestration.methods.Paramiko</tt> with connection pool.<br>"
-                "Both perform similarly, but OpenSSH has the advantage that the connections are shared between workers. "
+                "3) <tt>orchestra.contrib.orchestration.methods.AsyncOpenSSH</tt> with ControlPersist, "
+                "driving all the executions of a worker from a single event loop.<br>"
+                "OpenSSH and Paramiko perform similarly, but OpenSSH has the advantage that the connections are shared between workers. "
                 "Paramiko, in contrast, has a per worker connection pool.")
 )
+
+
+ORCHESTRATION_MAX_WORKERS = Setting('ORCHESTRATION_MAX_WORKERS',
+    16,
+    help_text=_("Maximum number of backends executed concurrently by each process. "
+                "Every worker holds its own database connection while executing.")
+)
+
+
+ORCHESTRATION_MAX_WORKERS_PER_HOST = Setting('ORCHESTRATION_MAX_WORKERS_PER_HOST',
+    4,
+    help_text=_("Maximum number of backends executed concurrently on the same server, "
+                "<tt>0</tt> means unlimited.")
+)
+
+
+ORCHESTRATION_MAX_QUEUE_SIZE = Setting('ORCHESTRATION_MAX_QUEUE_SIZE',
+    256,
+    help_text=_("Maximum number of executions waiting for a free worker, further executions "
+                "block until there is room on the queue. <tt>0</tt> means unlimited.")
+)
+
+
+ORCHESTRATION_SSH_POOL_MAX_CHANNELS = Setting('ORCHESTRATION_SSH_POOL_MAX_CHANNELS',
+    10,
+    help_text=_("Maximum number of concurrent sessions multiplexed over a single SSH connection, "
+                "it should not exceed sshd <tt>MaxSessions</tt>.")
+)
+
+
+ORCHESTRATION_SSH_POOL_MAX_CONNECTIONS = Setting('ORCHESTRATION_SSH_POOL_MAX_CONNECTIONS',
+    2,
+    help_text=_("Maximum number of pooled Paramiko connections per server. "
+                "OpenSSH uses a single ControlMaster connection per server.")
+)
+
+
+ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT = Setting('ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT',
+    300,
+    help_text=_("Seconds before closing an unused pooled SSH connection.")
+)
+
+
+ORCHESTRATION_SSH_POOL_CHECK_INTERVAL = Setting('ORCHESTRATION_SSH_POOL_CHECK_INTERVAL',
+    60,
+    help_text=_("Idle seconds after which pooled SSH connections are health-checked before reuse.")
+)
+
+
+ORCHESTRATION_LOG_FLUSH_SIZE = Setting('ORCHESTRATION_LOG_FLUSH_SIZE',
+    4096,
+    help_text=_("Buffered characters of backend output before storing a new log chunk.")
+)
+
+
+ORCHESTRATION_LOG_FLUSH_INTERVAL = Setting('ORCHESTRATION_LOG_FLUSH_INTERVAL',
+    1,
+    help_text=_("Seconds between log chunk stores of running backends.")
+)
+
+
+ORCHESTRATION_ROUTE_INDEX_TIMEOUT = Setting('ORCHESTRATION_ROUTE_INDEX_TIMEOUT',
+    60,
+    help_text=_("Seconds before rebuilding the process-wide route index. Route changes invalidate "
+                "it right away on the current process, and on other processes when the default "
+                "cache backend is shared between them.")
+)
+
+
+ORCHESTRATION_ASYNC_MAX_EXECUTIONS = Setting('ORCHESTRATION_ASYNC_MAX_EXECUTIONS',
+    1024,
+    help_text=_("Maximum number of backends executed concurrently by the event loop of each process "
+                "when using <tt>orchestra.contrib.orchestration.methods.AsyncOpenSSH</tt>.")
+)
+
+
+ORCHESTRATION_QUEUE_OPERATIONS = Setting('ORCHESTRATION_QUEUE_OPERATIONS',
+    False,
+    help_text=_("Store the operations of each request on the database instead of executing them "
+                "within the request/response cycle. Queued operations are executed by "
+                "<tt>python manage.py dispatchoperations</tt>, which should be kept running.")
+)
+
+
+ORCHESTRATION_QUEUE_BATCH_SIZE = Setting('ORCHESTRATION_QUEUE_BATCH_SIZE',
+    1000,
+    help_text=_("Maximum number of queued operations coalesced and executed by each dispatcher iteration.")
+)
+
+
+ORCHESTRATION_QUEUE_POLL_INTERVAL = Setting('ORCHESTRATION_QUEUE_POLL_INTERVAL',
+    1,
+    help_text=_("Seconds the dispatcher waits before checking again an empty queue.")
+)
+
+
+ORCHESTRATION_QUEUE_CLAIM_TIMEOUT = Setting('ORCHESTRATION_QUEUE_CLAIM_TIMEOUT',
+    3600,
+    help_text=_("Seconds after which operations claimed by a dispatcher that has not completed "
+                "them, e.g. because it crashed or was restarted, are queued again. "
+                "Should be longer than the slowest backend execution.")
+)
+
+
+ORCHESTRATION_COALESCE_WINDOWS = Setting('ORCHESTRATION_COALESCE_WINDOWS',
+    {},
+    help_text=_("Overrides the coalescing window of queued operations per backend, "
+                "e.g. <tt>{'Bind9MasterDomainController': 10}</tt>. The dispatcher holds the "
+                "operations of a route until no changes have been queued for that many seconds, "
+                "reloading the service once per window. "
+                "Only used when <tt>ORCHESTRATION_QUEUE_OPERATIONS</tt> is enabled.")
+)
+
+
+ORCHESTRATION_COALESCE_MAX_DELAY = Setting('ORCHESTRATION_COALESCE_MAX_DELAY',
+    30,
+    help_text=_("Maximum seconds a queued operation is held by coalescing windows, "
+                "caps the latency of routes receiving changes continuously.")
+)
+
+
+ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS = Setting('ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS',
+    False,
+    help_text=_("Do not execute save operations generating the same script that was last successfully "
+                "applied for the object on that route, the backend log is marked as NOTHING. "
+                "Use <tt>orchestrate --force</tt> for re-applying them, e.g. after manual changes on the servers.")
+)
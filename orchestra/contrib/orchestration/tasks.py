@@ -6,7 +6,7 @@ from django.utils import timezone
 from orchestra.contrib.tasks import periodic_task
 
 from . import settings
-from .models import BackendLog
+from .models import BackendLog, BackendLogChunk
 
 
 @periodic_task(run_every=crontab(hour=7, minute=0))
@@ -14,3 +14,10 @@ def backend_logs_cleanup():
     days = settings.ORCHESTRATION_BACKEND_CLEANUP_DAYS
     epoch = timezone.now()-timedelta(days=days)
     return BackendLog.objects.filter(created_at__lt=epoch).only('id').delete()
+
+
+@periodic_task(run_every=crontab(hour=7, minute=30))
+def backend_log_chunks_cleanup():
+    """ output of finished logs is already stored on the log itself """
+    unfinished = (BackendLog.STARTED, BackendLog.RECEIVED)
+    return BackendLogChunk.objects.exclude(log__state__in=unfinished).only('id').delete()
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from ..connections import Connection, ConnectionPool
+
+
+class FakeConnection(Connection):
+    def connect(self):
+        self.active = True
+        self.closed = False
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_reuse(self):
+        pool = ConnectionPool(FakeConnection, max_channels=2, max_connections=2)
+        with pool.checkout('web.example.com') as conn1:
+            pass
+        with pool.checkout('web.example.com') as conn2:
+            pass
+        self.assertIs(conn1, conn2)
+        with pool.checkout('web1.example.com') as conn3:
+            pass
+        self.assertIsNot(conn1, conn3)
+
+    def test_max_channels(self):
+        pool = ConnectionPool(FakeConnection, max_channels=2, max_connections=2)
+        conns = [pool.acquire('web.example.com') for ix in range(4)]
+        self.assertEqual(2, len(set(conns)))
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire('web.example.com')))
+        thread.start()
+        thread.join(0.1)
+        # All channels are in use
+        self.assertEqual([], acquired)
+        pool.release(conns[0])
+        thread.join(1)
+        self.assertEqual([conns[0]], acquired)
+
+    def test_idle_eviction(self):
+        pool = ConnectionPool(FakeConnection, idle_timeout=0.01)
+        with pool.checkout('web.example.com') as conn1:
+            pass
+        time.sleep(0.02)
+        with pool.checkout('web.example.com') as conn2:
+            pass
+        self.assertTrue(conn1.closed)
+        self.assertIsNot(conn1, conn2)
+
+    def test_health_check(self):
+        pool = ConnectionPool(FakeConnection, check_interval=0)
+        with pool.checkout('web.example.com') as conn1:
+            pass
+        conn1.active = False
+        with pool.checkout('web.example.com') as conn2:
+            pass
+        self.assertTrue(conn1.closed)
+        self.assertIsNot(conn1, conn2)
+
+    def test_broken_connection(self):
+        pool = ConnectionPool(FakeConnection)
+        with self.assertRaises(EOFError):
+            with pool.checkout('web.example.com') as conn1:
+                conn1.active = False
+                raise EOFError
+        self.assertTrue(conn1.closed)
+        self.assertEqual([], pool.connections['web.example.com'])
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from ..executors import AsyncioExecutor, BackendExecutor, run_sync
+
+
+class BackendExecutorTests(SimpleTestCase):
+    def test_per_host_limit(self):
+        executor = BackendExecutor(8, max_per_host=2)
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def execute(host):
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peaks[host] = max(peaks.get(host, 0), running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+
+        tasks = [executor.submit(execute, host, host) for host in (1, 2)*6]
+        [task.join() for task in tasks]
+        self.assertEqual({1: 2, 2: 2}, peaks)
+        metrics = executor.get_metrics()
+        self.assertEqual(12, metrics['executed'])
+        self.assertEqual(0, metrics['queued'])
+        self.assertLessEqual(metrics['workers'], 8)
+
+    def test_backpressure(self):
+        executor = BackendExecutor(1, max_queue=2)
+        release = threading.Event()
+        tasks = [executor.submit(release.wait, 1) for ix in range(3)]
+        submitted = threading.Event()
+
+        def submit():
+            tasks.append(executor.submit(release.wait, 1))
+            submitted.set()
+
+        threading.Thread(target=submit).start()
+        # One running and two queued tasks, the producer should be blocked
+        self.assertFalse(submitted.wait(0.1))
+        release.set()
+        self.assertTrue(submitted.wait(1))
+        [task.join() for task in tasks]
+        self.assertEqual(2, executor.get_metrics()['max_queued'])
+
+    def test_nested_submit(self):
+        executor = BackendExecutor(1)
+        result = []
+
+        def outer():
+            executor.submit(result.append, 1, 'inner').join()
+            result.append('outer')
+
+        self.assertTrue(executor.submit(outer, 1).join(1))
+        self.assertEqual(['inner', 'outer'], result)
+
+    def test_burst(self):
+        executor = BackendExecutor(4)
+        executor.submit(time.sleep, 1, 0).join()
+        # Wait for the worker to become idle
+        time.sleep(0.05)
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def execute():
+            started.release()
+            release.wait()
+
+        tasks = [executor.submit(execute, host) for host in range(4)]
+        try:
+            for task in tasks:
+                self.assertTrue(started.acquire(timeout=1))
+        finally:
+            release.set()
+        [task.join() for task in tasks]
+        self.assertEqual(4, executor.get_metrics()['workers'])
+        # Pending executions are not lost when the process exits
+        self.assertFalse(any(worker.daemon for worker in executor.workers))
+
+
+class AsyncioExecutorTests(SimpleTestCase):
+    def test_per_host_limit(self):
+        executor = AsyncioExecutor(2, max_per_host=1)
+        started = []
+        release = threading.Event()
+
+        async def execute(host):
+            started.append(host)
+            await executor.loop.run_in_executor(None, release.wait, 1)
+
+        tasks = [executor.submit(execute, 1, 1) for ix in range(3)]
+        tasks.append(executor.submit(execute, 2, 2))
+        # Tasks waiting on a busy host do not take the global slot of other hosts
+        deadline = time.monotonic() + 1
+        while len(started) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([1, 2], started)
+        release.set()
+        [task.join(1) for task in tasks]
+        self.assertEqual([1, 2, 1, 1], started)
+
+    def test_run_sync(self):
+        executor = AsyncioExecutor(1)
+        threads = []
+
+        async def execute():
+            threads.append(threading.current_thread())
+            threads.append(await run_sync(threading.current_thread))
+
+        executor.submit(execute, 1).join(1)
+        self.assertIs(executor.thread, threads[0])
+        # Blocking work is not performed by the event loop thread
+        self.assertIsNot(executor.thread, threads[1])
@@ -0,0 +1,54 @@
+from unittest import mock
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, methods, settings, Operation
+from ..models import BackendLog, Route, ScriptFragment, Server
+
+
+class FragmentTestBackend(backends.ServiceController):
+    verbose_name = 'Fragment test'
+    model = 'orchestration.Server'
+    actions = ('save', 'delete')
+    script_method = methods.Record
+    # Executed on the test thread for sharing its database connection
+    serialize = True
+
+    def save(self, server):
+        self.append('echo save %s' % server.name)
+
+    def delete(self, server):
+        self.append('echo delete %s' % server.name)
+
+
+@mock.patch.object(settings, 'ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS', True)
+class ScriptFragmentTests(BaseTestCase):
+    def setUp(self):
+        self.host = Server.objects.create(name='web.example.com')
+        self.route = Route.objects.create(backend=FragmentTestBackend.get_name(), host=self.host)
+        self.server = Server.objects.create(name='dns.example.com')
+        del methods.recorded_scripts[:]
+
+    def execute(self, action=Operation.SAVE, force=False):
+        operation = Operation(FragmentTestBackend, self.server, action, routes=[self.route])
+        log, = Operation.execute([operation], force=force)
+        return log
+
+    def test_skip_unchanged(self):
+        self.assertEqual(BackendLog.SUCCESS, self.execute().state)
+        self.assertEqual(1, ScriptFragment.objects.filter(route=self.route).count())
+        self.assertEqual(BackendLog.NOTHING, self.execute().state)
+        self.assertEqual(1, len(methods.recorded_scripts))
+        self.server.name = 'ns.example.com'
+        self.assertEqual(BackendLog.SUCCESS, self.execute().state)
+        self.assertEqual(2, len(methods.recorded_scripts))
+
+    def test_force(self):
+        self.execute()
+        self.assertEqual(BackendLog.SUCCESS, self.execute(force=True).state)
+        self.assertEqual(2, len(methods.recorded_scripts))
+
+    def test_delete(self):
+        self.execute()
+        self.assertEqual(BackendLog.SUCCESS, self.execute(Operation.DELETE).state)
+        self.assertFalse(ScriptFragment.objects.filter(route=self.route).exists())
@@ -0,0 +1,64 @@
+import asyncio
+from unittest import mock
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import executors, methods
+from ..models import BackendLog, Server
+
+
+def local_bash(*args, **kwargs):
+    """ local stand-in for the remote ssh command """
+    return 'bash'
+
+
+async def run_inline(func, *args, **kwargs):
+    """ run_sync() sharing the database connection of the test transaction """
+    return func(*args, **kwargs)
+
+
+@mock.patch.object(methods, 'get_ssh_command', local_bash)
+@mock.patch.object(executors, 'run_sync', run_inline)
+class AsyncOpenSSHTests(BaseTestCase):
+    def setUp(self):
+        self.host = Server.objects.create(name='web.example.com')
+        self.backend = mock.Mock(script_executable='/bin/bash')
+
+    def execute(self, cmds, run_async=False):
+        log = BackendLog.objects.create(backend='TestBackend', server=self.host)
+        # Executed on the test thread for sharing its database connection
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(methods.async_openssh(self.backend, log, self.host, cmds, run_async))
+        finally:
+            loop.close()
+        return BackendLog.objects.get(pk=log.pk)
+
+    def test_success(self):
+        log = self.execute(['echo hola', 'echo adeu >&2'])
+        self.assertEqual(BackendLog.SUCCESS, log.state)
+        self.assertEqual(0, log.exit_code)
+        self.assertEqual('hola\n', log.stdout)
+        self.assertEqual('adeu\n', log.stderr)
+
+    def test_failure(self):
+        log = self.execute(['echo hola', 'exit 3'])
+        self.assertEqual(BackendLog.FAILURE, log.state)
+        self.assertEqual(3, log.exit_code)
+
+    def test_run_async(self):
+        log = self.execute(['for i in $(seq 3); do echo $i; done'], run_async=True)
+        self.assertEqual(BackendLog.SUCCESS, log.state)
+        self.assertEqual('1\n2\n3\n', log.stdout)
+        self.assertEqual('1\n2\n3\n', ''.join(log.chunks.filter(stream='stdout').values_list('content', flat=True)))
+
+
+class RecordTests(BaseTestCase):
+    def test_record(self):
+        host = Server.objects.create(name='web.example.com', address='10.0.0.1')
+        backend = mock.Mock(**{'get_name.return_value': 'TestBackend'})
+        log = BackendLog.objects.create(backend='TestBackend', server=host)
+        del methods.recorded_scripts[:]
+        methods.Record(backend, log, host, ['echo hola'])
+        self.assertEqual(BackendLog.SUCCESS, log.state)
+        self.assertEqual([('TestBackend', '10.0.0.1', 'echo hola')], methods.recorded_scripts)
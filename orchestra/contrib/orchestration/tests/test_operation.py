@@ -0,0 +1,30 @@
+from orchestra.utils.python import OrderedSet
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, Operation
+from ..models import Server
+
+
+class OperationTests(BaseTestCase):
+    def setUp(self):
+        self.host = Server.objects.create(name='web.example.com')
+
+    def test_identity(self):
+        backend = backends.ServiceController
+        operations = OrderedSet()
+        operations.add(Operation(backend, self.host, Operation.SAVE))
+        self.assertIn(Operation(backend, self.host, Operation.SAVE), operations)
+        self.assertIn(Operation.get_key(backend, self.host, Operation.SAVE), operations)
+        self.assertNotIn(Operation.get_key(backend, self.host, Operation.DELETE), operations)
+        operations.discard(Operation.get_key(backend, self.host, Operation.SAVE))
+        self.assertEqual(0, len(operations))
+
+    def test_instances(self):
+        backend = backends.ServiceController
+        operation = Operation(backend, self.host, Operation.SAVE)
+        self.assertIs(self.host, operation.instance)
+        operation = Operation(backend, self.host, Operation.DELETE)
+        self.assertIsNot(self.host, operation.instance)
+        pk = self.host.pk
+        self.host.delete()
+        self.assertEqual(pk, operation.instance.pk)
@@ -0,0 +1,158 @@
+import json
+from datetime import timedelta
+from unittest import mock
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, manager, methods, settings, Operation
+from ..models import BackendLog, QueuedOperation, Route, Server
+
+
+class QueueTestBackend(backends.ServiceController):
+    verbose_name = 'Queue test'
+    model = 'orchestration.Server'
+    actions = ('save', 'delete')
+    script_method = methods.Record
+    # Executed on the test thread for sharing its database connection
+    serialize = True
+
+    def save(self, server):
+        self.append('echo save %s' % server.name)
+
+    def delete(self, server):
+        self.append('echo delete %s' % server.name)
+
+
+class QueueTests(BaseTestCase):
+    def setUp(self):
+        self.host = Server.objects.create(name='web.example.com')
+        self.route = Route.objects.create(backend=QueueTestBackend.get_name(), host=self.host)
+        self.server = Server.objects.create(name='dns.example.com')
+        del methods.recorded_scripts[:]
+
+    def enqueue(self, instance, action):
+        operation = Operation(QueueTestBackend, instance, action, routes=[self.route])
+        return manager.enqueue([operation])
+
+    def test_enqueue(self):
+        log, = self.enqueue(self.server, Operation.SAVE)
+        self.assertEqual(BackendLog.QUEUED, log.state)
+        self.assertFalse(log.has_finished)
+        queued = QueuedOperation.objects.get()
+        self.assertEqual(log, queued.log)
+        self.assertEqual(self.server, queued.get_instance())
+
+    def test_coalesce(self):
+        log1, = self.enqueue(self.server, Operation.SAVE)
+        self.server.name = 'ns.example.com'
+        self.server.save()
+        log2, = self.enqueue(self.server, Operation.SAVE)
+        manager.dispatch()
+        self.assertEqual(0, QueuedOperation.objects.count())
+        # Executed once with the last state
+        self.assertEqual(1, len(methods.recorded_scripts))
+        self.assertIn('echo save ns.example.com', methods.recorded_scripts[0][2])
+        for log in (log1, log2):
+            log = BackendLog.objects.get(pk=log.pk)
+            self.assertEqual(BackendLog.SUCCESS, log.state)
+        self.assertEqual(1, BackendLog.objects.get(pk=log1.pk).operations.count())
+
+    def test_delete(self):
+        self.enqueue(self.server, Operation.SAVE)
+        log, = self.enqueue(self.server, Operation.DELETE)
+        self.server.delete()
+        manager.dispatch()
+        self.assertEqual(1, len(methods.recorded_scripts))
+        self.assertIn('echo delete dns.example.com', methods.recorded_scripts[0][2])
+
+    def test_deleted_since(self):
+        log, = self.enqueue(self.server, Operation.SAVE)
+        Server.objects.filter(pk=self.server.pk).delete()
+        manager.dispatch()
+        self.assertEqual([], methods.recorded_scripts)
+        self.assertEqual(BackendLog.NOTHING, BackendLog.objects.get(pk=log.pk).state)
+
+    def test_snapshot(self):
+        # Related objects loaded before deleting are kept, e.g. by preload_context()
+        route = Route.objects.select_related('host').get(pk=self.route.pk)
+        snapshot = QueuedOperation.get_snapshot(route)
+        snapshot = json.loads(json.dumps(snapshot, cls=DjangoJSONEncoder))
+        with self.assertNumQueries(0):
+            loaded = QueuedOperation.load_snapshot(snapshot)
+            self.assertEqual(self.route.pk, loaded.pk)
+            self.assertEqual(self.route.backend, loaded.backend)
+            self.assertEqual('web.example.com', loaded.host.name)
+
+    def test_failing_load(self):
+        failing = Server.objects.create(name='mail.example.com')
+        failing_log, = self.enqueue(failing, Operation.SAVE)
+        log, = self.enqueue(self.server, Operation.SAVE)
+        get_instance = QueuedOperation.get_instance
+
+        def failing_get_instance(queued):
+            if queued.object_id == failing.pk:
+                raise ValueError("Unloadable")
+            return get_instance(queued)
+
+        with mock.patch.object(QueuedOperation, 'get_instance', failing_get_instance):
+            manager.dispatch()
+        self.assertEqual(0, QueuedOperation.objects.count())
+        failing_log = BackendLog.objects.get(pk=failing_log.pk)
+        self.assertEqual(BackendLog.ERROR, failing_log.state)
+        self.assertIn('ValueError: Unloadable', failing_log.traceback)
+        log = BackendLog.objects.get(pk=log.pk)
+        self.assertEqual(BackendLog.SUCCESS, log.state)
+        self.assertNotIn('Coalesced', log.stdout)
+        self.assertEqual(1, len(methods.recorded_scripts))
+        self.assertIn('echo save dns.example.com', methods.recorded_scripts[0][2])
+
+    def test_failing_batch(self):
+        log, = self.enqueue(self.server, Operation.SAVE)
+        with mock.patch.object(manager, 'generate', side_effect=ValueError("Failed")):
+            manager.dispatch()
+        # Not claimed again by the next dispatcher
+        self.assertEqual(0, QueuedOperation.objects.count())
+        log = BackendLog.objects.get(pk=log.pk)
+        self.assertEqual(BackendLog.ERROR, log.state)
+        self.assertIn('ValueError: Failed', log.traceback)
+
+    def test_coalesce_window(self):
+        QueueTestBackend.coalesce_window = 60
+        try:
+            self.enqueue(self.server, Operation.SAVE)
+            self.assertEqual([], manager.dispatch())
+            self.assertEqual(1, QueuedOperation.objects.count())
+            # Window elapsed since the last change
+            past = timezone.now()-timedelta(seconds=61)
+            QueuedOperation.objects.update(created_at=past)
+            self.assertEqual(1, len(manager.dispatch()))
+        finally:
+            QueueTestBackend.coalesce_window = 0
+        self.assertEqual(0, QueuedOperation.objects.count())
+
+    def test_claim(self):
+        log, = self.enqueue(self.server, Operation.SAVE)
+        claimed = QueuedOperation.objects.claim()
+        self.assertEqual(1, len(claimed))
+        self.assertEqual(BackendLog.RECEIVED, BackendLog.objects.get(pk=log.pk).state)
+        # Claimed operations are kept on the queue until completed, but not claimed twice
+        self.assertEqual(1, QueuedOperation.objects.count())
+        self.assertEqual([], QueuedOperation.objects.claim())
+        QueuedOperation.objects.complete(claimed)
+        self.assertEqual(0, QueuedOperation.objects.count())
+
+    def test_requeue_stale(self):
+        log, = self.enqueue(self.server, Operation.SAVE)
+        # The dispatcher crashes before completing its claim
+        QueuedOperation.objects.claim()
+        timeout = settings.ORCHESTRATION_QUEUE_CLAIM_TIMEOUT
+        past = timezone.now()-timedelta(seconds=timeout+1)
+        QueuedOperation.objects.update(claimed_at=past)
+        self.assertEqual(1, QueuedOperation.objects.requeue_stale())
+        self.assertEqual(BackendLog.QUEUED, BackendLog.objects.get(pk=log.pk).state)
+        manager.dispatch()
+        self.assertEqual(0, QueuedOperation.objects.count())
+        self.assertEqual(BackendLog.SUCCESS, BackendLog.objects.get(pk=log.pk).state)
@@ -1,7 +1,7 @@
 from orchestra.utils.tests import BaseTestCase
 
 from .. import backends, Operation
-from ..models import Route, Server
+from ..models import Route, Server, compile_match
 
 
 class RouterTests(BaseTestCase):
@@ -39,3 +39,12 @@ class RouterTests(BaseTestCase):
         route = Route.objects.create(backend=backend, host=self.host2,
                 match='route.backend == "something else"')
         self.assertEqual(2, len(Route.objects.get_for_operation(operation)))
+    
+    def test_compiled_match(self):
+        route = Route(host=self.host, match='True')
+        self.assertIsNone(compile_match(route.match))
+        self.assertTrue(route.matches(self.host))
+        route.match = 'server.name == "web.example.com"'
+        self.assertIs(compile_match(route.match), compile_match(route.match))
+        self.assertTrue(route.matches(self.host))
+        self.assertFalse(route.matches(self.host1))
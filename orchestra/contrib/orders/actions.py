@@ -1,5 +1,4 @@
 from django.contrib import admin, messages
-from django.urls import reverse
 from django.db import transaction
 from django.utils import timezone
 from django.utils.safestring import mark_safe
@@ -81,26 +80,12 @@ class BillSelectedOrders(object):
     def confirmation(self, request):
         form = BillSelectConfirmationForm(initial=self.options)
         if int(request.POST.get('step')) >= 3:
-            bills = self.queryset.bill(commit=True, **self.options)
-            for order in self.queryset:
-                self.modeladmin.log_change(request, order, _("Billed"))
-            if not bills:
-                msg = _("Selected orders do not have pending billing")
-                self.modeladmin.message_user(request, msg, messages.WARNING)
-            else:
-                num = len(bills)
-                if num == 1:
-                    url = change_url(bills[0])
-                else:
-                    url = reverse('admin:bills_bill_changelist')
-                    ids = ','.join([str(b.id) for b in bills])
-                    url += '?id__in=%s' % ids
-                msg = ngettext(
-                    '<a href="{url}">One bill</a> has been created.',
-                    '<a href="{url}">{num} bills</a> have been created.',
-                    num).format(url=url, num=num)
-                msg = mark_safe(msg)
-                self.modeladmin.message_user(request, msg, messages.INFO)
+            # Billed on the background, sharded by account
+            # Orders are logged as billed by the run, on behalf of the user
+            run = self.queryset.bill_run(created_by=request.user, **self.options)
+            msg = _('<a href="{url}">{run}</a> has been started, '
+                    'bills are being created on the background.').format(url=change_url(run), run=run)
+            self.modeladmin.message_user(request, mark_safe(msg), messages.INFO)
             return
         bills = self.queryset.bill(commit=False, **self.options)
         bills_with_total = []
@@ -147,6 +132,23 @@ def mark_as_not_ignored(modeladmin, request, queryset):
     modeladmin.message_user(request, msg)
 
 
+@transaction.atomic
+def resume_billing_runs(modeladmin, request, queryset):
+    """ Bills the pending and failed accounts of the selected billing runs """
+    num = 0
+    for run in queryset.exclude(state=queryset.model.SUCCESS):
+        transaction.on_commit(run.start)
+        modeladmin.log_change(request, run, 'Resumed')
+        num += 1
+    msg = ngettext(
+        _("One billing run has been resumed."),
+        _("%i billing runs have been resumed.") % num,
+        num)
+    modeladmin.message_user(request, msg)
+resume_billing_runs.short_description = _("Resume")
+resume_billing_runs.url_name = 'resume'
+
+
 def report(modeladmin, request, queryset):
     services = {}
     totals = [0, 0, None, 0]
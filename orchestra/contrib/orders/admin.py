@@ -4,19 +4,30 @@ from django.contrib import admin
 from django.urls import reverse, NoReverseMatch
 from django.db.models import Prefetch
 from django.utils import timezone
-from django.utils.html import escape, format_html
+from django.utils.html import escape, format_html, format_html_join
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
 from orchestra.admin import ExtendedModelAdmin
-from orchestra.admin.utils import admin_link, admin_date, change_url
+from orchestra.admin.options import ChangeViewActionsMixin
+from orchestra.admin.utils import admin_link, admin_date, admin_colored, change_url
 from orchestra.contrib.accounts.actions import list_accounts
 from orchestra.contrib.accounts.admin import AccountAdminMixin
 from orchestra.utils.humanize import naturaldate
 
-from .actions import BillSelectedOrders, mark_as_ignored, mark_as_not_ignored, report
+from .actions import (BillSelectedOrders, mark_as_ignored, mark_as_not_ignored, report,
+    resume_billing_runs)
 from .filters import IgnoreOrderListFilter, ActiveOrderListFilter, BilledOrderListFilter
-from .models import Order, MetricStorage
+from .models import Order, MetricStorage, BillingRun, BillingRunAccount
+
+
+STATE_COLORS = {
+    BillingRun.RECEIVED: 'darkorange',
+    BillingRun.STARTED: 'blue',
+    BillingRun.SUCCESS: 'green',
+    BillingRun.FAILURE: 'red',
+    BillingRunAccount.PENDING: 'grey',
+}
 
 
 class MetricStorageInline(admin.TabularInline):
@@ -203,5 +214,69 @@ class MetricStorageAdmin(admin.ModelAdmin):
     raw_id_fields = ('order',)
 
 
+class BillingRunAccountInline(admin.TabularInline):
+    model = BillingRunAccount
+    fields = ('account_link', 'display_state', 'display_bills', 'display_traceback', 'updated_at')
+    readonly_fields = fields
+    extra = 0
+
+    account_link = admin_link('account')
+    display_state = admin_colored('state', colors=STATE_COLORS)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def display_bills(self, checkpoint):
+        return format_html_join(', ', '<a href="{}">{}</a>', (
+            (change_url(bill), bill.number) for bill in checkpoint.bills.all()
+        ))
+    display_bills.short_description = _("Bills")
+
+    def display_traceback(self, checkpoint):
+        return format_html('<pre>{}</pre>', checkpoint.traceback) if checkpoint.traceback else ''
+    display_traceback.short_description = _("Traceback")
+
+    def get_queryset(self, request):
+        qs = super(BillingRunAccountInline, self).get_queryset(request)
+        return qs.select_related('account').prefetch_related('bills')
+
+
+class BillingRunAdmin(ChangeViewActionsMixin, admin.ModelAdmin):
+    list_display = (
+        'id', 'display_state', 'display_progress', 'billing_point', 'proforma', 'display_created',
+        'display_updated',
+    )
+    list_filter = ('state', 'proforma')
+    date_hierarchy = 'created_at'
+    inlines = (BillingRunAccountInline,)
+    fields = (
+        'display_state', 'display_progress', 'billing_point', 'fixed_point', 'proforma',
+        'new_open', 'created_by', 'display_created', 'display_updated',
+    )
+    readonly_fields = fields
+    actions = (resume_billing_runs,)
+    change_view_actions = actions
+
+    display_state = admin_colored('state', colors=STATE_COLORS)
+    display_created = admin_date('created_at', short_description=_("Created"))
+    display_updated = admin_date('updated_at', short_description=_("Updated"))
+
+    def display_progress(self, run):
+        progress = run.get_progress()
+        total = sum(progress.values())
+        billed = progress.get(BillingRunAccount.SUCCESS, 0)
+        failed = progress.get(BillingRunAccount.FAILURE, 0)
+        return _("%(billed)i of %(total)i accounts billed, %(failed)i failed") % {
+            'billed': billed,
+            'total': total,
+            'failed': failed,
+        }
+    display_progress.short_description = _("Progress")
+
+    def has_add_permission(self, *args, **kwargs):
+        return False
+
+
 admin.site.register(Order, OrderAdmin)
 admin.site.register(MetricStorage, MetricStorageAdmin)
+admin.site.register(BillingRun, BillingRunAdmin)
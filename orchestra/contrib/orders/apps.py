@@ -1,6 +1,6 @@
 from django.apps import AppConfig
 
-from orchestra.core import accounts
+from orchestra.core import accounts, administration
 
 
 class OrdersConfig(AppConfig):
@@ -8,6 +8,7 @@ class OrdersConfig(AppConfig):
     verbose_name = 'Orders'
     
     def ready(self):
-        from .models import Order
+        from .models import Order, BillingRun
         accounts.register(Order, icon='basket.png', search=False)
+        administration.register(BillingRun, icon='invoice.png', search=False)
         from . import signals
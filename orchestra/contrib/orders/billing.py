@@ -1,10 +1,18 @@
+from django.db import connections, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from orchestra.contrib.bills.models import Invoice, Fee, ProForma
+from orchestra.contrib.bills.models import (Bill, Invoice, Fee, ProForma, BillLine, BillSubline,
+    deferred_totals)
 
 
 class BillsBackend(object):
     def create_bills(self, account, lines, **options):
+        # Totals of each bill are updated once all its lines are created
+        with deferred_totals():
+            return self._create_bills(account, lines, **options)
+    
+    def _create_bills(self, account, lines, **options):
         bill = None
         ant_bill = None
         bills = []
@@ -18,14 +26,7 @@ class BillsBackend(object):
             # Create bill if needed
             if proforma:
                 if ant_bill is None:
-                    if create_new:
-                        bill = ProForma.objects.create(account=account)
-                    else:
-                        bill = ProForma.objects.filter(account=account, is_open=True).last()
-                        if bill:
-                            bill.updated()
-                        else:
-                            bill = ProForma.objects.create(account=account, is_open=True)
+                    bill = self.get_open_bill(ProForma, account, create_new)
                     bills.append(bill)
                 else:
                     bill = ant_bill
@@ -35,35 +36,48 @@ class BillsBackend(object):
                 bills.append(bill)
             else:
                 if ant_bill is None:
-                    if create_new:
-                        bill = Invoice.objects.create(account=account)
-                    else:
-                        bill = Invoice.objects.filter(account=account, is_open=True).last()
-                        if bill:
-                            bill.updated()
-                        else:
-                            bill = Invoice.objects.create(account=account, is_open=True)
+                    bill = self.get_open_bill(Invoice, account, create_new)
                     bills.append(bill)
                 else:
                     bill = ant_bill
                 ant_bill = bill
             # Create bill line
-            billine = bill.lines.create(
-                rate=service.nominal_price,
-                quantity=line.metric*line.size,
-                verbose_quantity=self.get_verbose_quantity(line),
-                subtotal=line.subtotal,
-                tax=service.tax,
-                description=self.get_line_description(line),
-                start_on=line.ini,
-                end_on=line.end if service.billing_period != service.NEVER else None,
-                order=line.order,
-                order_billed_on=line.order.old_billed_on,
-                order_billed_until=line.order.old_billed_until
-            )
+            billine = self.create_line(bill, line)
             self.create_sublines(billine, line.discounts)
         return bills
     
+    def get_open_bill(self, bill_class, account, create_new):
+        if create_new:
+            return bill_class.objects.create(account=account)
+        bill = bill_class.objects.filter(account=account, is_open=True).last()
+        if bill:
+            bill.updated()
+        else:
+            bill = bill_class.objects.create(account=account, is_open=True)
+        return bill
+    
+    def get_line(self, bill, line):
+        service = line.order.service
+        return BillLine(
+            bill=bill,
+            rate=service.nominal_price,
+            quantity=line.metric*line.size,
+            verbose_quantity=self.get_verbose_quantity(line),
+            subtotal=line.subtotal,
+            tax=service.tax,
+            description=self.get_line_description(line),
+            start_on=line.ini,
+            end_on=line.end if service.billing_period != service.NEVER else None,
+            order=line.order,
+            order_billed_on=line.order.old_billed_on,
+            order_billed_until=line.order.old_billed_until
+        )
+    
+    def create_line(self, bill, line):
+        billine = self.get_line(bill, line)
+        billine.save()
+        return billine
+    
 #    def format_period(self, ini, end):
 #        ini = ini.strftime("%b, %Y")
 #        end = (end-datetime.timedelta(seconds=1)).strftime("%b, %Y")
@@ -87,10 +101,82 @@ class BillsBackend(object):
             return metric
         return "%s&times;%s" % (metric, size)
     
-    def create_sublines(self, line, discounts):
-        for discount in discounts:
-            line.sublines.create(
+    def get_sublines(self, line, discounts):
+        return [
+            BillSubline(
+                line=line,
                 description=_("Discount per %s") % discount.type.lower(),
                 total=discount.total,
                 type=discount.type,
-            )
+            ) for discount in discounts
+        ]
+    
+    def create_sublines(self, line, discounts):
+        for subline in self.get_sublines(line, discounts):
+            subline.save()
+
+
+class BulkBillsBackend(BillsBackend):
+    """
+    Same bills than BillsBackend, but the lines and sublines of each account are written with
+    bulk inserts and the updated dates of its reused open bills with a single update
+    """
+    def __init__(self):
+        self.lines = []
+        self.discounts = []
+        self.updated = []
+    
+    def create_bills(self, account, lines, **options):
+        # Leftovers of a failed account
+        self.lines = []
+        self.discounts = []
+        self.updated = []
+        # Open bills stay locked until the lines of the account are written
+        with transaction.atomic(), deferred_totals():
+            bills = self._create_bills(account, lines, **options)
+            self.flush()
+        return bills
+    
+    def get_open_bill(self, bill_class, account, create_new):
+        if create_new:
+            return bill_class.objects.create(account=account)
+        bill = bill_class.objects.select_for_update().filter(account=account, is_open=True).last()
+        if bill:
+            self.updated.append(bill)
+        else:
+            bill = bill_class.objects.create(account=account, is_open=True)
+        return bill
+    
+    def create_line(self, bill, line):
+        billine = self.get_line(bill, line)
+        self.lines.append(billine)
+        return billine
+    
+    def create_sublines(self, line, discounts):
+        if discounts:
+            self.discounts.append((line, discounts))
+    
+    def flush(self):
+        """ writes the pending lines, sublines, totals and updated dates """
+        connection = connections[BillLine.objects.db]
+        if not self.discounts or connection.features.can_return_ids_from_bulk_insert:
+            BillLine.objects.bulk_create(self.lines)
+        else:
+            # Sublines need the ids of their lines
+            for line in self.lines:
+                line.save()
+        sublines = []
+        for line, discounts in self.discounts:
+            sublines.extend(self.get_sublines(line, discounts))
+        BillSubline.objects.bulk_create(sublines)
+        # bulk_create() does not send the signals that keep the totals in sync
+        for bill in set(line.bill for line in self.lines):
+            deferred_totals.update(bill)
+        if self.updated:
+            now = timezone.now()
+            Bill.objects.filter(pk__in=[bill.pk for bill in self.updated]).update(updated_on=now)
+            for bill in self.updated:
+                bill.updated_on = now
+        self.lines = []
+        self.discounts = []
+        self.updated = []
@@ -1,10 +1,12 @@
 import datetime
 import decimal
 import logging
+import traceback
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import F, Q, Sum
 from django.apps import apps
+from django.contrib.admin.models import CHANGE, LogEntry
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
@@ -29,24 +31,39 @@ class OrderQuerySet(models.QuerySet):
         qs = self.select_related('account', 'service')
         commit = options.get('commit', True)
         for account, services in qs.group_by('account', 'service').items():
-            bill_lines = []
-            for service, orders in services.items():
-                for order in orders:
-                    # Saved for undoing support
-                    order.old_billed_on = order.billed_on
-                    order.old_billed_until = order.billed_until
-                lines = service.handler.generate_bill_lines(orders, account, **options)
-                bill_lines.extend(lines)
-            # TODO make this consistent always returning the same fucking types
-            if commit:
-                bills += bill_backend.create_bills(account, bill_lines, **options)
-            else:
-                bills += [(account, bill_lines)]
+            bills += self.bill_account(account, services, bill_backend=bill_backend, **options)
         # TODO remove if commit and always return unique elemenets (set()) when the other todo is fixed
         if commit:
             return list(set(bills))
         return bills
 
+    @staticmethod
+    def bill_account(account, services, bill_backend=None, **options):
+        """ services: {service: orders} of account """
+        if bill_backend is None:
+            bill_backend = Order.get_bill_backend()
+        bill_lines = []
+        for service, orders in services.items():
+            for order in orders:
+                # Saved for undoing support
+                order.old_billed_on = order.billed_on
+                order.old_billed_until = order.billed_until
+            lines = service.handler.generate_bill_lines(orders, account, **options)
+            bill_lines.extend(lines)
+        # TODO make this consistent always returning the same fucking types
+        if options.get('commit', True):
+            return bill_backend.create_bills(account, bill_lines, **options)
+        return [(account, bill_lines)]
+
+    def bill_run(self, created_by=None, **options):
+        """ bills on the background, sharded by account, see BillingRun """
+        run = BillingRun.objects.create(created_by=created_by, **{
+            option: value for option, value in options.items() if option in BillingRun.OPTIONS
+        })
+        run.orders.set(self)
+        transaction.on_commit(run.start)
+        return run
+
     def givers(self, ini, end):
         return self.cancelled_and_billed().filter(billed_until__gt=ini, registered_on__lt=end)
 
@@ -308,3 +325,156 @@ class MetricStorage(models.Model):
 
     def __str__(self):
         return str(self.order)
+
+
+class BillingRun(models.Model):
+    """
+    Billing of a set of orders on the background
+
+    Accounts are sharded between tasks, and each account is billed on its own transaction
+    and checkpointed. Failed or interrupted runs are resumed by starting them again, which
+    only bills the accounts not billed yet.
+    """
+    RECEIVED = 'RECEIVED'
+    STARTED = 'STARTED'
+    SUCCESS = 'SUCCESS'
+    FAILURE = 'FAILURE'
+
+    STATES = (
+        (RECEIVED, RECEIVED),
+        (STARTED, STARTED),
+        (SUCCESS, SUCCESS),
+        (FAILURE, FAILURE),
+    )
+    OPTIONS = ('billing_point', 'fixed_point', 'proforma', 'new_open')
+
+    state = models.CharField(_("state"), max_length=16, choices=STATES, default=RECEIVED)
+    orders = models.ManyToManyField(Order, verbose_name=_("orders"), related_name='billing_runs')
+    billing_point = models.DateField(_("billing point"), null=True, blank=True)
+    fixed_point = models.BooleanField(_("fixed point"), default=False)
+    proforma = models.BooleanField(_("pro forma"), default=False)
+    new_open = models.BooleanField(_("new open"), default=False)
+    created_by = models.ForeignKey('accounts.Account', on_delete=models.SET_NULL, null=True,
+        blank=True, verbose_name=_("created by"), related_name='+',
+        help_text=_("Billed orders are logged on the history on behalf of this user."))
+    created_at = models.DateTimeField(_("created"), auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
+
+    class Meta:
+        get_latest_by = 'id'
+
+    def __str__(self):
+        return _("Billing run #%s") % self.pk
+
+    def get_options(self):
+        return {option: getattr(self, option) for option in self.OPTIONS}
+
+    def get_progress(self):
+        """ {state: number of accounts} """
+        states = self.accounts.values_list('state').annotate(models.Count('id'))
+        return dict(states)
+
+    def start(self):
+        """ (re)starts billing the accounts still pending or failed """
+        from . import settings, tasks
+        account_ids = self.orders.values_list('account_id', flat=True).distinct()
+        existing = set(self.accounts.values_list('account_id', flat=True))
+        BillingRunAccount.objects.bulk_create([
+            BillingRunAccount(run=self, account_id=account_id)
+            for account_id in account_ids if account_id not in existing
+        ])
+        self.accounts.filter(state=BillingRunAccount.FAILURE).update(
+            state=BillingRunAccount.PENDING, traceback='')
+        self.state = self.STARTED
+        self.save(update_fields=('state', 'updated_at'))
+        pending = list(self.accounts.filter(state=BillingRunAccount.PENDING).order_by(
+            'account_id').values_list('account_id', flat=True))
+        if not pending:
+            return self.update_state()
+        shards = max(1, min(settings.ORDERS_BILLING_RUN_SHARDS, len(pending)))
+        for shard in range(shards):
+            tasks.bill_shard.delay(self.pk, pending[shard::shards])
+        return self.state
+
+    def bill_shard(self, account_ids):
+        bill_backend = Order.get_bill_backend()
+        for account_id in account_ids:
+            self.bill_account(account_id, bill_backend=bill_backend)
+        return self.update_state()
+
+    def bill_account(self, account_id, bill_backend=None):
+        """ bills the orders of account once, checkpointing it on the same transaction """
+        options = self.get_options()
+        try:
+            with transaction.atomic():
+                checkpoint = BillingRunAccount.objects.select_for_update().get(
+                    run=self, account_id=account_id)
+                if checkpoint.state == BillingRunAccount.SUCCESS:
+                    # Billed by a concurrent execution of the run
+                    return checkpoint
+                order_ids = self.orders.filter(account_id=account_id).values_list('id', flat=True)
+                # Concurrent runs of the same orders wait for this one
+                list(Order.objects.select_for_update().filter(id__in=order_ids).values_list('id'))
+                orders = Order.objects.filter(id__in=order_ids).select_related('account', 'service')
+                for account, services in orders.group_by('account', 'service').items():
+                    bills = OrderQuerySet.bill_account(account, services,
+                        bill_backend=bill_backend, **options)
+                    checkpoint.bills.add(*set(bills))
+                self.log_billed(orders)
+                checkpoint.state = BillingRunAccount.SUCCESS
+                checkpoint.save(update_fields=('state', 'updated_at'))
+        except Exception:
+            logger.exception("Billing run %s failed billing account %s." % (self.pk, account_id))
+            checkpoint = BillingRunAccount.objects.get(run=self, account_id=account_id)
+            checkpoint.state = BillingRunAccount.FAILURE
+            checkpoint.traceback = traceback.format_exc()
+            checkpoint.save(update_fields=('state', 'traceback', 'updated_at'))
+        return checkpoint
+
+    def log_billed(self, orders):
+        """ history of the orders, once they have actually been billed """
+        if self.created_by_id is None:
+            return
+        content_type = ContentType.objects.get_for_model(Order)
+        for order in orders:
+            LogEntry.objects.log_action(self.created_by_id, content_type.pk, order.pk,
+                str(order), CHANGE, 'Billed')
+
+    def update_state(self):
+        """ finishes the run once there are no pending accounts """
+        with transaction.atomic():
+            run = type(self).objects.select_for_update().get(pk=self.pk)
+            progress = run.get_progress()
+            if run.state == self.STARTED and not progress.get(BillingRunAccount.PENDING):
+                run.state = self.FAILURE if progress.get(BillingRunAccount.FAILURE) else self.SUCCESS
+                run.save(update_fields=('state', 'updated_at'))
+        self.state = run.state
+        return self.state
+
+
+class BillingRunAccount(models.Model):
+    """ checkpoint of an account billed by a billing run """
+    PENDING = 'PENDING'
+    SUCCESS = 'SUCCESS'
+    FAILURE = 'FAILURE'
+
+    STATES = (
+        (PENDING, PENDING),
+        (SUCCESS, SUCCESS),
+        (FAILURE, FAILURE),
+    )
+
+    run = models.ForeignKey(BillingRun, on_delete=models.CASCADE, verbose_name=_("run"),
+        related_name='accounts')
+    account = models.ForeignKey('accounts.Account', on_delete=models.CASCADE,
+        verbose_name=_("account"), related_name='+')
+    state = models.CharField(_("state"), max_length=16, choices=STATES, default=PENDING)
+    bills = models.ManyToManyField('bills.Bill', verbose_name=_("bills"), related_name='+')
+    traceback = models.TextField(_("traceback"), blank=True)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
+
+    class Meta:
+        unique_together = ('run', 'account')
+
+    def __str__(self):
+        return str(self.account)
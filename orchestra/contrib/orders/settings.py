@@ -4,7 +4,9 @@ from orchestra.contrib.settings import Setting
 ORDERS_BILLING_BACKEND = Setting('ORDERS_BILLING_BACKEND',
     'orchestra.contrib.orders.billing.BillsBackend',
     validators=[Setting.validate_import_class],
-    help_text="Pluggable backend for bill generation.",
+    help_text=("Pluggable backend for bill generation.<br>"
+               "<tt>orchestra.contrib.orders.billing.BulkBillsBackend</tt> creates the same bills "
+               "with bulk inserts, faster for billing many accounts at once."),
 )
 
 
@@ -44,3 +46,9 @@ ORDERS_BILLED_METRIC_CLEANUP_DAYS = Setting('ORDERS_BILLED_METRIC_CLEANUP_DAYS',
     40,
     help_text=("Number of days after a billed stored metric is deleted."),
 )
+
+
+ORDERS_BILLING_RUN_SHARDS = Setting('ORDERS_BILLING_RUN_SHARDS',
+    4,
+    help_text=("Number of tasks between which the accounts of a billing run are distributed."),
+)
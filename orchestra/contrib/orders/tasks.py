@@ -3,7 +3,7 @@ import datetime
 from celery.task.schedules import crontab
 from django.apps import apps
 
-from orchestra.contrib.tasks import periodic_task
+from orchestra.contrib.tasks import task, periodic_task
 
 from . import settings
 
@@ -48,3 +48,10 @@ def cleanup_metrics():
                     metrics.exclude(pk=latest.pk).only('id').delete()
     
     return (general, monthly)
+
+
+@task(name='orders.bill_shard')
+def bill_shard(run_id, account_ids):
+    from .models import BillingRun
+    run = BillingRun.objects.get(pk=run_id)
+    return run.bill_shard(account_ids)
@@ -0,0 +1,92 @@
+from unittest import mock
+
+from dateutil.relativedelta import relativedelta
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.bills.models import Bill
+from orchestra.contrib.services.models import Service
+from orchestra.contrib.systemusers.models import SystemUser
+from orchestra.utils.tests import random_ascii, BaseTestCase
+
+from .. import settings
+
+
+class BillsBackendTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.bills',
+        'orchestra.contrib.orders',
+        'orchestra.contrib.plans',
+        'orchestra.contrib.systemusers',
+    )
+
+    def setUp(self):
+        self.service = Service.objects.create(
+            description="FTP Account",
+            content_type=ContentType.objects.get_for_model(SystemUser),
+            match='not systemuser.is_main',
+            billing_period=Service.ANUAL,
+            billing_point=Service.FIXED_DATE,
+            is_fee=False,
+            metric='',
+            pricing_period=Service.NEVER,
+            rate_algorithm='orchestra.contrib.plans.ratings.step_price',
+            on_cancel=Service.COMPENSATE,
+            payment_style=Service.PREPAY,
+            tax=0,
+            nominal_price=10,
+        )
+
+    def create_ftp(self, account):
+        return SystemUser.objects.create_user('%s_ftp' % random_ascii(10), account=account)
+
+    def bill(self, backend, account, years):
+        billing_point = timezone.now().date() + relativedelta(years=years)
+        with mock.patch.object(settings, 'ORDERS_BILLING_BACKEND', backend):
+            return account.orders.bill(billing_point=billing_point, fixed_point=True)
+
+    def get_bills(self, account):
+        """ bills of account without the ids and the descriptions of random usernames """
+        bills = []
+        for bill in Bill.objects.filter(account=account).order_by('id'):
+            lines = []
+            for line in bill.lines.order_by('id'):
+                lines.append((
+                    line.rate, line.quantity, line.verbose_quantity,
+                    line.subtotal, line.tax, line.start_on, line.end_on,
+                    line.order_billed_on, line.order_billed_until,
+                    list(line.sublines.order_by('id').values_list('description', 'type', 'total')),
+                ))
+            bills.append((bill.type, bill.is_open, bill.total, bill.updated_on, lines))
+        return bills
+
+    def bill_compensation(self, backend):
+        """ bills a cancelled order compensated by a new one on the same open bill """
+        account = self.create_account()
+        ftp = self.create_ftp(account)
+        self.bill(backend, account, years=2)
+        ftp.delete()
+        self.create_ftp(account)
+        self.create_ftp(account)
+        self.bill(backend, account, years=1)
+        return self.get_bills(account)
+
+    def test_same_bills(self):
+        bills = self.bill_compensation('orchestra.contrib.orders.billing.BillsBackend')
+        bulk_bills = self.bill_compensation('orchestra.contrib.orders.billing.BulkBillsBackend')
+        self.assertEqual(1, len(bills))
+        # Compensation discounts
+        self.assertTrue(any(line[-1] for line in bills[0][-1]))
+        self.assertEqual(bills, bulk_bills)
+
+    def test_closed_open_bill(self):
+        account = self.create_account()
+        self.create_ftp(account)
+        backend = 'orchestra.contrib.orders.billing.BulkBillsBackend'
+        bill, = self.bill(backend, account, years=1)
+        Bill.objects.filter(pk=bill.pk).update(is_open=False)
+        self.create_ftp(account)
+        new_bill, = self.bill(backend, account, years=1)
+        self.assertNotEqual(bill.pk, new_bill.pk)
+        self.assertEqual(1, bill.lines.count())
+        self.assertEqual(1, new_bill.lines.count())
@@ -0,0 +1,127 @@
+from unittest import mock
+
+from dateutil.relativedelta import relativedelta
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.bills.models import Bill
+from orchestra.contrib.services.models import Service
+from orchestra.contrib.systemusers.models import SystemUser
+from orchestra.utils.tests import random_ascii, BaseTestCase
+
+from .. import tasks
+from ..models import BillingRun, BillingRunAccount, Order, OrderQuerySet
+
+
+def bill_shard(run_id, account_ids):
+    """ bill_shard task executed on the test thread, sharing its database connection """
+    return BillingRun.objects.get(pk=run_id).bill_shard(account_ids)
+
+
+@mock.patch.object(tasks.bill_shard, 'delay', bill_shard)
+class BillingRunTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.bills',
+        'orchestra.contrib.orders',
+        'orchestra.contrib.plans',
+        'orchestra.contrib.systemusers',
+    )
+
+    def setUp(self):
+        Service.objects.create(
+            description="FTP Account",
+            content_type=ContentType.objects.get_for_model(SystemUser),
+            match='not systemuser.is_main',
+            billing_period=Service.ANUAL,
+            billing_point=Service.FIXED_DATE,
+            is_fee=False,
+            metric='',
+            pricing_period=Service.NEVER,
+            rate_algorithm='orchestra.contrib.plans.ratings.step_price',
+            on_cancel=Service.COMPENSATE,
+            payment_style=Service.PREPAY,
+            tax=0,
+            nominal_price=10,
+        )
+        self.accounts = []
+        for ix in range(3):
+            account = self.create_account()
+            SystemUser.objects.create_user('%s_ftp' % random_ascii(10), account=account)
+            self.accounts.append(account)
+        self.user = self.create_account(superuser=True)
+        self.billing_point = timezone.now().date() + relativedelta(years=1)
+
+    def create_run(self):
+        orders = Order.objects.filter(account__in=self.accounts)
+        # Started on commit, which never happens inside a test case
+        return orders.bill_run(created_by=self.user, billing_point=self.billing_point,
+            fixed_point=True)
+
+    def get_billed(self, run):
+        return dict(run.accounts.values_list('account_id', 'state'))
+
+    def fail_account(self, account):
+        """ bill_account() raising for account """
+        bill_account = OrderQuerySet.bill_account
+
+        def failing_bill_account(billed_account, *args, **kwargs):
+            if billed_account == account:
+                raise ValueError("Failed")
+            return bill_account(billed_account, *args, **kwargs)
+        return mock.patch.object(OrderQuerySet, 'bill_account', staticmethod(failing_bill_account))
+
+    def test_failing_account(self):
+        run = self.create_run()
+        with self.fail_account(self.accounts[1]):
+            run.start()
+        run.refresh_from_db()
+        self.assertEqual(BillingRun.FAILURE, run.state)
+        self.assertEqual({
+            self.accounts[0].pk: BillingRunAccount.SUCCESS,
+            self.accounts[1].pk: BillingRunAccount.FAILURE,
+            self.accounts[2].pk: BillingRunAccount.SUCCESS,
+        }, self.get_billed(run))
+        failed = run.accounts.get(account=self.accounts[1])
+        self.assertIn('ValueError: Failed', failed.traceback)
+        self.assertFalse(failed.bills.exists())
+        self.assertEqual({self.accounts[0].pk, self.accounts[2].pk},
+            set(Bill.objects.values_list('account_id', flat=True)))
+
+    def test_resume(self):
+        run = self.create_run()
+        with self.fail_account(self.accounts[1]):
+            run.start()
+        bill_account = OrderQuerySet.bill_account
+        with mock.patch.object(OrderQuerySet, 'bill_account', side_effect=bill_account) as billed:
+            run.start()
+        run.refresh_from_db()
+        self.assertEqual(BillingRun.SUCCESS, run.state)
+        self.assertEqual([self.accounts[1]], [call[0][0] for call in billed.call_args_list])
+        self.assertEqual({BillingRunAccount.SUCCESS}, set(self.get_billed(run).values()))
+        self.assertEqual(3, Bill.objects.filter(account__in=self.accounts).count())
+
+    def test_concurrent_start(self):
+        run = self.create_run()
+        shards = []
+        with mock.patch.object(tasks.bill_shard, 'delay', lambda *args: shards.append(args)):
+            run.start()
+            BillingRun.objects.get(pk=run.pk).start()
+        self.assertEqual(2*len(self.accounts),
+            sum(len(account_ids) for __, account_ids in shards))
+        for run_id, account_ids in shards:
+            bill_shard(run_id, account_ids)
+        self.assertEqual({BillingRunAccount.SUCCESS}, set(self.get_billed(run).values()))
+        for account in self.accounts:
+            self.assertEqual(1, Bill.objects.filter(account=account).count())
+
+    def test_log_billed(self):
+        run = self.create_run()
+        content_type = ContentType.objects.get_for_model(Order)
+        history = LogEntry.objects.filter(content_type=content_type, change_message='Billed')
+        self.assertFalse(history.exists())
+        with self.fail_account(self.accounts[1]):
+            run.start()
+        orders = Order.objects.filter(account__in=(self.accounts[0], self.accounts[2]))
+        self.assertEqual(set(str(pk) for pk in orders.values_list('pk', flat=True)),
+            set(history.filter(user=self.user).values_list('object_id', flat=True)))
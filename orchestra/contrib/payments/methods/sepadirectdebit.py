@@ -198,9 +198,7 @@ class SEPADirectDebit(PaymentMethod):
         import lxml.builder
         from lxml.builder import E
         for transaction in transactions:
-            transaction.process = process
-            transaction.state = transaction.WAITTING_EXECUTION
-            transaction.save(update_fields=('state', 'process', 'modified_at'))
+            transaction.mark_as_processed(process=process)
             account = transaction.account
             data = transaction.source.data
             yield E.DrctDbtTxInf(                           # Direct Debit Transaction Info
@@ -245,9 +243,7 @@ class SEPADirectDebit(PaymentMethod):
         import lxml.builder
         from lxml.builder import E
         for transaction in transactions:
-            transaction.process = process
-            transaction.state = transaction.WAITTING_EXECUTION
-            transaction.save(update_fields=('state', 'process', 'modified_at'))
+            transaction.mark_as_processed(process=process)
             account = transaction.account
             data = transaction.source.data
             yield E.CdtTrfTxInf(                            # Credit Transfer Transaction Info
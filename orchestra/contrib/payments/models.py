@@ -1,5 +1,5 @@
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from jsonfield import JSONField
@@ -70,7 +70,9 @@ class TransactionQuerySet(models.QuerySet):
         amount = kwargs.get('amount')
         if amount == 0:
             kwargs['state'] = self.model.SECURED
-        return super(TransactionQuerySet, self).create(**kwargs)
+        with transaction.atomic():
+            # The payment state of its bill is updated on post_save
+            return super(TransactionQuerySet, self).create(**kwargs)
 
     def secured(self):
         return self.filter(state=Transaction.SECURED)
@@ -147,21 +149,30 @@ class Transaction(models.Model):
             return self.source.method_instance.state_help.get(self.state) or self.STATE_HELP.get(self.state)
         return self.STATE_HELP.get(self.state)
 
-    def mark_as_processed(self):
+    @transaction.atomic
+    def save_state(self, update_fields=('state', 'modified_at')):
+        """ saves a state transition along with the payment state of its bill, on post_save """
+        self.save(update_fields=update_fields)
+
+    def mark_as_processed(self, process=None):
         self.state = self.WAITTING_EXECUTION
-        self.save(update_fields=('state', 'modified_at'))
+        update_fields = ('state', 'modified_at')
+        if process is not None:
+            self.process = process
+            update_fields += ('process',)
+        self.save_state(update_fields)
 
     def mark_as_executed(self):
         self.state = self.EXECUTED
-        self.save(update_fields=('state', 'modified_at'))
+        self.save_state()
 
     def mark_as_secured(self):
         self.state = self.SECURED
-        self.save(update_fields=('state', 'modified_at'))
+        self.save_state()
 
     def mark_as_rejected(self):
         self.state = self.REJECTED
-        self.save(update_fields=('state', 'modified_at'))
+        self.save_state()
 
 
 class TransactionProcess(models.Model):
@@ -191,20 +202,30 @@ class TransactionProcess(models.Model):
     def __str__(self):
         return '#%i' % self.id
 
+    @transaction.atomic
     def mark_as_executed(self):
+        from orchestra.contrib.bills.models import deferred_payment_states
         self.state = self.EXECUTED
-        for transaction in self.transactions.all():
-            transaction.mark_as_executed()
+        # Bills updated once all their transactions have changed
+        with deferred_payment_states():
+            for trans in self.transactions.all():
+                trans.mark_as_executed()
         self.save(update_fields=('state', 'updated_at'))
 
+    @transaction.atomic
     def abort(self):
+        from orchestra.contrib.bills.models import deferred_payment_states
         self.state = self.ABORTED
-        for transaction in self.transactions.all():
-            transaction.mark_as_rejected()
+        with deferred_payment_states():
+            for trans in self.transactions.all():
+                trans.mark_as_rejected()
         self.save(update_fields=('state', 'updated_at'))
 
+    @transaction.atomic
     def commit(self):
+        from orchestra.contrib.bills.models import deferred_payment_states
         self.state = self.COMMITED
-        for transaction in self.transactions.processing():
-            transaction.mark_as_secured()
+        with deferred_payment_states():
+            for trans in self.transactions.processing():
+                trans.mark_as_secured()
         self.save(update_fields=('state', 'updated_at'))
@@ -1,7 +1,9 @@
 import datetime
 import decimal
 import itertools
+import logging
 
+from django.db.models import Sum
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
@@ -9,10 +11,31 @@ from orchestra.utils.python import AttrDict
 
 from orchestra import plugins
 
+try:
+    from . import vectorized
+except ImportError:
+    vectorized = None
+
+
+logger = logging.getLogger(__name__)
+
 
 class Aggregation(plugins.Plugin, metaclass=plugins.PluginMount):
     """ filters and computes dataset usage """
     aggregated_history = False
+    # (period, field) of the coarsest rollup that yields the same usage, None for raw data
+    rollup = None
+    # (period, field) of the rollup used by the history charts
+    history_rollup = None
+    
+    def get_dataset(self, history=False):
+        """ MonitorData or rollup queryset this aggregation reads from """
+        from . import rollups, settings
+        from .models import MonitorData
+        rollup = self.history_rollup if history else self.rollup
+        if rollup is None or not settings.RESOURCES_READ_MONITOR_ROLLUPS:
+            return MonitorData.objects.all()
+        return rollups.get_dataset(*rollup)
     
     def filter(self, dataset):
         """ Filter the dataset to get the relevant data according to the period """
@@ -22,6 +45,13 @@ class Aggregation(plugins.Plugin, metaclass=plugins.PluginMount):
         """ given a dataset computes its usage according to the method (avg, sum, ...) """
         raise NotImplementedError
     
+    def compute_usages(self, dataset):
+        """ {object_id: usage} of every monitored object of the dataset """
+        usages = {}
+        for object_id in dataset.order_by().values_list('object_id', flat=True).distinct():
+            usages[object_id] = self.compute_usage(dataset.filter(object_id=object_id))
+        return usages
+    
     def aggregate_history(self, dataset):
         raise NotImplementedError
 
@@ -30,6 +60,7 @@ class Last(Aggregation):
     """ Sum of the last value of all monitors """
     name = 'last'
     verbose_name = _("Last value")
+    history_rollup = ('hourly', 'last_value')
     
     def filter(self, dataset, date=None):
 
@@ -48,6 +79,11 @@ class Last(Aggregation):
             return sum(values)
         return None
     
+    def compute_usages(self, dataset):
+        """ a single grouped query """
+        dataset = dataset.order_by().values_list('object_id').annotate(usage=Sum('value'))
+        return dict(dataset)
+    
     def aggregate_history(self, dataset):
         prev_object_id = None
         prev_object_repr = None
@@ -70,14 +106,19 @@ class MonthlySum(Last):
     name = 'monthly-sum'
     verbose_name = _("Monthly Sum")
     aggregated_history = True
+    rollup = ('monthly', 'sum')
+    history_rollup = ('monthly', 'sum')
     
     def filter(self, dataset, date=None):
+        """ a range on created_at, which prunes the partitions of other months """
+        from . import rollups
         if date is None:
-            date = timezone.now().date()
-        return dataset.filter(
-            created_at__year=date.year,
-            created_at__month=date.month,
-        )
+            date = timezone.now()
+        elif not isinstance(date, datetime.datetime):
+            date = datetime.datetime.combine(date, datetime.time(12))
+            date = timezone.make_aware(date)
+        start, end = rollups.get_period(date, rollups.MONTHLY)
+        return dataset.filter(created_at__gte=start, created_at__lt=end)
     
     def aggregate_history(self, dataset):
         prev = None
@@ -117,10 +158,16 @@ class MonthlyAvg(MonthlySum):
     name = 'monthly-avg'
     verbose_name = _("Monthly AVG")
     aggregated_history = False
+    rollup = ('monthly', 'avg')
+    history_rollup = ('daily', 'avg')
     
     def get_epoch(self, date=None):
         if date is None:
             date = timezone.now().date()
+        if isinstance(date, datetime.datetime):
+            # Keep tzinfo, datetimes can not be subtracted from dates
+            from . import rollups
+            return rollups.truncate(date, rollups.MONTHLY)
         return datetime.date(
             year=date.year,
             month=date.month,
@@ -128,28 +175,33 @@ class MonthlyAvg(MonthlySum):
         )
     
     def compute_usage(self, dataset):
-        result = 0
-        has_result = False
-        aggregate = []
-        for object_id, dataset in dataset.order_by('created_at').group_by('object_id').items():
-            try:
-                last = dataset[-1]
-            except IndexError:
-                continue
-            epoch = self.get_epoch(date=last.created_at)
-            total = (last.created_at-epoch).total_seconds()
+        usages = self.compute_usages(dataset)
+        if usages:
+            return sum(usages.values())
+        return None
+    
+    def compute_usages(self, dataset):
+        """ time-weighted average of each object, in a single ordered pass over the dataset """
+        if dataset.model.is_rollup:
+            return {
+                rollup.object_id: rollup.get_average() for rollup in dataset.order_by()
+            }
+        usages = {}
+        dataset = dataset.order_by('object_id', 'created_at').values_list(
+            'object_id', 'created_at', 'value')
+        for object_id, values in itertools.groupby(dataset.iterator(), key=lambda v: v[0]):
+            values = list(values)
+            last = values[-1][1]
+            epoch = self.get_epoch(date=last)
+            total = (last-epoch).total_seconds()
             ini = epoch
             current = 0
-            for mdata in dataset:
-                has_result = True
-                slot = (mdata.created_at-ini).total_seconds()
-                current += mdata.value * decimal.Decimal(str(slot/total))
-                ini = mdata.created_at
-            else:
-                result += current
-        if has_result:
-            return result
-        return None
+            for __, created_at, value in values:
+                slot = (created_at-ini).total_seconds()
+                current += value * decimal.Decimal(str(slot/total))
+                ini = created_at
+            usages[object_id] = current
+        return usages
     
     def aggregate_history(self, dataset):
         yield from super(MonthlySum, self).aggregate_history(dataset)
@@ -160,6 +212,8 @@ class Last10DaysAvg(MonthlyAvg):
     name = 'last-10-days-avg'
     verbose_name = _("Last 10 days AVG")
     days = 10
+    # Periods are not aligned with rollups
+    rollup = None
     
     def get_epoch(self, date=None):
         if date is None:
@@ -172,3 +226,40 @@ class Last10DaysAvg(MonthlyAvg):
         if date is not None:
             dataset = dataset.filter(created_at__lte=date)
         return dataset
+
+
+class VectorizedMixin(object):
+    """
+    computes the time-weighted averages of all the objects with NumPy segment operations,
+    falls back to the Python implementation when NumPy is not installed
+    """
+    def compute_usages(self, dataset):
+        if dataset.model.is_rollup:
+            return super(VectorizedMixin, self).compute_usages(dataset)
+        if vectorized is None:
+            logger.warning("NumPy is not installed, %s is computed without it." % self.get_name())
+            return super(VectorizedMixin, self).compute_usages(dataset)
+        object_ids, timestamps, values = vectorized.load(dataset)
+        if not len(object_ids):
+            return {}
+        starts = vectorized.get_segments(object_ids)
+        epochs = []
+        for last in vectorized.segment_last(timestamps, starts):
+            last = datetime.datetime.fromtimestamp(last, tz=datetime.timezone.utc)
+            epochs.append(self.get_epoch(date=last).timestamp())
+        averages = vectorized.time_weighted_average(timestamps, values, starts, epochs)
+        usages = {}
+        for object_id, average in zip(object_ids[starts], averages):
+            if vectorized.numpy.isfinite(average):
+                usages[int(object_id)] = vectorized.to_decimal(average)
+        return usages
+
+
+class VectorizedMonthlyAvg(VectorizedMixin, MonthlyAvg):
+    name = 'np-monthly-avg'
+    verbose_name = _("Monthly AVG (NumPy)")
+
+
+class VectorizedLast10DaysAvg(VectorizedMixin, Last10DaysAvg):
+    name = 'np-last-10d-avg'
+    verbose_name = _("Last 10 days AVG (NumPy)")
@@ -1,5 +1,6 @@
 from django import db
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 from orchestra.core import administration
 from orchestra.utils.db import database_ready
@@ -22,6 +23,13 @@ class ResourcesConfig(AppConfig):
         administration.register(ResourceData, parent=Resource, icon='monitor.png')
         administration.register(MonitorData, parent=Resource, dashboard=False)
         from . import signals
+        post_migrate.connect(self.sync_periodic_tasks, sender=self,
+            dispatch_uid="orchestra.contrib.resources.apps.sync_periodic_tasks")
+    
+    def sync_periodic_tasks(self, **kwargs):
+        """ replaces the per resource periodic tasks of previous versions on upgrade """
+        from .models import Resource
+        Resource.sync_periodic_tasks()
     
     def reload_relations(self):
         from .admin import insert_resource_inlines
@@ -1,4 +1,10 @@
 import datetime
+import decimal
+import io
+import itertools
+import logging
+import os
+import textwrap
 
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -9,6 +15,116 @@ from orchestra.contrib.orchestration import ServiceBackend
 from . import helpers
 
 
+logger = logging.getLogger(__name__)
+
+
+# Python 2 and 3 compatible, monitor scripts run with the python of the server
+LOG_OFFSETS_SCRIPT = textwrap.dedent("""\
+    import fcntl
+    import json
+    import os
+    import sys
+    
+    class LogOffsets(object):
+        \"\"\"
+        Byte offsets of the log files already parsed for each object, followed by inode on rotation
+        is_new() is None for objects without offsets yet, which are parsed by date
+        data of each object is saved along with its offsets, for correlating lines of different executions
+        
+        Offsets and data of an execution are pending until Orchestra stores its output, they are
+        promoted by prepare() when the last date stored for the object is not older than the execution,
+        and discarded otherwise so the same lines are parsed again.
+        Objects not monitored since expire_date, like deleted ones, are forgotten.
+        \"\"\"
+        def __init__(self, state_path, current_date, expire_date):
+            if not os.path.isdir(os.path.dirname(state_path)):
+                os.makedirs(os.path.dirname(state_path))
+            self.handler = open(state_path, 'a+')
+            fcntl.flock(self.handler, fcntl.LOCK_EX)
+            self.handler.seek(0)
+            try:
+                state = json.loads(self.handler.read() or '{}')
+            except ValueError:
+                state = {}
+            # {object_id: {'date': date, 'offsets': {inode: offset}, 'data': data}}
+            self.state = state.get('objects', {})
+            self.pending = state.get('pending', {})
+            self.current_date = current_date
+            self.expire_date = expire_date
+            self.data = {}
+            self.sizes = {}
+            self.ends = {}
+        
+        def prepare(self, object_id, last_date):
+            \"\"\" last_date is the date of the last data stored by Orchestra for object_id \"\"\"
+            object_id = str(object_id)
+            pending = self.pending.pop(object_id, None)
+            if pending is not None and last_date >= pending['date']:
+                self.state[object_id] = pending
+            self.data[object_id] = self.state.get(object_id, {}).get('data', {})
+        
+        def get_data(self, object_id):
+            return self.data.setdefault(str(object_id), {})
+        
+        def get_offset(self, object_id, inode):
+            entry = self.state.get(str(object_id))
+            if entry is None:
+                return None
+            offset = entry['offsets'].get(inode, 0)
+            if offset > self.sizes[inode]:
+                # Truncated
+                return 0
+            return offset
+        
+        def readlines(self, paths, object_ids):
+            \"\"\" yields (inode, position, line) of the complete lines not parsed by all object_ids \"\"\"
+            for path in paths:
+                try:
+                    handler = open(path, 'rb')
+                except IOError as e:
+                    sys.stderr.write(str(e)+'\\n')
+                    continue
+                with handler:
+                    inode = str(os.fstat(handler.fileno()).st_ino)
+                    size = os.fstat(handler.fileno()).st_size
+                    self.sizes[inode] = size
+                    offsets = [self.get_offset(object_id, inode) for object_id in object_ids]
+                    position = min([offset or 0 for offset in offsets] or [size])
+                    handler.seek(position)
+                    while position < size:
+                        line = handler.readline(size-position)
+                        if not line.endswith(b'\\n'):
+                            # Still being written
+                            break
+                        yield inode, position, line.decode('utf-8', 'replace')
+                        position += len(line)
+                    for object_id in object_ids:
+                        self.ends.setdefault(str(object_id), {})[inode] = position
+        
+        def is_new(self, object_id, inode, position):
+            offset = self.get_offset(object_id, inode)
+            if offset is None:
+                return None
+            return position >= offset
+        
+        def save(self):
+            for object_id, offsets in self.ends.items():
+                self.pending[object_id] = {
+                    'date': self.current_date,
+                    'offsets': offsets,
+                    'data': self.data.get(object_id, {}),
+                }
+            for entries in (self.state, self.pending):
+                for object_id, entry in list(entries.items()):
+                    if entry['date'] < self.expire_date:
+                        del entries[object_id]
+            self.handler.seek(0)
+            self.handler.truncate()
+            self.handler.write(json.dumps({'objects': self.state, 'pending': self.pending}))
+            self.handler.close()
+    """)
+
+
 class ServiceMonitor(ServiceBackend):
     TRAFFIC = 'traffic'
     DISK = 'disk'
@@ -19,6 +135,8 @@ class ServiceMonitor(ServiceBackend):
     abstract = True
     delete_old_equal_values = False
     monthly_sum_old_values = False
+    # Monitored values stored per bulk insert
+    store_chunk_size = 1000
     
     @classmethod
     def get_plugins(cls):
@@ -42,6 +160,26 @@ class ServiceMonitor(ServiceBackend):
         model = model.lower()
         return ContentType.objects.get_by_natural_key(app_label, model)
     
+    def get_state_path(self):
+        """ path of the file where the monitor script keeps its state on the server """
+        from . import settings
+        return os.path.join(settings.RESOURCES_MONITOR_STATE_DIR, '%s.json' % self.get_name())
+    
+    def get_log_offsets_script(self):
+        """
+        python monitor scripts can use LogOffsets for parsing only the log lines appended
+        since their last execution, their prepare() should call log_offsets.prepare()
+        """
+        from . import settings
+        expire_date = self.current_date - datetime.timedelta(days=settings.RESOURCES_MONITOR_STATE_EXPIRE_DAYS)
+        return LOG_OFFSETS_SCRIPT + textwrap.dedent("""
+            log_offsets = LogOffsets('%s', '%s', '%s')
+            """) % (
+                self.get_state_path(),
+                self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
+                expire_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
+            )
+    
     def get_last_data(self, object_id):
         from .models import MonitorData
         try:
@@ -66,35 +204,86 @@ class ServiceMonitor(ServiceBackend):
         result.append(None)
         return result
     
+    def parse(self, lines, errors):
+        """ lazily yields (object_id, value, state) of valid lines, malformed lines go to errors """
+        for num, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                object_id, value, state = self.process(line)
+                if isinstance(value, bytes):
+                    value = value.decode('ascii')
+                if isinstance(state, bytes):
+                    state = state.decode('ascii')
+                object_id = int(object_id)
+                value = decimal.Decimal(value)
+                if state is not None:
+                    state = decimal.Decimal(state)
+            except (ValueError, TypeError, ArithmeticError) as exc:
+                errors.append((num, line, str(exc) or type(exc).__name__))
+            else:
+                yield num, line, object_id, value, state
+
     def store(self, log):
-        """ stores monitored values from stdout """
-        from django.contrib.contenttypes.models import ContentType
+        """ stores monitored values from stdout, in chunks of store_chunk_size lines """
+        from . import rollups
         from .models import MonitorData
         name = self.get_name()
-        app_label, model_name = self.model.split('.')
-        ct = ContentType.objects.get_by_natural_key(app_label, model_name.lower())
-        for line in log.stdout.splitlines():
-            line = line.strip()
-            object_id, value, state = self.process(line)
-            if isinstance(value, bytes):
-                value = value.decode('ascii')
-            if isinstance(state, bytes):
-                state = state.decode('ascii')
-            content_object = ct.get_object_for_this_type(pk=object_id)
-            MonitorData.objects.create(
-                monitor=name, object_id=object_id, content_type=ct, value=value, state=state,
-                created_at=self.current_date, content_object_repr=str(content_object),
-            )
-    
+        ct = self.content_type
+        model = ct.model_class()
+        errors = []
+        stored = 0
+        parsed = self.parse(io.StringIO(log.stdout), errors)
+        chunks = iter(lambda: list(itertools.islice(parsed, self.store_chunk_size)), [])
+        for chunk in chunks:
+            objects = model.objects.in_bulk(set(result[2] for result in chunk))
+            data = []
+            for num, line, object_id, value, state in chunk:
+                try:
+                    content_object = objects[object_id]
+                except KeyError:
+                    errors.append((num, line, "%s %i does not exist" % (model.__name__, object_id)))
+                    continue
+                data.append(MonitorData(
+                    monitor=name, object_id=object_id, content_type=ct, value=value, state=state,
+                    created_at=self.current_date, content_object_repr=str(content_object)[:256],
+                ))
+            MonitorData.objects.bulk_create(data)
+            rollups.update(data)
+            stored += len(data)
+        if errors:
+            self.report_errors(log, errors)
+        return stored
+
+    def report_errors(self, log, errors, max_errors=50):
+        msg = "%s: %i malformed output lines have not been stored." % (self.get_name(), len(errors))
+        logger.warning(msg)
+        report = [msg]
+        for num, line, error in errors[:max_errors]:
+            report.append("line %i '%s': %s" % (num, line, error))
+        if len(errors) > max_errors:
+            report.append("...")
+        log.stderr += '\n'.join(report) + '\n'
+        log.save(update_fields=('stderr',))
+
     def execute(self, *args, **kwargs):
         log = super(ServiceMonitor, self).execute(*args, **kwargs)
         if log.state == log.SUCCESS:
             self.store(log)
         return log
+
+    async def execute_async(self, *args, **kwargs):
+        from orchestra.contrib.orchestration.executors import run_sync
+        log = await super(ServiceMonitor, self).execute_async(*args, **kwargs)
+        if log.state == log.SUCCESS:
+            await run_sync(self.store, log)
+        return log
     
     @classmethod
-    def aggregate(cls, dataset):
+    def aggregate(cls, dataset, **kwargs):
+        """ compacts old data, kwargs are chunk_size, start and progress of helpers.compact() """
         if cls.delete_old_equal_values:
-            return helpers.delete_old_equal_values(dataset)
+            return helpers.delete_old_equal_values(dataset, **kwargs)
         elif cls.monthly_sum_old_values:
-            return helpers.monthly_sum_old_values(dataset)
+            return helpers.monthly_sum_old_values(dataset, **kwargs)
@@ -1,5 +1,10 @@
 import decimal
+import itertools
 
+from django.db import connections, transaction
+from django.db.models import Count, F, FloatField, Max, Min, Q, Sum, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lag, Lead, RowNumber, TruncMonth
 from django.template.defaultfilters import date as date_format
 
 
@@ -29,7 +34,8 @@ def get_history_data(queryset):
         monitors = []
         scale = options['scale']
         all_dates = options['dates']
-        for monitor_name, dataset in rdata.get_monitor_datasets():
+        datasets = rdata.get_monitor_datasets(aggregation.get_dataset(history=True))
+        for monitor_name, dataset in datasets:
             datasets = {}
             for content_object, datas in aggregation.aggregate_history(dataset):
                 if aggregation.aggregated_history:
@@ -83,52 +89,144 @@ def get_history_data(queryset):
     return result
 
 
-def delete_old_equal_values(dataset):
-    """ only first and last values of an equal serie (+-error) are kept """
-    prev_value = None
-    prev_key = None
-    delete_count = 0
+def get_chunks(dataset, chunk_size, start=None):
+    """
+    lazily yields (checkpoint, chunk) where chunk is the dataset of a range of chunk_size objects
+    and checkpoint its last (content_type_id, object_id), objects after start only
+    """
+    objects = dataset.order_by('content_type_id', 'object_id').values_list(
+        'content_type_id', 'object_id').distinct()
+    if start is not None:
+        content_type_id, object_id = start
+        objects = objects.filter(
+            Q(content_type_id__gt=content_type_id) |
+            Q(content_type_id=content_type_id, object_id__gt=object_id)
+        )
+    for content_type_id, object_ids in itertools.groupby(objects.iterator(), key=lambda o: o[0]):
+        object_ids = [object_id for __, object_id in object_ids]
+        for ix in range(0, len(object_ids), chunk_size):
+            chunk = object_ids[ix:ix+chunk_size]
+            yield (content_type_id, chunk[-1]), dataset.filter(
+                content_type_id=content_type_id, object_id__gte=chunk[0], object_id__lte=chunk[-1])
+
+
+def get_window_sql(dataset, **windows):
+    """ SQL and params of the dataset id and value, annotated with windows """
+    dataset = dataset.order_by().annotate(**windows).values('id', 'value', *windows)
+    return dataset.query.sql_with_params()
+
+
+def get_window_output_field(connection):
+    """ Django 2.2 wraps decimal windows on a CAST that SQLite can not parse """
+    if connection.vendor == 'sqlite':
+        return FloatField()
+    return None
+
+
+def compact(dataset, compact_chunk, chunk_size=None, start=None, progress=None):
+    """
+    applies compact_chunk() to chunks of objects, each one on its own transaction
+    progress(checkpoint, affected) is called after each chunk, checkpoint can be used as start
+    for resuming an interrupted execution
+    """
+    if chunk_size is None:
+        from . import settings
+        chunk_size = settings.RESOURCES_CLEANUP_CHUNK_SIZE
+    affected = 0
+    for checkpoint, chunk in get_chunks(dataset, chunk_size, start=start):
+        with transaction.atomic(using=dataset.db):
+            affected += compact_chunk(chunk)
+        if progress is not None:
+            progress(checkpoint, affected)
+    return affected
+
+
+def get_compacted(dataset, sql, params):
+    """ (objects, span) of the rows of dataset selected by sql, before compacting them """
+    compacted = dataset.model.objects.using(dataset.db).filter(id__in=RawSQL(sql, params))
+    objects = compacted.order_by().values_list('monitor', 'content_type_id', 'object_id').distinct()
+    span = compacted.aggregate(since=Min('created_at'), until=Max('created_at'))
+    return list(objects), span
+
+
+def refresh_rollups(objects, span):
+    """ compacted data no longer matches the rollups of its months """
+    from . import rollups
+    if objects:
+        rollups.refresh(objects, span['since'], span['until'])
+
+
+def delete_chunk_equal_values(dataset):
+    """ deletes values equal (+-error) to both the previous and the next one """
     error = decimal.Decimal('0.005')
-    third = False
-    for mdata in dataset.order_by('content_type_id', 'object_id', 'created_at'):
-        key = (mdata.content_type_id, mdata.object_id)
-        if prev_key == key:
-            if prev_value is not None and mdata.value*(1-error) < prev_value < mdata.value*(1+error):
-                if third:
-                    prev.delete()
-                    delete_count += 1
-                else:
-                    third = True
-            else:
-                third = False
-            prev_value = mdata.value
-            prev_key = key
-        else:
-            prev_value = None
-            prev_key = key
-        prev = mdata
-    return delete_count
-
-
-def monthly_sum_old_values(dataset):
-    aggregated = 0
-    prev_key = None
-    prev = None
-    to_delete = []
-    delete_count = 0
-    for mdata in dataset.order_by('content_type_id', 'object_id', 'created_at'):
-        key = (mdata.content_type_id, mdata.object_id, mdata.created_at.year, mdata.created_at.month)
-        if prev_key is not None and prev_key != key:
-            if prev.value != aggregated:
-                prev.value = aggregated
-                prev.save(update_fields=('value',))
-            for obj in to_delete[:-1]:
-                obj.delete()
-                delete_count += 1
-            aggregated = 0
-            to_delete = []
-        prev = mdata
-        prev_key = key
-        aggregated += mdata.value
-        to_delete.append(mdata)
-    return delete_count
+    connection = connections[dataset.db]
+    qn = connection.ops.quote_name
+    partition = [F('content_type_id'), F('object_id')]
+    order = [F('created_at').asc(), F('id').asc()]
+    output_field = get_window_output_field(connection)
+    sql, params = get_window_sql(dataset,
+        prev_value=Window(Lag('value', output_field=output_field),
+            partition_by=partition, order_by=order),
+        next_value=Window(Lead('value', output_field=output_field),
+            partition_by=partition, order_by=order),
+    )
+    select = (
+        "SELECT w.{id} FROM ({sql}) w "
+        "WHERE w.{value}*%s < w.{prev} AND w.{prev} < w.{value}*%s "
+        "AND w.{next}*%s < w.{value} AND w.{value} < w.{next}*%s"
+    ).format(id=qn('id'), value=qn('value'), prev=qn('prev_value'), next=qn('next_value'), sql=sql)
+    delete = "DELETE FROM {table} WHERE {id} IN ({select})".format(
+        table=qn(dataset.model._meta.db_table), id=qn('id'), select=select)
+    params = tuple(params) + (1-error, 1+error)*2
+    objects, span = get_compacted(dataset, select, params)
+    with connection.cursor() as cursor:
+        cursor.execute(delete, params)
+        rowcount = cursor.rowcount
+    refresh_rollups(objects, span)
+    return rowcount
+
+
+def delete_old_equal_values(dataset, **kwargs):
+    """ only first and last values of an equal serie (+-error) are kept """
+    return compact(dataset, delete_chunk_equal_values, **kwargs)
+
+
+def sum_chunk_monthly_values(dataset):
+    """ the last value of each month stores the monthly sum, the others are deleted """
+    connection = connections[dataset.db]
+    qn = connection.ops.quote_name
+    partition = [F('content_type_id'), F('object_id'), TruncMonth('created_at')]
+    sql, params = get_window_sql(dataset,
+        month_sum=Window(Sum('value', output_field=get_window_output_field(connection)),
+            partition_by=partition),
+        month_count=Window(Count('id'), partition_by=partition),
+        position=Window(RowNumber(), partition_by=partition,
+            order_by=[F('created_at').desc(), F('id').desc()]),
+    )
+    select = (
+        "SELECT w.{id}, w.{sum} FROM ({sql}) w "
+        "WHERE w.{position} = 1 AND w.{count} > 1"
+    ).format(id=qn('id'), sum=qn('month_sum'), position=qn('position'), count=qn('month_count'),
+        sql=sql)
+    delete = (
+        "DELETE FROM {table} WHERE {id} IN (SELECT w.{id} FROM ({sql}) w WHERE w.{position} > 1)"
+    ).format(table=qn(dataset.model._meta.db_table), id=qn('id'), position=qn('position'),
+        sql=sql)
+    compacted = "SELECT w.{id} FROM ({sql}) w WHERE w.{count} > 1".format(
+        id=qn('id'), count=qn('month_count'), sql=sql)
+    objects, span = get_compacted(dataset, compacted, params)
+    with connection.cursor() as cursor:
+        cursor.execute(select, params)
+        monthly = [
+            dataset.model(id=pk, value=decimal.Decimal(str(value)))
+            for pk, value in cursor.fetchall()
+        ]
+        dataset.model.objects.using(dataset.db).bulk_update(monthly, ('value',), batch_size=1000)
+        cursor.execute(delete, params)
+        rowcount = cursor.rowcount
+    refresh_rollups(objects, span)
+    return rowcount
+
+
+def monthly_sum_old_values(dataset, **kwargs):
+    return compact(dataset, sum_chunk_monthly_values, **kwargs)
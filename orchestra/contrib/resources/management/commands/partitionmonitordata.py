@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from orchestra.contrib.resources import partitions
+
+
+class Command(BaseCommand):
+    help = ('Converts the monitor data table to monthly partitions (PostgreSQL 11 or later), '
+            'or creates the missing partitions when it is already partitioned.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database, defaults to the "default" one.')
+        parser.add_argument('--ahead', action='store', dest='ahead', type=int,
+            help='Monthly partitions created in advance, RESOURCES_MONITOR_DATA_PARTITIONS_AHEAD '
+                 'by default.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity'))
+        connection = partitions.get_connection(options.get('database'))
+        if not partitions.is_supported(connection):
+            raise CommandError("Partitioning requires PostgreSQL 11 or later, "
+                               "monitor data is kept on a single table.")
+        if partitions.partition(connection) and verbosity:
+            self.stdout.write('Monitor data has been partitioned by month.')
+        created = partitions.create_partitions(connection, ahead=options.get('ahead'))
+        if verbosity:
+            for name in created:
+                self.stdout.write('Created partition %s.' % name)
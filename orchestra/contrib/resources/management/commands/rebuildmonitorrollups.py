@@ -0,0 +1,43 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from orchestra.contrib.resources import rollups
+from orchestra.contrib.resources.models import MonitorData
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the hourly, daily and monthly rollups from the stored monitor data, '
+            'needed for backfilling them on existing data. Months with expired raw data '
+            'are not rebuilt.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('monitors', nargs='*',
+            help='Monitors to rebuild, all by default.')
+        parser.add_argument('--from', action='store', dest='from_date',
+            help='Rebuilds since the month of this date (YYYY-MM-DD) instead of all the data.')
+        parser.add_argument('-p', '--period', action='append', dest='periods',
+            choices=list(rollups.MODELS),
+            help='Period to rebuild, all by default. Can be used multiple times.')
+
+    def handle(self, *args, **options):
+        dataset = MonitorData.objects.all()
+        if options.get('monitors'):
+            dataset = dataset.filter(monitor__in=options.get('monitors'))
+        from_date = options.get('from_date')
+        if from_date:
+            date = parse_date(from_date)
+            if date is None:
+                raise CommandError("'%s' is not a valid date." % from_date)
+            date = datetime.datetime(year=date.year, month=date.month, day=1)
+            # Whole months, which contain whole days and hours as well
+            dataset = dataset.filter(created_at__gte=timezone.make_aware(date, is_dst=False))
+        count = rollups.rebuild(dataset, periods=options.get('periods'))
+        if int(options.get('verbosity')):
+            self.stdout.write('%i rollups have been rebuilt.' % count)
+            complete_since = rollups.get_complete_since()
+            if complete_since is not None:
+                self.stdout.write('Rollups before %s have been kept, their raw data has expired.'
+                    % timezone.localtime(complete_since).date())
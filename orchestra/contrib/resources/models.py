@@ -1,3 +1,5 @@
+import decimal
+
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.apps import apps
@@ -10,6 +12,7 @@ from djcelery.models import PeriodicTask
 from orchestra.core import validators
 from orchestra.models import queryset, fields
 from orchestra.models.utils import get_model_field_path
+from orchestra.utils.index import VersionedIndex
 
 from . import tasks
 from .backends import ServiceMonitor
@@ -122,24 +125,29 @@ class Resource(models.Model):
 
     def sync_periodic_task(self, delete=False):
         """ sync periodic task on save/delete resource operations """
-        name = 'monitor.%s' % self
-        if delete or not self.crontab or not self.is_active:
-            PeriodicTask.objects.filter(name=name).delete()
-        elif self.pk:
-            try:
-                task = PeriodicTask.objects.get(name=name)
-            except PeriodicTask.DoesNotExist:
-                if self.is_active:
-                    PeriodicTask.objects.create(
-                        name=name,
-                        task='resources.Monitor',
-                        args=[self.pk],
-                        crontab=self.crontab
-                    )
+        type(self).sync_periodic_tasks()
+
+    @classmethod
+    def sync_periodic_tasks(cls):
+        """ a periodic task per crontab monitors all the active resources sharing it """
+        # Resources used to have a periodic task of their own
+        PeriodicTask.objects.filter(task='resources.Monitor').delete()
+        crontabs = set(cls.objects.filter(is_active=True, crontab__isnull=False).values_list(
+            'crontab_id', flat=True))
+        tasks = PeriodicTask.objects.filter(task='resources.MonitorCrontab')
+        existing = set()
+        for task in tasks:
+            if task.crontab_id in crontabs and task.crontab_id not in existing:
+                existing.add(task.crontab_id)
             else:
-                if task.crontab != self.crontab:
-                    task.crontab = self.crontab
-                    task.save(update_fields=['crontab'])
+                task.delete()
+        for crontab_id in crontabs - existing:
+            PeriodicTask.objects.create(
+                name='monitor.crontab-%i' % crontab_id,
+                task='resources.MonitorCrontab',
+                args=[crontab_id],
+                crontab_id=crontab_id,
+            )
 
     def get_model_path(self, monitor):
         """ returns a model path between self.content_type and monitor.model """
@@ -150,6 +158,51 @@ class Resource(models.Model):
     def get_scale(self):
         return eval(self.scale)
 
+    def get_usages(self, ids=None):
+        """
+        {object_id: usage} of all the objects of this resource (or ids), unscaled
+        each monitor is computed with a few grouped queries instead of per object
+        """
+        return self.sum_usages(self.get_monitor_usages(monitor, ids=ids) for monitor in self.monitors)
+
+    def get_monitor_usages(self, monitor, ids=None):
+        """ {object_id: usage} of the data of one of the monitors of this resource """
+        aggregation = self.aggregation_instance
+        path = self.get_model_path(monitor)
+        monitor_model = ServiceMonitor.get_backend(monitor).model_class()
+        ct = ContentType.objects.get_for_model(monitor_model)
+        dataset = aggregation.get_dataset().filter(monitor=monitor, content_type=ct)
+        owners = None
+        if path == []:
+            if ids is not None:
+                dataset = dataset.filter(object_id__in=ids)
+        else:
+            fields = '__'.join(path)
+            objects = monitor_model.objects.all()
+            if ids is not None:
+                objects = objects.filter(**{'%s__in' % fields: ids})
+            owners = dict(objects.values_list('id', fields))
+            dataset = dataset.filter(object_id__in=objects.values('id'))
+        dataset = aggregation.filter(dataset)
+        usages = {}
+        for object_id, usage in aggregation.compute_usages(dataset).items():
+            if usage is None:
+                continue
+            if owners is not None:
+                object_id = owners.get(object_id)
+                if object_id is None:
+                    continue
+            usages[object_id] = usages.get(object_id, 0) + usage
+        return usages
+
+    @staticmethod
+    def sum_usages(monitor_usages):
+        usages = {}
+        for monitor_usage in monitor_usages:
+            for object_id, usage in monitor_usage.items():
+                usages[object_id] = usages.get(object_id, 0) + usage
+        return usages
+
     def get_verbose_name(self):
         return self.verbose_name or self.name
 
@@ -175,6 +228,41 @@ class ResourceDataQuerySet(models.QuerySet):
                 allocated=resource.default_allocation
             ), True
 
+    def update_used(self, resource, objects, ids=None, usages=None):
+        """
+        bulk version of get_or_create(obj, resource).update() for all objects
+        usages are computed unless provided, returns [(obj, data)]
+        """
+        ct = resource.content_type
+        if usages is None:
+            usages = resource.get_usages(ids=ids)
+        scale = resource.get_scale()
+        dataset = self.filter(resource=resource, content_type=ct)
+        if ids is not None:
+            dataset = dataset.filter(object_id__in=ids)
+        dataset = {data.object_id: data for data in dataset}
+        now = timezone.now()
+        result = []
+        created = []
+        updated = []
+        for obj in objects:
+            try:
+                data = dataset[obj.pk]
+            except KeyError:
+                data = self.model(resource=resource, content_type=ct, object_id=obj.pk,
+                    allocated=resource.default_allocation)
+                created.append(data)
+            else:
+                updated.append(data)
+            used = usages.get(obj.pk)
+            data.used = float(used)/scale if used else 0
+            data.updated_at = now
+            data.content_object_repr = str(obj)[:256]
+            result.append((obj, data))
+        self.bulk_create(created, batch_size=1000)
+        self.bulk_update(updated, ('used', 'updated_at', 'content_object_repr'), batch_size=1000)
+        return result
+
 
 class ResourceData(models.Model):
     """ Stores computed resource usage and allocation """
@@ -213,7 +301,8 @@ class ResourceData(models.Model):
         resource = self.resource
         total = 0
         has_result = False
-        for monitor, dataset in self.get_monitor_datasets():
+        datasets = self.get_monitor_datasets(resource.aggregation_instance.get_dataset())
+        for monitor, dataset in datasets:
             dataset = resource.aggregation_instance.filter(dataset)
             usage = resource.aggregation_instance.compute_usage(dataset)
             if usage is not None:
@@ -235,12 +324,15 @@ class ResourceData(models.Model):
             return tasks.monitor.delay(self.resource_id, ids=ids)
         return tasks.monitor(self.resource_id, ids=ids)
 
-    def get_monitor_datasets(self):
+    def get_monitor_datasets(self, queryset=None):
+        """ MonitorData (or rollups queryset) of each monitor of this resource """
+        if queryset is None:
+            queryset = MonitorData.objects.all()
         resource = self.resource
         for monitor in resource.monitors:
             path = resource.get_model_path(monitor)
             if path == []:
-                dataset = MonitorData.objects.filter(
+                dataset = queryset.filter(
                     monitor=monitor,
                     content_type=self.content_type_id,
                     object_id=self.object_id,
@@ -251,7 +343,7 @@ class ResourceData(models.Model):
                 objects = monitor_model.objects.filter(**{fields: self.object_id})
                 pks = objects.values_list('id', flat=True)
                 ct = ContentType.objects.get_for_model(monitor_model)
-                dataset = MonitorData.objects.filter(
+                dataset = queryset.filter(
                     monitor=monitor,
                     content_type=ct,
                     object_id__in=pks,
@@ -278,6 +370,7 @@ class MonitorData(models.Model):
 
     content_object = GenericForeignKey()
     objects = MonitorDataQuerySet.as_manager()
+    is_rollup = False
 
     class Meta:
         get_latest_by = 'id'
@@ -294,9 +387,116 @@ class MonitorData(models.Model):
         return self.resource.unit
 
 
+class MonitorRollup(models.Model):
+    """
+    Summary of the monitored data of an object during a period (hour, day or month)
+    maintained incrementally when the data is stored, see rollups.py
+    """
+    monitor = models.CharField(_("monitor"), max_length=256,
+        choices=ServiceMonitor.get_choices())
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE,
+        verbose_name=_("content type"))
+    object_id = models.PositiveIntegerField(_("object id"))
+    created_at = models.DateTimeField(_("period"), db_index=True,
+        help_text=_("Start of the period."))
+    count = models.PositiveIntegerField(_("count"), default=0)
+    sum = models.DecimalField(_("sum"), max_digits=20, decimal_places=2, default=0)
+    last_value = models.DecimalField(_("last value"), max_digits=16, decimal_places=2, null=True)
+    last_at = models.DateTimeField(_("last sample"))
+    weighted = models.DecimalField(_("time-weighted sum"), max_digits=30, decimal_places=3,
+        default=0, help_text=_("Sum of each value multiplied by the seconds elapsed since the "
+                               "previous sample, or since the start of the period."))
+    content_object_repr = models.CharField(_("content object representation"), max_length=256,
+        editable=False)
+
+    content_object = GenericForeignKey()
+    is_rollup = True
+
+    class Meta:
+        abstract = True
+        unique_together = (
+            ('monitor', 'content_type', 'object_id', 'created_at'),
+        )
+        index_together = (
+            ('content_type', 'object_id'),
+        )
+
+    def __str__(self):
+        return str(self.monitor)
+
+    @property
+    def key(self):
+        return (self.monitor, self.content_type_id, self.object_id, self.created_at)
+
+    def add(self, mdata):
+        """ adds a sample, samples are expected to be added in chronological order """
+        elapsed = (mdata.created_at-self.last_at).total_seconds()
+        self.weighted += mdata.value * decimal.Decimal(str(elapsed))
+        self.sum += mdata.value
+        self.count += 1
+        self.last_value = mdata.value
+        self.last_at = mdata.created_at
+        self.content_object_repr = mdata.content_object_repr
+
+    def get_average(self):
+        """ time-weighted average since the start of the period """
+        total = (self.last_at-self.created_at).total_seconds()
+        if not total:
+            return self.last_value
+        return self.weighted / decimal.Decimal(str(total))
+
+
+class HourlyMonitorData(MonitorRollup):
+    period = 'hourly'
+
+    class Meta(MonitorRollup.Meta):
+        verbose_name_plural = _("hourly monitor data")
+
+
+class DailyMonitorData(MonitorRollup):
+    period = 'daily'
+
+    class Meta(MonitorRollup.Meta):
+        verbose_name_plural = _("daily monitor data")
+
+
+class MonthlyMonitorData(MonitorRollup):
+    period = 'monthly'
+
+    class Meta(MonitorRollup.Meta):
+        verbose_name_plural = _("monthly monitor data")
+
+
+class ResourceIndex(VersionedIndex):
+    """ process-wide index of resources by content type and name, invalidated by Resource changes """
+    version_key = 'resources.resource_index.version'
+
+    def get_timeout(self):
+        from . import settings
+        return settings.RESOURCES_INDEX_TIMEOUT
+
+    def build(self):
+        resources = {}
+        for resource in Resource.objects.all():
+            resources.setdefault(resource.content_type_id, {})[resource.name] = resource
+        return resources
+
+    def get(self, model):
+        """ {name: resource} of model """
+        content_type = ContentType.objects.get_for_model(model)
+        return super(ResourceIndex, self).get().get(content_type.pk, {})
+
+
+resource_index = ResourceIndex()
+
+
 def create_resource_relation():
     class ResourceHandler(object):
-        """ account.resources.web """
+        """
+        account.resources.web
+        
+        resource data loaded with prefetch_related('resource_set') is used without querying
+        """
         def __getattr__(self, attr):
             """ get or build ResourceData """
             if attr.startswith('_'):
@@ -308,20 +508,29 @@ def create_resource_relation():
             except KeyError:
                 pass
             try:
-                rdata = self.obj.resource_set.get(resource__name=attr)
-            except ResourceData.DoesNotExist:
-                model = self.obj._meta.model_name
-                resource = Resource.objects.get(
-                    content_type__model=model,
-                    name=attr,
-                    is_active=True
-                )
+                resource = resource_index.get(type(self.obj))[attr]
+            except KeyError:
+                raise Resource.DoesNotExist("Resource '%s' does not exist." % attr)
+            rdata = None
+            prefetched = getattr(self.obj, '_prefetched_objects_cache', {})
+            if 'resource_set' in prefetched:
+                for data in prefetched['resource_set']:
+                    if data.resource_id == resource.pk:
+                        rdata = data
+                        break
+            else:
+                rdata = self.obj.resource_set.filter(resource=resource).first()
+            if rdata is None:
+                if not resource.is_active:
+                    raise Resource.DoesNotExist("Resource '%s' is not active." % attr)
                 rdata = ResourceData(
                     content_object=self.obj,
                     content_object_repr=str(self.obj),
                     resource=resource,
                     allocated=resource.default_allocation
                 )
+            else:
+                rdata.resource = resource
             self.obj.__resource_cache[attr] = rdata
             return rdata
 
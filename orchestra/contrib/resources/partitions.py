@@ -0,0 +1,175 @@
+"""
+Monthly partitions of the MonitorData table on PostgreSQL 11+
+
+The table is converted once with the partitionmonitordata command, then partitions are created
+ahead of time by a periodic task and whole partitions are dropped when monitor data expires.
+Rows of months without partition go to the default partition, and they are moved to their own
+partition when it is created.
+Other databases (SQLite on tests) keep a single table and every function is a no-op.
+"""
+import datetime
+import logging
+import re
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from . import rollups
+from .models import MonitorData
+
+
+logger = logging.getLogger(__name__)
+
+TABLE = MonitorData._meta.db_table
+DEFAULT = '%s_default' % TABLE
+PARTITION_RE = re.compile(r'^%s_p(\d{4})(\d{2})$' % TABLE)
+
+
+def get_connection(using=None):
+    return connections[using or MonitorData.objects.db]
+
+
+def is_supported(connection):
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def is_partitioned(connection):
+    if not is_supported(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt "
+            "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = %s", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def get_month(date):
+    """ (start, end) of the month containing date, in local time like the aggregations """
+    return rollups.get_period(date, rollups.MONTHLY)
+
+
+def get_next_month(end):
+    """ month starting at end """
+    return get_month(end + datetime.timedelta(days=15))
+
+
+def get_partition_name(start):
+    return '%s_p%s' % (TABLE, start.strftime('%Y%m'))
+
+
+def get_partitions(connection):
+    """ {name: (start, end)} of the monthly partitions """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", [TABLE])
+        names = [name for name, in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        match = PARTITION_RE.match(name)
+        if match:
+            year, month = map(int, match.groups())
+            date = datetime.datetime(year=year, month=month, day=15, tzinfo=datetime.timezone.utc)
+            partitions[name] = get_month(date)
+    return partitions
+
+
+def create_partition(connection, start, end):
+    """
+    creates the partition of [start, end) moving its rows out of the default partition
+    rows of [start, end) inserted into the default partition by other transactions between
+    the move and the ATTACH make the ATTACH fail, so create partitions ahead of the data
+    """
+    qn = connection.ops.quote_name
+    name = get_partition_name(start)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (qn(name), qn(TABLE)))
+        cursor.execute(
+            "WITH moved AS ("
+            "DELETE FROM {default} WHERE {created_at} >= %s AND {created_at} < %s RETURNING *"
+            ") INSERT INTO {name} SELECT * FROM moved".format(
+                default=qn(DEFAULT), created_at=qn('created_at'), name=qn(name)),
+            [start, end])
+        cursor.execute(
+            "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)" % (
+                qn(TABLE), qn(name)), [start, end])
+    logger.info("Created partition %s [%s, %s)" % (name, start, end))
+    return name
+
+
+def create_partitions(connection, ahead=None, since=None):
+    """ creates the missing partitions from since (current month) to ahead months later """
+    from . import settings
+    if ahead is None:
+        ahead = settings.RESOURCES_MONITOR_DATA_PARTITIONS_AHEAD
+    if not is_partitioned(connection):
+        return []
+    existing = get_partitions(connection)
+    created = []
+    __, last_end = get_month(timezone.now())
+    for __ in range(ahead):
+        __, last_end = get_next_month(last_end)
+    start, end = get_month(since or timezone.now())
+    while start < last_end:
+        if get_partition_name(start) not in existing:
+            created.append(create_partition(connection, start, end))
+        start, end = get_next_month(end)
+    return created
+
+
+def drop_partitions(connection, threshold):
+    """ drops the partitions that only contain data older than threshold """
+    if not is_partitioned(connection):
+        return []
+    qn = connection.ops.quote_name
+    dropped = []
+    for name, (start, end) in sorted(get_partitions(connection).items()):
+        if end <= threshold:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE %s" % qn(name))
+            logger.info("Dropped partition %s [%s, %s)" % (name, start, end))
+            dropped.append(name)
+    return dropped
+
+
+def partition(connection):
+    """
+    converts the MonitorData table to a table partitioned by month, copying all its rows
+    the table is locked until the copy finishes
+    """
+    if not is_supported(connection):
+        raise NotImplementedError("Partitioning requires PostgreSQL 11 or later.")
+    if is_partitioned(connection):
+        return False
+    qn = connection.ops.quote_name
+    old = '%s_unpartitioned' % TABLE
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(TABLE), qn(old)))
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [old])
+            sequence, = cursor.fetchone()
+            cursor.execute(
+                "CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) "
+                "PARTITION BY RANGE ({created_at})".format(
+                    table=qn(TABLE), old=qn(old), created_at=qn('created_at')))
+            # Unique constraints must include the partition key
+            cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (id, created_at)" % (
+                qn(TABLE), qn('%s_part_pkey' % TABLE)))
+            cursor.execute(
+                "ALTER TABLE {table} ADD FOREIGN KEY (content_type_id) "
+                "REFERENCES django_content_type (id) DEFERRABLE INITIALLY DEFERRED".format(
+                    table=qn(TABLE)))
+            for fields in (('created_at',), ('monitor',), ('content_type_id', 'object_id')):
+                cursor.execute("CREATE INDEX %s ON %s (%s)" % (
+                    qn('%s_%s_part_idx' % (TABLE, '_'.join(fields))), qn(TABLE),
+                    ', '.join(map(qn, fields))))
+            cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT" % (qn(DEFAULT), qn(TABLE)))
+            cursor.execute("SELECT MIN(created_at) FROM %s" % qn(old))
+            since, = cursor.fetchone()
+        create_partitions(connection, since=since)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO %s SELECT * FROM %s" % (qn(TABLE), qn(old)))
+            cursor.execute("ALTER SEQUENCE %s OWNED BY %s.id" % (sequence, qn(TABLE)))
+            cursor.execute("DROP TABLE %s" % qn(old))
+    return True
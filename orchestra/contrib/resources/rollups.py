@@ -0,0 +1,208 @@
+"""
+Hourly, daily and monthly summaries of MonitorData
+
+Rollups are updated incrementally when monitored data is stored, samples older than the last
+one of their period trigger a rebuild of that period from the raw data.
+Periods are truncated in local time, like the created_at__month lookups of the aggregations.
+
+Rollups are never rebuilt on months whose raw data has been partially expired, they have been
+computed with data that no longer exists. Compacted raw data refreshes the rollups of its months.
+"""
+import datetime
+import itertools
+
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, FloatField
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from . import settings
+from .models import MonitorData, HourlyMonitorData, DailyMonitorData, MonthlyMonitorData
+
+
+HOURLY = 'hourly'
+DAILY = 'daily'
+MONTHLY = 'monthly'
+
+MODELS = {
+    model.period: model for model in (HourlyMonitorData, DailyMonitorData, MonthlyMonitorData)
+}
+
+
+def truncate(date, period):
+    """ start of the period containing date """
+    if period == HOURLY:
+        # Truncated in UTC, local hours are ambiguous on DST changes
+        return date.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    date = timezone.localtime(date).replace(tzinfo=None)
+    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == MONTHLY:
+        date = date.replace(day=1)
+    elif period != DAILY:
+        raise ValueError("Unknown period '%s'" % period)
+    return timezone.make_aware(date, is_dst=False)
+
+
+def get_period(date, period):
+    """ (start, end) of the period containing date """
+    start = truncate(date, period)
+    if period == HOURLY:
+        end = start + datetime.timedelta(hours=1)
+    elif period == DAILY:
+        end = truncate(start + datetime.timedelta(hours=36), period)
+    else:
+        end = truncate(start + datetime.timedelta(days=45), period)
+    return start, end
+
+
+def get_complete_since(now=None):
+    """
+    start of the first month whose raw data has not been expired by expire_monitor_data,
+    None when raw data never expires
+    """
+    days = settings.RESOURCES_MONITOR_DATA_EXPIRE_DAYS
+    if days is None:
+        return None
+    threshold = (now or timezone.now()) - datetime.timedelta(days=days)
+    start, end = get_period(threshold, MONTHLY)
+    return start if start == threshold else end
+
+
+def get_dataset(period, field):
+    """ rollup queryset annotated with the value used by the aggregations """
+    if field == 'avg':
+        value = Cast('sum', FloatField()) / F('count')
+        value = ExpressionWrapper(value, output_field=FloatField())
+    else:
+        value = F(field)
+    return MODELS[period].objects.annotate(value=value)
+
+
+def get_key(mdata, period):
+    return (mdata.monitor, mdata.content_type_id, mdata.object_id,
+        truncate(mdata.created_at, period))
+
+
+def save(model, rollups):
+    """ bulk creates or updates rollups, matching existing rows by their key """
+    rollups = {rollup.key: rollup for rollup in rollups}
+    if not rollups:
+        return
+    existing = model.objects.filter(
+        monitor__in=set(key[0] for key in rollups),
+        content_type_id__in=set(key[1] for key in rollups),
+        object_id__in=set(key[2] for key in rollups),
+        created_at__in=set(key[3] for key in rollups),
+    ).values_list('monitor', 'content_type_id', 'object_id', 'created_at', 'id')
+    to_update = []
+    for monitor, content_type_id, object_id, created_at, pk in existing:
+        rollup = rollups.get((monitor, content_type_id, object_id, created_at))
+        if rollup is not None:
+            rollup.pk = pk
+            to_update.append(rollup)
+    to_create = [rollup for rollup in rollups.values() if rollup.pk is None]
+    fields = ('count', 'sum', 'last_value', 'last_at', 'weighted', 'content_object_repr')
+    model.objects.bulk_update(to_update, fields, batch_size=1000)
+    model.objects.bulk_create(to_create, batch_size=1000)
+
+
+def create(model, key):
+    monitor, content_type_id, object_id, start = key
+    return model(monitor=monitor, content_type_id=content_type_id, object_id=object_id,
+        created_at=start, last_at=start)
+
+
+@transaction.atomic
+def update(data):
+    """ adds the samples of the MonitorData instances data to the rollups of every period """
+    if not data:
+        return
+    for period, model in MODELS.items():
+        buckets = {}
+        for mdata in data:
+            buckets.setdefault(get_key(mdata, period), []).append(mdata)
+        existing = model.objects.filter(
+            monitor__in=set(key[0] for key in buckets),
+            content_type_id__in=set(key[1] for key in buckets),
+            object_id__in=set(key[2] for key in buckets),
+            created_at__in=set(key[3] for key in buckets),
+        )
+        existing = {rollup.key: rollup for rollup in existing}
+        rollups = []
+        for key, samples in buckets.items():
+            samples.sort(key=lambda mdata: mdata.created_at)
+            rollup = existing.get(key)
+            if rollup is None:
+                rollup = create(model, key)
+            elif samples[0].created_at < rollup.last_at:
+                # Out of order
+                monitor, content_type_id, object_id, start = key
+                start, end = get_period(start, period)
+                rebuild(MonitorData.objects.filter(monitor=monitor,
+                    content_type_id=content_type_id, object_id=object_id,
+                    created_at__gte=start, created_at__lt=end), periods=[period])
+                continue
+            for mdata in samples:
+                rollup.add(mdata)
+            rollups.append(rollup)
+        save(model, rollups)
+
+
+def build(dataset, period):
+    """ lazily yields the rollups of dataset, which should contain whole periods """
+    model = MODELS[period]
+    dataset = dataset.order_by('monitor', 'content_type_id', 'object_id', 'created_at')
+    for key, samples in itertools.groupby(dataset.iterator(), key=lambda m: get_key(m, period)):
+        rollup = create(model, key)
+        for mdata in samples:
+            rollup.add(mdata)
+        yield rollup
+
+
+@transaction.atomic
+def rebuild(dataset, periods=None, chunk_size=1000):
+    """
+    (re)creates the rollups of dataset, returns the number of rollups
+    months with expired raw data are left out, their rollups are more complete than the data
+    """
+    complete_since = get_complete_since()
+    if complete_since is not None:
+        dataset = dataset.filter(created_at__gte=complete_since)
+    count = 0
+    for period in periods or MODELS:
+        model = MODELS[period]
+        rollups = build(dataset, period)
+        for chunk in iter(lambda: list(itertools.islice(rollups, chunk_size)), []):
+            save(model, chunk)
+            count += len(chunk)
+    return count
+
+
+@transaction.atomic
+def refresh(objects, since, until):
+    """
+    rebuilds the rollups of objects, (monitor, content_type_id, object_id) tuples, on the months
+    between since and until after their raw data has been compacted,
+    rollups left without raw data are deleted
+    """
+    start = truncate(since, MONTHLY)
+    end = get_period(until, MONTHLY)[1]
+    complete_since = get_complete_since()
+    if complete_since is not None:
+        start = max(start, complete_since)
+    if not objects or start >= end:
+        return 0
+    count = 0
+    for monitor, content_type_id in set((obj[0], obj[1]) for obj in objects):
+        object_ids = [obj[2] for obj in objects if obj[:2] == (monitor, content_type_id)]
+        filters = {
+            'monitor': monitor,
+            'content_type_id': content_type_id,
+            'object_id__in': object_ids,
+            'created_at__gte': start,
+            'created_at__lt': end,
+        }
+        for model in MODELS.values():
+            model.objects.filter(**filters).delete()
+        count += rebuild(MonitorData.objects.filter(**filters))
+    return count
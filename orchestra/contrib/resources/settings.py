@@ -1,6 +1,78 @@
+from django.utils.translation import gettext_lazy as _
+
 from orchestra.contrib.settings import Setting
 
 
 RESOURCES_OLD_MONITOR_DATA_DAYS = Setting('RESOURCES_OLD_MONITOR_DATA_DAYS',
     40,
 )
+
+
+RESOURCES_CLEANUP_CHUNK_SIZE = Setting('RESOURCES_CLEANUP_CHUNK_SIZE',
+    100,
+    help_text=_("Number of monitored objects whose old data is compacted on each transaction."),
+)
+
+
+RESOURCES_READ_MONITOR_ROLLUPS = Setting('RESOURCES_READ_MONITOR_ROLLUPS',
+    False,
+    help_text=_("Compute usage and history from the hourly, daily and monthly rollups when the "
+                "aggregation allows it. Rollups are always kept up to date with new data, run "
+                "<tt>rebuildmonitorrollups</tt> for backfilling the existing monitor data before "
+                "enabling it."),
+)
+
+
+RESOURCES_MONITOR_DATA_EXPIRE_DAYS = Setting('RESOURCES_MONITOR_DATA_EXPIRE_DAYS',
+    None,
+    help_text=_("Raw monitor data older than this number of days is deleted, rollups are kept "
+                "and are not rebuilt from the remaining data of those months. "
+                "It should cover the periods aggregated from raw data, like 'Last 10 days AVG'. "
+                "<tt>None</tt> keeps it forever."),
+)
+
+
+RESOURCES_HOURLY_ROLLUP_EXPIRE_DAYS = Setting('RESOURCES_HOURLY_ROLLUP_EXPIRE_DAYS',
+    90,
+    help_text=_("Hourly monitor rollups older than this number of days are deleted, "
+                "<tt>None</tt> keeps them forever."),
+)
+
+
+RESOURCES_MONITOR_DATA_PARTITIONS_AHEAD = Setting('RESOURCES_MONITOR_DATA_PARTITIONS_AHEAD',
+    3,
+    help_text=_("Monthly partitions created in advance when monitor data is partitioned with "
+                "<tt>partitionmonitordata</tt> (PostgreSQL only)."),
+)
+
+
+RESOURCES_MONITOR_WORKERS = Setting('RESOURCES_MONITOR_WORKERS',
+    4,
+    help_text=_("Monitors executed concurrently by a monitoring task, usage of each monitor is "
+                "computed as soon as its data is stored. <tt>1</tt> executes them one after "
+                "another on the task thread."),
+)
+
+
+RESOURCES_MONITOR_STATE_DIR = Setting('RESOURCES_MONITOR_STATE_DIR',
+    '/var/lib/orchestra/monitors',
+    help_text=_("Directory of the servers where traffic monitors keep the offsets of the log "
+                "files they have already parsed."),
+)
+
+
+RESOURCES_MONITOR_STATE_EXPIRE_DAYS = Setting('RESOURCES_MONITOR_STATE_EXPIRE_DAYS',
+    7,
+    help_text=_("Days after which the log offsets kept by traffic monitors for objects that are no "
+                "longer monitored, like deleted ones, are removed. It should be longer than the "
+                "time a message can stay on the mail queue."),
+)
+
+
+RESOURCES_INDEX_TIMEOUT = Setting('RESOURCES_INDEX_TIMEOUT',
+    60,
+    help_text=_("Seconds before rebuilding the process-wide index of resources used by "
+                "<tt>object.resources.&lt;name&gt;</tt>. Resource changes invalidate it right away "
+                "on the current process, and on other processes when the default cache backend is "
+                "shared between them."),
+)
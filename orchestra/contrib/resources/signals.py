@@ -1,7 +1,8 @@
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from .models import Resource
+from . import rollups
+from .models import Resource, MonitorData, resource_index
 
 
 @receiver(post_save, sender=Resource, dispatch_uid="resources.sync_periodic_task")
@@ -16,3 +17,16 @@ def delete_periodic_task(sender, **kwargs):
     """ useing signals instead of Model.delete() override beucause of admin bulk delete() """
     instance = kwargs['instance']
     instance.sync_periodic_task(delete=True)
+
+
+post_save.connect(resource_index.invalidate_receiver, sender=Resource,
+    dispatch_uid="resources.resource_index.save")
+post_delete.connect(resource_index.invalidate_receiver, sender=Resource,
+    dispatch_uid="resources.resource_index.delete")
+
+
+@receiver(post_save, sender=MonitorData, dispatch_uid="resources.update_rollups")
+def update_rollups(sender, **kwargs):
+    """ data created one at a time, bulk stored data is rolled up by ServiceMonitor.store() """
+    if kwargs['created'] and not kwargs['raw']:
+        rollups.update([kwargs['instance']])
@@ -1,77 +1,260 @@
 import datetime
+import logging
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import wraps
 
+from celery import current_task
 from celery.task.schedules import crontab
-from django.db import transaction
+from django import db
+from django.core.cache import cache
 from django.utils import timezone
 
 from orchestra.contrib.orchestration import Operation
 from orchestra.contrib.tasks import task, periodic_task
 from orchestra.models.utils import get_model_field_path
-from orchestra.utils.sys import LockFile
+from orchestra.utils.sys import LockFile, OperationLocked
 
 from . import settings
 from .backends import ServiceMonitor
 
 
+logger = logging.getLogger(__name__)
+
+# Last (content_type_id, object_id) compacted of each monitor
+CLEANUP_CHECKPOINTS_KEY = 'resources.cleanup_old_monitors.checkpoints'
+CLEANUP_DONE = 'done'
+
+MONITOR = 'monitor'
+USAGE = 'usage'
+
+
+class SerialExecutor(object):
+    """ executor running the tasks on the calling thread, sharing its database connection """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+def close_connection(fn):
+    """ pool threads have their own database connection, closed when finishing """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db.connection.close()
+    return wrapper
+
+
+def execute_monitor(resource, monitor_name, ids=None):
+    """ executes monitor_name on the objects of resource (or ids) and stores its data """
+    backend = ServiceMonitor.get_backend(monitor_name)
+    model = backend.model_class()
+    kwargs = {}
+    if ids:
+        path = get_model_field_path(model, resource.content_type.model_class())
+        path = '%s__in' % ('__'.join(path) or 'id')
+        kwargs = {
+            path: ids
+        }
+    monitorings = []
+    for obj in model.objects.filter(**kwargs):
+        op = Operation(backend, obj, Operation.MONITOR)
+        monitorings.append(op)
+    return Operation.execute(monitorings, run_async=False)
+
+
+def update_used(resource, usages, ids=None):
+    """ updates used resources and triggers resource exceeded and recovery """
+    from .models import ResourceData
+    # Triggers are executed by the last monitor
+    backend = ServiceMonitor.get_backend(resource.monitors[-1])
+    kwargs = {'id__in': ids} if ids else {}
+    triggers = []
+    model = resource.content_type.model_class()
+    objects = model.objects.filter(**kwargs)
+    for obj, data in ResourceData.objects.update_used(resource, objects, ids=ids or None, usages=usages):
+        if not resource.disable_trigger:
+            if data.used > (data.allocated or 0):
+                op = Operation(backend, obj, Operation.EXCEEDED)
+                triggers.append(op)
+            elif data.used < (data.allocated or 0):
+                op = Operation(backend, obj, Operation.RECOVERY)
+                triggers.append(op)
+    Operation.execute(triggers)
+
+
+def monitor_resources(resources, ids=None):
+    """
+    executes the monitors of resources concurrently, on RESOURCES_MONITOR_WORKERS threads
+    the usage of each monitor is computed as soon as its data is stored and each resource is
+    updated as soon as all its monitors are done, monitors shared by resources are executed once
+    """
+    from .models import Resource
+    resources = [resource for resource in resources if resource.monitors]
+    logs = []
+    workers = settings.RESOURCES_MONITOR_WORKERS
+    if workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        threaded = close_connection
+    else:
+        executor = SerialExecutor()
+        threaded = lambda fn: fn
+    pending = {resource: set(resource.monitors) for resource in resources}
+    usages = {resource: [] for resource in resources}
+    with executor:
+        running = {}
+        for resource in resources:
+            for monitor_name in resource.monitors:
+                if (MONITOR, monitor_name) not in running.values():
+                    future = executor.submit(threaded(execute_monitor), resource, monitor_name, ids)
+                    running[future] = (MONITOR, monitor_name)
+        while running:
+            done, __ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                kind, args = running.pop(future)
+                if kind == MONITOR:
+                    affected = [resource for resource in pending if args in pending[resource]]
+                    try:
+                        logs += future.result()
+                    except Exception:
+                        # Only the resources of the failing monitor are skipped
+                        logger.exception("Monitor %s failed, skipping %s" % (
+                            args, ', '.join(map(str, affected))))
+                        for resource in affected:
+                            pending.pop(resource)
+                            usages.pop(resource)
+                        continue
+                    for resource in affected:
+                        future = executor.submit(threaded(resource.get_monitor_usages), args, ids=ids)
+                        running[future] = (USAGE, (resource, args))
+                else:
+                    resource, monitor_name = args
+                    if resource not in pending:
+                        # Another monitor of this resource has failed
+                        continue
+                    try:
+                        usages[resource].append(future.result())
+                    except Exception:
+                        logger.exception("Usages of %s on %s failed, skipping it" % (
+                            monitor_name, resource))
+                        pending.pop(resource)
+                        usages.pop(resource)
+                        continue
+                    pending[resource].remove(monitor_name)
+                    if not pending[resource]:
+                        try:
+                            update_used(resource, Resource.sum_usages(usages[resource]), ids=ids)
+                        except Exception:
+                            logger.exception("Updating used %s failed" % resource)
+    return logs
+
+
 @task(name='resources.Monitor')
 def monitor(resource_id, ids=None):
     with LockFile('/dev/shm/resources.monitor-%i.lock' % resource_id, expire=60*60, unlocked=bool(ids)):
-        from .models import ResourceData, Resource
+        from .models import Resource
         resource = Resource.objects.get(pk=resource_id)
-        resource_model = resource.content_type.model_class()
-        logs = []
-        # Execute monitors
-        for monitor_name in resource.monitors:
-            backend = ServiceMonitor.get_backend(monitor_name)
-            model = backend.model_class()
-            kwargs = {}
-            if ids:
-                path = get_model_field_path(model, resource_model)
-                path = '%s__in' % ('__'.join(path) or 'id')
-                kwargs = {
-                    path: ids
-                }
-            # Execute monitor
-            monitorings = []
-            for obj in model.objects.filter(**kwargs):
-                op = Operation(backend, obj, Operation.MONITOR)
-                monitorings.append(op)
-            logs += Operation.execute(monitorings, run_async=False)
-
-        kwargs = {'id__in': ids} if ids else {}
-        # Update used resources and trigger resource exceeded and revovery
-        triggers = []
-        model = resource.content_type.model_class()
-        for obj in model.objects.filter(**kwargs):
-            data, __ = ResourceData.objects.get_or_create(obj, resource)
-            data.update()
-            if not resource.disable_trigger:
-                a = data.used
-                b = data.allocated
-                if data.used > (data.allocated or 0):
-                    op = Operation(backend, obj, Operation.EXCEEDED)
-                    triggers.append(op)
-                elif data.used < (data.allocated or 0):
-                    op = Operation(backend, obj, Operation.RECOVERY)
-                    triggers.append(op)
-        Operation.execute(triggers)
-        return logs
+        return monitor_resources([resource], ids=ids)
+
+
+@task(name='resources.MonitorCrontab')
+def monitor_crontab(crontab_id):
+    """ monitors all the active resources sharing a crontab, locked ones are skipped """
+    from .models import Resource
+    resources = []
+    with ExitStack() as locks:
+        for resource in Resource.objects.filter(crontab_id=crontab_id, is_active=True):
+            lock = LockFile('/dev/shm/resources.monitor-%i.lock' % resource.pk, expire=60*60)
+            try:
+                locks.enter_context(lock)
+            except OperationLocked as exc:
+                logger.warning(str(exc))
+            else:
+                resources.append(resource)
+        return monitor_resources(resources)
+
+
+def report_progress(**meta):
+    """ PROGRESS state of the running task, only logged when not executed by a celery worker """
+    logger.info("Progress %s" % ', '.join('%s=%s' % item for item in sorted(meta.items())))
+    if current_task and not current_task.request.called_directly:
+        current_task.update_state(state='PROGRESS', meta=meta)
 
 
 @periodic_task(run_every=crontab(hour=2, minute=30), name='resources.cleanup_old_monitors')
-@transaction.atomic
 def cleanup_old_monitors(queryset=None):
+    """
+    compacts old monitor data on a transaction per chunk of objects,
+    an interrupted run is resumed from its last checkpoint unless a queryset is provided
+    """
+    checkpoints = {}
     if queryset is None:
         from .models import MonitorData
         queryset = MonitorData.objects.all()
+        checkpoints = cache.get(CLEANUP_CHECKPOINTS_KEY) or {}
     delta = datetime.timedelta(days=settings.RESOURCES_OLD_MONITOR_DATA_DAYS)
     threshold = timezone.now() - delta
     queryset = queryset.filter(created_at__lt=threshold)
     delete_counts = []
     for monitor in ServiceMonitor.get_plugins():
-        dataset = queryset.filter(monitor=monitor)
-        delete_count = monitor.aggregate(dataset)
+        name = monitor.get_name()
+        start = checkpoints.get(name)
+        if start == CLEANUP_DONE:
+            continue
+        
+        def progress(checkpoint, delete_count, name=name):
+            checkpoints[name] = checkpoint
+            cache.set(CLEANUP_CHECKPOINTS_KEY, checkpoints, None)
+            report_progress(monitor=name, checkpoint=checkpoint, deleted=delete_count)
+        
+        dataset = queryset.filter(monitor=name)
+        delete_count = monitor.aggregate(dataset, start=start, progress=progress)
+        checkpoints[name] = CLEANUP_DONE
+        cache.set(CLEANUP_CHECKPOINTS_KEY, checkpoints, None)
+        delete_counts.append(
+            (name, delete_count)
+        )
+    cache.delete(CLEANUP_CHECKPOINTS_KEY)
+    return delete_counts
+
+
+@periodic_task(run_every=crontab(hour=3, minute=30), name='resources.expire_monitor_data')
+def expire_monitor_data():
+    """ deletes raw data and hourly rollups according to their expiration settings """
+    from . import partitions
+    from .models import MonitorData, HourlyMonitorData
+    now = timezone.now()
+    delete_counts = []
+    for model, days in ((MonitorData, settings.RESOURCES_MONITOR_DATA_EXPIRE_DAYS),
+                        (HourlyMonitorData, settings.RESOURCES_HOURLY_ROLLUP_EXPIRE_DAYS)):
+        if days is None:
+            continue
+        threshold = now - datetime.timedelta(days=days)
+        if model is MonitorData:
+            # Whole months first, then the remaining rows
+            partitions.drop_partitions(partitions.get_connection(), threshold)
+        delete_count, __ = model.objects.filter(created_at__lt=threshold).delete()
         delete_counts.append(
-            (monitor.get_name(), delete_count)
+            (model._meta.model_name, delete_count)
         )
     return delete_counts
+
+
+@periodic_task(run_every=crontab(hour=4, minute=30), name='resources.create_monitor_partitions')
+def create_monitor_partitions():
+    """ keeps RESOURCES_MONITOR_DATA_PARTITIONS_AHEAD monthly partitions ready for new data """
+    from . import partitions
+    return partitions.create_partitions(partitions.get_connection())
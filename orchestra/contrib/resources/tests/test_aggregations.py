@@ -0,0 +1,76 @@
+import datetime
+import decimal
+import random
+from unittest import skipUnless
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.orchestration.models import Server
+from orchestra.utils.tests import BaseTestCase
+
+from ..aggregations import (Last, MonthlySum, MonthlyAvg, Last10DaysAvg, VectorizedMonthlyAvg,
+    VectorizedLast10DaysAvg, vectorized)
+from ..models import MonitorData
+
+
+class AggregationTests(BaseTestCase):
+    def setUp(self):
+        self.servers = [Server.objects.create(name='web%i.example.com' % ix) for ix in range(3)]
+        ct = ContentType.objects.get_for_model(Server)
+        now = timezone.now()
+        for ix, server in enumerate(self.servers):
+            for minutes in range(0, 3*24*60, 6*60):
+                MonitorData.objects.create(monitor='TestMonitor', content_type=ct,
+                    object_id=server.pk, created_at=now-datetime.timedelta(minutes=minutes),
+                    value=decimal.Decimal(ix+minutes))
+        self.dataset = MonitorData.objects.filter(monitor='TestMonitor')
+
+    def assertUsages(self, aggregation):
+        dataset = aggregation.filter(self.dataset)
+        usages = aggregation.compute_usages(dataset)
+        for server in self.servers:
+            usage = aggregation.compute_usage(dataset.filter(object_id=server.pk))
+            self.assertEqual(usage, usages.get(server.pk))
+
+    def test_compute_usages(self):
+        for aggregation in (Last, MonthlySum, Last10DaysAvg):
+            self.assertUsages(aggregation())
+
+
+@skipUnless(vectorized, "NumPy is not installed")
+class VectorizedAggregationTests(BaseTestCase):
+    """ property test: the NumPy engine matches the Python implementation on random datasets """
+    def setUp(self):
+        self.ct = ContentType.objects.get_for_model(Server)
+        self.random = random.Random(1)
+
+    def generate_dataset(self):
+        MonitorData.objects.filter(monitor='TestMonitor').delete()
+        now = timezone.now()
+        data = []
+        for object_id in self.random.sample(range(1, 1000), self.random.randint(1, 10)):
+            for ix in range(self.random.randint(1, 10)):
+                seconds = self.random.randint(1, 9*24*60*60)
+                value = decimal.Decimal(self.random.randint(0, 10**8))/100
+                data.append(MonitorData(monitor='TestMonitor', content_type=self.ct,
+                    object_id=object_id, created_at=now-datetime.timedelta(seconds=seconds),
+                    value=value))
+        MonitorData.objects.bulk_create(data)
+        return MonitorData.objects.filter(monitor='TestMonitor')
+
+    def test_equivalence(self):
+        pairs = (
+            (MonthlyAvg(), VectorizedMonthlyAvg()),
+            (Last10DaysAvg(), VectorizedLast10DaysAvg()),
+        )
+        for ix in range(25):
+            dataset = self.generate_dataset()
+            for aggregation, vectorized_aggregation in pairs:
+                expected = aggregation.compute_usages(aggregation.filter(dataset))
+                usages = vectorized_aggregation.compute_usages(vectorized_aggregation.filter(dataset))
+                self.assertEqual(set(expected), set(usages))
+                for object_id, usage in usages.items():
+                    self.assertIsInstance(usage, decimal.Decimal)
+                    tolerance = max(abs(expected[object_id]), 1) * decimal.Decimal('1e-9')
+                    self.assertLessEqual(abs(usage-expected[object_id]), tolerance)
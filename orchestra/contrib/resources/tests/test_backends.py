@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+
+from orchestra.contrib.orchestration.models import BackendLog, Server
+from orchestra.utils.tests import BaseTestCase
+
+from ..backends import LOG_OFFSETS_SCRIPT, ServiceMonitor
+from ..models import MonitorData
+
+
+class StoreTestMonitor(ServiceMonitor):
+    model = 'orchestration.Server'
+    verbose_name = 'Store test'
+    store_chunk_size = 2
+
+
+class ServiceMonitorTests(BaseTestCase):
+    def test_store(self):
+        servers = [Server.objects.create(name='web%i.example.com' % ix) for ix in range(3)]
+        stdout = '\n'.join(['%i %i' % (server.pk, ix) for ix, server in enumerate(servers)] + [
+            'malformed',
+            '%i not-a-number' % servers[0].pk,
+            '%i 10' % (servers[-1].pk+100),
+        ])
+        log = BackendLog.objects.create(backend=StoreTestMonitor.get_name(), server=servers[0],
+            stdout=stdout, state=BackendLog.SUCCESS)
+        self.assertEqual(3, StoreTestMonitor().store(log))
+        dataset = MonitorData.objects.filter(monitor=StoreTestMonitor.get_name()).order_by('value')
+        self.assertEqual([str(server) for server in servers],
+            [data.content_object_repr for data in dataset])
+        self.assertIn('3 malformed output lines', BackendLog.objects.get(pk=log.pk).stderr)
+
+
+
+class LogOffsetsTests(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.log = os.path.join(self.tmp, 'access.log')
+        self.state = os.path.join(self.tmp, 'state', 'monitor.json')
+        namespace = {}
+        exec(LOG_OFFSETS_SCRIPT, namespace)
+        self.LogOffsets = namespace['LogOffsets']
+        self.executions = 0
+    
+    def write(self, content):
+        with open(self.log, 'a') as handler:
+            handler.write(content)
+    
+    def parse(self, object_ids, stored=True, expire_date='2026-01-01 00:00:00 UTC'):
+        """ stored tells whether the output of the previous execution has been stored """
+        self.executions += 1
+        current_date = '2026-01-01 %02d:00:00 UTC' % self.executions
+        last_date = '2026-01-01 %02d:00:00 UTC' % (self.executions - (1 if stored else 2))
+        log_offsets = self.LogOffsets(self.state, current_date, expire_date)
+        for object_id in object_ids:
+            log_offsets.prepare(object_id, last_date)
+        lines = {}
+        for inode, position, line in log_offsets.readlines([self.log+'.1', self.log], object_ids):
+            for object_id in object_ids:
+                if log_offsets.is_new(object_id, inode, position) is not False:
+                    lines.setdefault(object_id, []).append(line.strip())
+        log_offsets.save()
+        return lines
+    
+    def test_readlines(self):
+        self.write('a\nb\n')
+        self.assertEqual({1: ['a', 'b']}, self.parse([1]))
+        # Partial lines are parsed once completed
+        self.write('c\nd')
+        self.assertEqual({1: ['c'], 2: ['a', 'b', 'c']}, self.parse([1, 2]))
+        self.write('\n')
+        self.assertEqual({1: ['d'], 2: ['d']}, self.parse([1, 2]))
+        # Followed by inode on rotation
+        os.rename(self.log, self.log+'.1')
+        self.write('e\n')
+        self.assertEqual({1: ['e'], 2: ['e']}, self.parse([1, 2]))
+        self.assertEqual({}, self.parse([1, 2]))
+    
+    def test_pending(self):
+        self.write('a\n')
+        self.assertEqual({1: ['a']}, self.parse([1]))
+        self.write('b\n')
+        self.assertEqual({1: ['b']}, self.parse([1]))
+        # Lines of executions whose output has not been stored are parsed again
+        self.assertEqual({1: ['b']}, self.parse([1], stored=False))
+        self.assertEqual({}, self.parse([1]))
+    
+    def test_expire(self):
+        self.write('a\n')
+        self.parse([1, 2])
+        self.parse([1])
+        self.parse([1], expire_date='2026-01-01 02:00:00 UTC')
+        with open(self.state) as handler:
+            state = json.load(handler)
+        self.assertEqual(['1'], list(state['objects']))
+        self.assertEqual(['1'], list(state['pending']))
@@ -0,0 +1,53 @@
+import datetime
+import decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.orchestration.models import Server
+from orchestra.utils.tests import BaseTestCase
+
+from .. import helpers
+from ..models import MonitorData
+
+
+class CompactTests(BaseTestCase):
+    def setUp(self):
+        self.servers = [Server.objects.create(name='web%i.example.com' % ix) for ix in range(3)]
+        self.ct = ContentType.objects.get_for_model(Server)
+        self.epoch = timezone.now() - datetime.timedelta(days=90)
+
+    def create_data(self, server, values):
+        MonitorData.objects.bulk_create([
+            MonitorData(monitor='TestMonitor', content_type=self.ct, object_id=server.pk,
+                value=decimal.Decimal(str(value)), created_at=self.epoch+datetime.timedelta(days=ix))
+            for ix, value in enumerate(values)
+        ])
+        return MonitorData.objects.filter(monitor='TestMonitor', object_id=server.pk)
+
+    def get_values(self, dataset):
+        return [float(value) for value in dataset.order_by('created_at').values_list('value', flat=True)]
+
+    def test_delete_old_equal_values(self):
+        dataset = self.create_data(self.servers[0], (5, 10, 10, 10, 10.01, 20, 20, 20, 5))
+        other = self.create_data(self.servers[1], (10, 10, 10))
+        progress = []
+        deleted = helpers.delete_old_equal_values(
+            MonitorData.objects.all(), chunk_size=1, progress=lambda *args: progress.append(args))
+        self.assertEqual(4, deleted)
+        self.assertEqual([5, 10, 10.01, 20, 20, 5], self.get_values(dataset))
+        self.assertEqual([10, 10], self.get_values(other))
+        self.assertEqual([
+            ((self.ct.pk, self.servers[0].pk), 3),
+            ((self.ct.pk, self.servers[1].pk), 4),
+        ], progress)
+
+    def test_monthly_sum_old_values(self):
+        dataset = self.create_data(self.servers[0], [1]*70)
+        other = self.create_data(self.servers[1], [1]*70)
+        # Resumed after the first object
+        start = (self.ct.pk, self.servers[0].pk)
+        helpers.monthly_sum_old_values(MonitorData.objects.all(), start=start)
+        self.assertEqual(70, dataset.count())
+        self.assertEqual(70, sum(self.get_values(other)))
+        self.assertLessEqual(other.count(), 4)
@@ -0,0 +1,54 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from djcelery.models import CrontabSchedule, PeriodicTask
+
+from orchestra.contrib.orchestration.models import Server
+from orchestra.utils.tests import BaseTestCase
+
+from ..models import Resource, ResourceData, resource_index
+
+
+class ResourceHandlerTests(BaseTestCase):
+    def setUp(self):
+        self.resource = Resource.objects.create(
+            name='load',
+            content_type=ContentType.objects.get_for_model(Server),
+            aggregation='last',
+            verbose_name='Server load',
+            unit='load',
+            scale='1',
+            on_demand=True,
+        )
+        self.servers = [Server.objects.create(name='web%i.example.com' % ix) for ix in range(3)]
+        for server in self.servers[:2]:
+            ResourceData.objects.get_or_create(server, self.resource)
+
+    def test_prefetch(self):
+        resource_index.get(Server)
+        with self.assertNumQueries(2):
+            servers = Server.objects.filter(pk__in=[server.pk for server in self.servers])
+            rdatas = [server.resources.load for server in servers.prefetch_related('resource_set')]
+        self.assertEqual([True, True, False], [rdata.pk is not None for rdata in rdatas])
+        self.assertEqual({self.resource}, set(rdata.resource for rdata in rdatas))
+
+    def test_inactive(self):
+        self.resource.is_active = False
+        self.resource.save()
+        self.assertIsNotNone(self.servers[0].resources.load.pk)
+        with self.assertRaises(Resource.DoesNotExist):
+            self.servers[2].resources.load
+
+
+class PeriodicTaskTests(BaseTestCase):
+    def test_upgrade(self):
+        crontab = CrontabSchedule.objects.create(minute='0')
+        resource = Resource.objects.create(name='load', content_type=ContentType.objects.get_for_model(Server),
+            aggregation='last', verbose_name='Server load', unit='load', scale='1', crontab=crontab)
+        # Created by previous versions
+        PeriodicTask.objects.create(name='monitor.%s' % resource, task='resources.Monitor',
+            args=[resource.pk], crontab=crontab)
+        Resource.objects.filter(pk=resource.pk).update(name='cpu')
+        apps.get_app_config('resources').sync_periodic_tasks()
+        tasks = PeriodicTask.objects.filter(task__startswith='resources.Monitor')
+        self.assertEqual([('resources.MonitorCrontab', crontab.pk)],
+            list(tasks.values_list('task', 'crontab_id')))
@@ -0,0 +1,76 @@
+import datetime
+from unittest import skipUnless
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils import timezone
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import partitions
+from ..models import MonitorData
+
+
+class PartitionTests(BaseTestCase):
+    def setUp(self):
+        self.connection = partitions.get_connection()
+
+    def test_months(self):
+        date = timezone.make_aware(datetime.datetime(2024, 12, 31, 23, 59))
+        start, end = partitions.get_month(date)
+        self.assertEqual((2024, 12, 1), (start.year, start.month, start.day))
+        self.assertEqual('resources_monitordata_p202412', partitions.get_partition_name(start))
+        start, end = partitions.get_next_month(end)
+        self.assertEqual((2025, 1), (start.year, start.month))
+        self.assertEqual((2025, 2), (end.year, end.month))
+
+    def test_fallback(self):
+        if partitions.is_supported(self.connection):
+            self.skipTest("Partitioning is supported")
+        self.assertFalse(partitions.is_partitioned(self.connection))
+        self.assertEqual([], partitions.create_partitions(self.connection))
+        self.assertEqual([], partitions.drop_partitions(self.connection, timezone.now()))
+
+
+@skipUnless(partitions.is_supported(connection), "Partitioning requires PostgreSQL 11 or later")
+class PartitioningTests(BaseTestCase):
+    def setUp(self):
+        self.connection = partitions.get_connection()
+        self.ct = ContentType.objects.get_for_model(ContentType)
+
+    def create_data(self, created_at, count):
+        MonitorData.objects.bulk_create([
+            MonitorData(monitor='TestMonitor', content_type=self.ct, object_id=ix, value=ix,
+                created_at=created_at)
+            for ix in range(count)
+        ])
+
+    def count(self, table):
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s" % self.connection.ops.quote_name(table))
+            return cursor.fetchone()[0]
+
+    def test_partition(self):
+        start, end = partitions.get_month(timezone.now())
+        old_start, old_end = partitions.get_month(start - datetime.timedelta(days=70))
+        self.create_data(old_start, 2)
+        self.create_data(start, 3)
+        self.assertTrue(partitions.partition(self.connection))
+        self.assertFalse(partitions.partition(self.connection))
+        self.assertTrue(partitions.is_partitioned(self.connection))
+        self.assertEqual(5, MonitorData.objects.count())
+        old_name = partitions.get_partition_name(old_start)
+        self.assertEqual(2, self.count(old_name))
+        self.assertEqual(3, self.count(partitions.get_partition_name(start)))
+        self.assertEqual(0, self.count(partitions.DEFAULT))
+        # Rows without a partition go to the default one until it is created
+        older_start, older_end = partitions.get_month(old_start - datetime.timedelta(days=1))
+        self.create_data(older_start, 4)
+        self.assertEqual(4, self.count(partitions.DEFAULT))
+        name = partitions.create_partition(self.connection, older_start, older_end)
+        self.assertEqual(0, self.count(partitions.DEFAULT))
+        self.assertEqual(4, self.count(name))
+        self.assertEqual(9, MonitorData.objects.count())
+        dropped = partitions.drop_partitions(self.connection, old_end)
+        self.assertEqual([name, old_name], dropped)
+        self.assertEqual(3, MonitorData.objects.count())
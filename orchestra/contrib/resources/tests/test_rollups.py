@@ -0,0 +1,77 @@
+import datetime
+import decimal
+import random
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.orchestration.models import Server
+from orchestra.utils.tests import BaseTestCase
+
+from .. import helpers, rollups, settings
+from ..aggregations import MonthlySum, MonthlyAvg
+from ..models import MonitorData
+
+
+class RollupTests(BaseTestCase):
+    def setUp(self):
+        self.servers = [Server.objects.create(name='web%i.example.com' % ix) for ix in range(3)]
+        self.ct = ContentType.objects.get_for_model(Server)
+        self.random = random.Random(1)
+        epoch = rollups.truncate(timezone.now(), rollups.MONTHLY)
+        minutes = max(int((timezone.now()-epoch).total_seconds()//60), 60)
+        for server in self.servers:
+            samples = []
+            for ix in range(20):
+                created_at = epoch + datetime.timedelta(minutes=self.random.randint(1, minutes))
+                value = decimal.Decimal(self.random.randint(0, 10**6))/100
+                samples.append(MonitorData(monitor='TestMonitor', content_type=self.ct,
+                    object_id=server.pk, created_at=created_at, value=value))
+            # Stored in batches, some of them out of order
+            for ix in range(0, len(samples), 5):
+                batch = samples[ix:ix+5]
+                MonitorData.objects.bulk_create(batch)
+                rollups.update(batch)
+        self.dataset = MonitorData.objects.filter(monitor='TestMonitor')
+
+    def get_rollups(self, period):
+        return sorted(
+            (rollup.key, rollup.count, rollup.sum, rollup.last_value, rollup.last_at)
+            for rollup in rollups.MODELS[period].objects.all()
+        )
+
+    def test_update(self):
+        for period in rollups.MODELS:
+            updated = self.get_rollups(period)
+            rollups.MODELS[period].objects.all().delete()
+            rollups.rebuild(self.dataset, periods=[period])
+            self.assertEqual(self.get_rollups(period), updated)
+        self.assertEqual(3, rollups.MODELS[rollups.MONTHLY].objects.count())
+
+    def test_usages(self):
+        for aggregation in (MonthlySum(), MonthlyAvg()):
+            raw = aggregation.compute_usages(aggregation.filter(self.dataset))
+            dataset = aggregation.get_dataset().filter(monitor='TestMonitor')
+            usages = aggregation.compute_usages(aggregation.filter(dataset))
+            self.assertEqual(set(raw), set(usages))
+            for object_id, usage in raw.items():
+                self.assertAlmostEqual(float(usage), float(usages[object_id]), places=1)
+
+    def test_compaction(self):
+        helpers.monthly_sum_old_values(self.dataset)
+        self.assertEqual(3, self.dataset.count())
+        compacted = {period: self.get_rollups(period) for period in rollups.MODELS}
+        for model in rollups.MODELS.values():
+            model.objects.all().delete()
+        rollups.rebuild(self.dataset)
+        for period in rollups.MODELS:
+            self.assertEqual(self.get_rollups(period), compacted[period])
+
+    def test_expired(self):
+        updated = {period: self.get_rollups(period) for period in rollups.MODELS}
+        self.dataset.filter(object_id=self.servers[0].pk).delete()
+        with mock.patch.object(settings, 'RESOURCES_MONITOR_DATA_EXPIRE_DAYS', 0):
+            self.assertEqual(0, rollups.rebuild(self.dataset))
+        for period in rollups.MODELS:
+            self.assertEqual(self.get_rollups(period), updated[period])
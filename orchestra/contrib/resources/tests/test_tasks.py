@@ -0,0 +1,56 @@
+from unittest import mock
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import settings, tasks
+
+
+class MonitorResourcesTests(BaseTestCase):
+    def setUp(self):
+        self.disk = mock.Mock(monitors=['disk', 'traffic'])
+        self.disk.get_monitor_usages.side_effect = lambda monitor, ids: {1: len(monitor)}
+        self.traffic = mock.Mock(monitors=['traffic'])
+        self.traffic.get_monitor_usages.side_effect = lambda monitor, ids: {2: 1}
+        self.failing = None
+
+    def execute_monitor(self, resource, monitor, ids):
+        if monitor == self.failing:
+            raise OSError("%s is down" % monitor)
+        return [monitor]
+
+    def monitor_resources(self, workers):
+        updates = {}
+        def update_used(resource, usages, ids=None):
+            updates[resource] = usages
+        with mock.patch.object(settings, 'RESOURCES_MONITOR_WORKERS', workers), \
+                mock.patch.object(tasks, 'execute_monitor', self.execute_monitor), \
+                mock.patch.object(tasks, 'update_used', update_used):
+            logs = tasks.monitor_resources([self.disk, self.traffic])
+        return sorted(logs), updates
+
+    def test_serial(self):
+        logs, updates = self.monitor_resources(1)
+        # Shared monitors are executed once
+        self.assertEqual(['disk', 'traffic'], logs)
+        self.assertEqual({self.disk: {1: 11}, self.traffic: {2: 1}}, updates)
+
+    def test_concurrent(self):
+        logs, updates = self.monitor_resources(4)
+        self.assertEqual(['disk', 'traffic'], logs)
+        self.assertEqual({self.disk: {1: 11}, self.traffic: {2: 1}}, updates)
+
+    def test_failing_monitor(self):
+        self.failing = 'disk'
+        for workers in (1, 4):
+            with self.assertLogs(tasks.logger, 'ERROR'):
+                logs, updates = self.monitor_resources(workers)
+            self.assertEqual(['traffic'], logs)
+            self.assertEqual({self.traffic: {2: 1}}, updates)
+
+    def test_failing_usages(self):
+        self.traffic.get_monitor_usages.side_effect = OSError("traffic is down")
+        for workers in (1, 4):
+            with self.assertLogs(tasks.logger, 'ERROR'):
+                logs, updates = self.monitor_resources(workers)
+            self.assertEqual(['disk', 'traffic'], logs)
+            self.assertEqual({self.disk: {1: 11}}, updates)
@@ -0,0 +1,67 @@
+"""
+NumPy engine for the aggregation plugins
+
+The (object_id, created_at, value) columns of a dataset are loaded once, ordered by object
+and date, and the per object results are computed with segment operations.
+"""
+import decimal
+
+import numpy
+
+
+def load(dataset):
+    """ returns object_ids, timestamps and values arrays ordered by object and date """
+    dataset = dataset.order_by('object_id', 'created_at').values_list(
+        'object_id', 'created_at', 'value')
+    object_ids, timestamps, values = [], [], []
+    for object_id, created_at, value in dataset.iterator():
+        object_ids.append(object_id)
+        timestamps.append(created_at.timestamp())
+        values.append(value)
+    return (
+        numpy.array(object_ids, dtype=numpy.int64),
+        numpy.array(timestamps, dtype=numpy.float64),
+        numpy.array(values, dtype=numpy.float64),
+    )
+
+
+def get_segments(object_ids):
+    """ start index of the segment of each object """
+    if not len(object_ids):
+        return numpy.array([], dtype=numpy.intp)
+    return numpy.flatnonzero(numpy.r_[True, object_ids[1:] != object_ids[:-1]])
+
+
+def get_lengths(starts, size):
+    return numpy.diff(numpy.r_[starts, size])
+
+
+def segment_sum(values, starts):
+    if not len(starts):
+        return values[:0]
+    return numpy.add.reduceat(values, starts)
+
+
+def segment_last(values, starts):
+    ends = numpy.r_[starts[1:], len(values)] - 1
+    return values[ends]
+
+
+def time_weighted_average(timestamps, values, starts, epochs):
+    """
+    average of each segment weighted by the time elapsed since the previous sample,
+    or since its epoch for the first sample
+    """
+    previous = numpy.empty_like(timestamps)
+    previous[1:] = timestamps[:-1]
+    previous[starts] = epochs
+    totals = segment_last(timestamps, starts) - epochs
+    totals = numpy.repeat(totals, get_lengths(starts, len(timestamps)))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        weights = (timestamps-previous)/totals
+    return segment_sum(values*weights, starts)
+
+
+def to_decimal(value):
+    """ results leave the engine as Decimal, like the values they are computed from """
+    return decimal.Decimal(repr(float(value)))
@@ -261,6 +261,9 @@ class Service(models.Model):
         queryset = related_model.objects.all()
         if related_model._meta.model_name != 'account':
             queryset = queryset.select_related('account').all()
+        if hasattr(related_model, 'resource_set'):
+            # metrics like account.resources.traffic.used
+            queryset = queryset.prefetch_related('resource_set')
         for instance in queryset:
             updates += manager.update_by_instance(instance, service=self, commit=commit)
         return updates
@@ -319,7 +319,8 @@ class Exim4Traffic(ServiceMonitor):
         mainlog = settings.SYSTEMUSERS_MAIL_LOG_PATH
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'mainlogs': str((mainlog, mainlog+'.1')),
+            'mainlogs': str((mainlog+'.1', mainlog)),
+            'log_offsets': self.get_log_offsets_script(),
         }
         self.append(textwrap.dedent("""\
             import re
@@ -327,6 +328,8 @@ class Exim4Traffic(ServiceMonitor):
             from datetime import datetime
             from dateutil import tz
             
+            {log_offsets}
+            
             def to_local_timezone(date, tzlocal=tz.tzlocal()):
                 date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
                 date = date.replace(tzinfo=tz.tzutc())
@@ -341,30 +344,32 @@ class Exim4Traffic(ServiceMonitor):
             
             def prepare(object_id, username, ini_date):
                 global users
+                log_offsets.prepare(object_id, ini_date)
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[username] = [ini_date, object_id, 0]
             
             def monitor(users, end_date, mainlogs):
                 user_regex = re.compile(r' U=([^ ]+) ')
-                for mainlog in mainlogs:
-                    try:
-                        with open(mainlog, 'r') as mainlog:
-                            for line in mainlog.readlines():
-                                if ' <= ' in line and 'P=local' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        date, time, id, __, __, user, protocol, size = line.split()[:8]
-                                        date = date.replace('-', '')
-                                        date += time.replace(':', '')
-                                        if sender[0] < int(date) < end_date:
-                                            sender[2] += int(size[2:])
-                    except IOError as e:
-                        sys.stderr.write(str(e))
+                object_ids = [sender[1] for sender in users.values()]
+                # Only the lines appended since the last execution
+                for inode, position, line in log_offsets.readlines(mainlogs, object_ids):
+                    if ' <= ' in line and 'P=local' in line:
+                        username = user_regex.search(line).groups()[0]
+                        try:
+                            sender = users[username]
+                        except KeyError:
+                            continue
+                        else:
+                            date, time, id, __, __, user, protocol, size = line.split()[:8]
+                            new = log_offsets.is_new(sender[1], inode, position)
+                            if new is None:
+                                date = date.replace('-', '')
+                                date += time.replace(':', '')
+                                new = sender[0] < int(date) < end_date
+                            if new:
+                                sender[2] += int(size[2:])
+                log_offsets.save()
                 
                 for username, opts in users.iteritems():
                     __, object_id, size = opts
@@ -405,7 +410,8 @@ class VsFTPdTraffic(ServiceMonitor):
         vsftplog = settings.SYSTEMUSERS_FTP_LOG_PATH
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'vsftplogs': str((vsftplog, vsftplog+'.1')),
+            'vsftplogs': str((vsftplog+'.1', vsftplog)),
+            'log_offsets': self.get_log_offsets_script(),
         }
         self.append(textwrap.dedent("""\
             import re
@@ -413,6 +419,8 @@ class VsFTPdTraffic(ServiceMonitor):
             from datetime import datetime
             from dateutil import tz
             
+            {log_offsets}
+            
             def to_local_timezone(date, tzlocal=tz.tzlocal()):
                 date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
                 date = date.replace(tzinfo=tz.tzutc())
@@ -429,6 +437,7 @@ class VsFTPdTraffic(ServiceMonitor):
             
             def prepare(object_id, username, ini_date):
                 global users
+                log_offsets.prepare(object_id, ini_date)
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[username] = [ini_date, object_id, 0]
@@ -436,24 +445,25 @@ class VsFTPdTraffic(ServiceMonitor):
             def monitor(users, end_date, months, vsftplogs):
                 user_regex = re.compile(r'\] \[([^ ]+)\] (OK|FAIL) ')
                 bytes_regex = re.compile(r', ([0-9]+) bytes, ')
-                for vsftplog in vsftplogs:
-                    try:
-                        with open(vsftplog, 'r') as vsftplog:
-                            for line in vsftplog.readlines():
-                                if ' bytes, ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        user = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        __, month, day, time, year = line.split()[:5]
-                                        date = year + months[month] + day + time.replace(':', '')
-                                        if user[0] < int(date) < end_date:
-                                            bytes = bytes_regex.search(line).groups()[0]
-                                            user[2] += int(bytes)
-                    except IOError as e:
-                        sys.stderr.write(str(e))
+                object_ids = [user[1] for user in users.values()]
+                # Only the lines appended since the last execution
+                for inode, position, line in log_offsets.readlines(vsftplogs, object_ids):
+                    if ' bytes, ' in line:
+                        username = user_regex.search(line).groups()[0]
+                        try:
+                            user = users[username]
+                        except KeyError:
+                            continue
+                        else:
+                            new = log_offsets.is_new(user[1], inode, position)
+                            if new is None:
+                                __, month, day, time, year = line.split()[:5]
+                                date = year + months[month] + day + time.replace(':', '')
+                                new = user[0] < int(date) < end_date
+                            if new:
+                                bytes = bytes_regex.search(line).groups()[0]
+                                user[2] += int(bytes)
+                log_offsets.save()
                 
                 for username, opts in users.items():
                     __, object_id, size = opts
@@ -28,6 +28,8 @@ class Apache2Controller(ServiceController):
         ('webapps.WebApp', 'website_set'),
     )
     verbose_name = _("Apache 2")
+    # Virtual host changes of concurrent requests are applied with a single apache reload
+    coalesce_window = 5
     doc_settings = (settings, (
         'WEBSITES_VHOST_EXTRA_DIRECTIVES',
         'WEBSITES_DEFAULT_SSL_CERT',
@@ -434,70 +436,100 @@ class Apache2Traffic(ServiceMonitor):
     """
     Parses apache logs,
     looking for the size of each request on the last word of the log line.
+    All the sites are parsed by a single script, reading each log file only once.
     """
     model = 'websites.Website'
     resource = ServiceMonitor.TRAFFIC
     verbose_name = _("Apache 2 Traffic")
+    script_executable = '/usr/bin/python'
     monthly_sum_old_values = True
     doc_settings = (settings,
         ('WEBSITES_TRAFFIC_IGNORE_HOSTS',)
     )
 
     def prepare(self):
-        super(Apache2Traffic, self).prepare()
-        ignore_hosts = '\\|'.join(settings.WEBSITES_TRAFFIC_IGNORE_HOSTS)
+        ignore_hosts = '|'.join(map(re.escape, settings.WEBSITES_TRAFFIC_IGNORE_HOSTS))
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'ignore_hosts': '-v "%s"' % ignore_hosts if ignore_hosts else '',
+            'ignore_hosts': repr(ignore_hosts),
+            'log_offsets': self.get_log_offsets_script(),
         }
         self.append(textwrap.dedent("""\
-            function monitor () {
-                OBJECT_ID=$1
-                INI_DATE=$(date "+%%Y%%m%%d%%H%%M%%S" -d "$2")
-                END_DATE=$(date '+%%Y%%m%%d%%H%%M%%S' -d '%(current_date)s')
-                LOG_FILE="$3"
-                {
-                    { grep %(ignore_hosts)s ${LOG_FILE} || echo -e '\\r'; } \\
-                        | awk -v ini="${INI_DATE}" -v end="${END_DATE}" '
-                            BEGIN {
-                                sum = 0
-                                months["Jan"] = "01"
-                                months["Feb"] = "02"
-                                months["Mar"] = "03"
-                                months["Apr"] = "04"
-                                months["May"] = "05"
-                                months["Jun"] = "06"
-                                months["Jul"] = "07"
-                                months["Aug"] = "08"
-                                months["Sep"] = "09"
-                                months["Oct"] = "10"
-                                months["Nov"] = "11"
-                                months["Dec"] = "12"
-                            } {
-                                # date = [11/Jul/2014:13:50:41
-                                date = substr($4, 2)
-                                year = substr(date, 8, 4)
-                                month = months[substr(date, 4, 3)];
-                                day = substr(date, 1, 2)
-                                hour = substr(date, 13, 2)
-                                minute = substr(date, 16, 2)
-                                second = substr(date, 19, 2)
-                                line_date = year month day hour minute second
-                                if ( line_date > ini && line_date < end)
-                                    sum += $NF
-                            } END {
-                                print sum
-                            }' || [[ $? == 1 ]] && true
-                } | xargs echo ${OBJECT_ID}
-            }""") % context)
+            import re
+            import sys
+            from datetime import datetime
+            from dateutil import tz
+            
+            {log_offsets}
+            
+            def to_local_timezone(date, tzlocal=tz.tzlocal()):
+                date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S %Z')
+                date = date.replace(tzinfo=tz.tzutc())
+                date = date.astimezone(tzlocal)
+                return date
+            
+            # Use local timezone
+            end_date = to_local_timezone('{current_date}')
+            end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
+            ignore_hosts = {ignore_hosts}
+            months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+            months = dict((m, '%02d' % n) for n, m in enumerate(months, 1))
+            logs = {{}}
+            
+            def prepare(object_id, log_file, ini_date):
+                global logs
+                log_offsets.prepare(object_id, ini_date)
+                ini_date = to_local_timezone(ini_date)
+                ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
+                logs.setdefault(log_file, []).append([ini_date, object_id, 0])
+            
+            def monitor(logs, end_date, months):
+                ignore = re.compile(ignore_hosts) if ignore_hosts else None
+                for log_file, sites in logs.items():
+                    object_ids = [site[1] for site in sites]
+                    # Only the lines appended since the last execution
+                    for inode, position, line in log_offsets.readlines((log_file+'.1', log_file), object_ids):
+                        if ignore and ignore.search(line):
+                            continue
+                        line = line.split()
+                        try:
+                            size = int(line[-1])
+                        except (IndexError, ValueError):
+                            # no body or not interested in this line
+                            continue
+                        date = None
+                        for site in sites:
+                            new = log_offsets.is_new(site[1], inode, position)
+                            if new is None:
+                                if date is None:
+                                    try:
+                                        # [11/Jul/2014:13:50:41
+                                        date = line[3][1:]
+                                        date = int(date[7:11] + months[date[3:6]] + date[:2] + date[12:].replace(':', ''))
+                                    except (IndexError, KeyError, ValueError):
+                                        # malformed line, not inside any period
+                                        date = 0
+                                new = site[0] < date < end_date
+                            if new:
+                                site[2] += size
+                log_offsets.save()
+                
+                for sites in logs.values():
+                    for __, object_id, size in sites:
+                        sys.stdout.write('%s %s\\n' % (object_id, size))
+            """).format(**context)
+        )
+
+    def commit(self):
+        self.append('monitor(logs, end_date, months)')
 
     def monitor(self, site):
         context = self.get_context(site)
-        self.append('monitor {object_id} "{last_date}" {log_file}'.format(**context))
+        self.append("prepare(%(object_id)s, '%(log_file)s', '%(last_date)s')" % context)
 
     def get_context(self, site):
         return {
-            'log_file': '%s{,.1}' % site.get_www_access_log_path(),
+            'log_file': site.get_www_access_log_path(),
             'last_date': self.get_last_date(site.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
             'object_id': site.pk,
         }
@@ -0,0 +1,80 @@
+import contextlib
+import datetime
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.utils import timezone
+
+from orchestra.contrib.domains.models import Domain
+from orchestra.contrib.orchestration import manager
+from orchestra.contrib.orchestration.models import Server
+from orchestra.contrib.resources import settings as resources_settings
+from orchestra.utils.tests import BaseTestCase
+
+from ..backends.apache import Apache2Controller, Apache2Traffic
+from ..models import Website
+
+
+class Apache2ControllerTests(BaseTestCase):
+    def setUp(self):
+        account = self.create_account()
+        server = Server.objects.create(name='web.example.com')
+        self.site = Website.objects.create(name='site', account=account, target_server=server)
+        self.site.domains.add(Domain.objects.create(name='site.example.com', account=account))
+
+    def get_fragment(self, now):
+        backend = Apache2Controller()
+        backend.set_content()
+        with mock.patch.object(timezone, 'now', return_value=now):
+            backend.save(self.site)
+        return manager.get_fragment(backend, (0, 0))
+
+    def test_digest(self):
+        now = timezone.now()
+        fragment = self.get_fragment(now)
+        later = self.get_fragment(now + datetime.timedelta(minutes=5))
+        # The banner time changes, but it is not part of the digest
+        self.assertIn('Generated by Orchestra at', '\n'.join(fragment))
+        self.assertNotEqual(fragment, later)
+        self.assertEqual(manager.get_digest('save', fragment), manager.get_digest('save', later))
+        self.site.protocol = Website.HTTPS_ONLY
+        changed = self.get_fragment(now)
+        self.assertNotEqual(manager.get_digest('save', fragment), manager.get_digest('save', changed))
+
+
+class Apache2TrafficTests(BaseTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        account = self.create_account()
+        server = Server.objects.create(name='web.example.com')
+        self.site = Website.objects.create(name='site', account=account, target_server=server)
+        self.log = os.path.join(self.tmp, 'access.log')
+
+    def monitor(self):
+        backend = Apache2Traffic()
+        with mock.patch.object(resources_settings, 'RESOURCES_MONITOR_STATE_DIR', self.tmp):
+            backend.prepare()
+        with mock.patch.object(Website, 'get_www_access_log_path', return_value=self.log):
+            backend.monitor(self.site)
+        backend.commit()
+        script = '\n'.join(cmd for method, cmds in backend.scripts for cmd in cmds)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            exec(script, {})
+        return stdout.getvalue()
+
+    def test_malformed_lines(self):
+        # Local time of the server
+        date = (datetime.datetime.now() - datetime.timedelta(hours=1)).strftime('%d/%b/%Y:%H:%M:%S')
+        with open(self.log, 'w') as handler:
+            handler.write('\n'.join((
+                '10.0.0.1 - - [%s +0000] "GET / HTTP/1.1" 200 100' % date,
+                'truncated 20',
+                '10.0.0.1 - - [%s +0000] "GET / HTTP/1.1" 200 30' % (date[:3] + 'Foo' + date[6:]),
+                '10.0.0.1 - - [%s +0000] "GET / HTTP/1.1" 200 5' % date,
+            )) + '\n')
+        self.assertEqual('%i 105\n' % self.site.pk, self.monitor())
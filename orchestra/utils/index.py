@@ -0,0 +1,59 @@
+import threading
+import time
+
+from django.core.cache import cache as shared_cache
+from django.db import transaction
+
+
+class VersionedIndex(object):
+    """
+    Process-wide index built from the database
+
+    Changes invalidate the index of the current process and bump a version stored on the
+    default cache, other processes rebuild their index when the version changes (shared
+    cache backend) or after get_timeout() seconds.
+    Subclasses provide version_key, build() and get_timeout().
+    """
+    version_key = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.version = None
+        self.built_at = 0
+
+    def build(self, *args):
+        raise NotImplementedError
+
+    def get_timeout(self):
+        """ seconds before rebuilding the index """
+        raise NotImplementedError
+
+    def get_version(self):
+        return shared_cache.get(self.version_key, 0)
+
+    def invalidate(self):
+        with self.lock:
+            self.index = None
+        try:
+            shared_cache.incr(self.version_key)
+        except ValueError:
+            shared_cache.set(self.version_key, 1, None)
+
+    def invalidate_receiver(self, sender, **kwargs):
+        """ signal receiver for the changes of the indexed models """
+        self.invalidate()
+        # Other processes can only see the changes after commit
+        transaction.on_commit(self.invalidate)
+
+    def get(self, *args):
+        """ the index, rebuilt with build(*args) when invalidated or expired """
+        version = self.get_version()
+        with self.lock:
+            now = time.monotonic()
+            expired = now-self.built_at > self.get_timeout()
+            if self.index is None or self.version != version or expired:
+                self.index = self.build(*args)
+                self.version = version
+                self.built_at = now
+            return self.index
@@ -160,7 +160,7 @@ def run(command, display=False, valid_codes=(0,), silent=False, stdin=b'', run_a
     return join(iterator, display=display, silent=silent, valid_codes=valid_codes)
 
 
-def sshrun(addr, command, *args, executable='bash', persist=False, options=None, **kwargs):
+def get_ssh_command(addr, executable='bash', persist=False, options=None, user=None):
     from .. import settings
     base_options = {
         'stricthostkeychecking': 'no',
@@ -181,9 +181,14 @@ def sshrun(addr, command, *args, executable='bash', persist=False, options=None,
     base_options.update(options or {})
     options = ['%s=%s' % (k, v) for k, v in base_options.items()]
     options = ' -o '.join(options)
-    user = kwargs.get('user', settings.ORCHESTRA_SSH_DEFAULT_USER)
-    cmd = 'ssh -o {options} -C {user}@{addr} {executable}'.format(
+    user = user or settings.ORCHESTRA_SSH_DEFAULT_USER
+    return 'ssh -o {options} -C {user}@{addr} {executable}'.format(
         options=options, addr=addr, user=user, executable=executable)
+
+
+def sshrun(addr, command, *args, executable='bash', persist=False, options=None, **kwargs):
+    cmd = get_ssh_command(addr, executable=executable, persist=persist, options=options,
+        user=kwargs.pop('user', None))
     return run(cmd, *args, stdin=command.encode('utf8'), **kwargs)
 
 